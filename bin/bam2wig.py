@@ -176,6 +176,8 @@ def parse_arguments():
                          help='Merge both data strands.')
     parser.add_argument( '--read-filter', default=None, choices=['1','2'],
         help='Filter paired end reads to only accept this read pair (ie uses the is_read1 pysam attribute)')
+    parser.add_argument( '--coverage-cache-dir', 
+        help='Cache the coverage in this directory, and reuse it in later runs on the same bam. (default: do not cache the coverage)')
 
         
     args = parser.parse_args()
@@ -206,7 +208,7 @@ def parse_arguments():
     
     return ( args.assay, not args.unstranded, args.mapped_reads_fname, args.out_fname_prefix, 
              args.bigwig, args.reverse_read_strand, read_filter, 
-             args.region, args.threads )
+             args.region, args.threads, args.coverage_cache_dir )
         
 
 def build_bigwig_from_bedgraph(bedgraph_fp, chrm_sizes_file, op_fname):
@@ -226,7 +228,8 @@ def build_bigwig_from_bedgraph(bedgraph_fp, chrm_sizes_file, op_fname):
 
 def main():
     ( assay, stranded, reads_fname, op_prefix, build_bigwig, 
-      reverse_read_strand, read_filter, region, num_threads) = parse_arguments()
+      reverse_read_strand, read_filter, region, num_threads, 
+      coverage_cache_dir ) = parse_arguments()
     
     # initialize the assay specific options
     if assay == 'cage':
@@ -260,6 +263,12 @@ def main():
     else:
         raise ValueError, "Unrecognized assay: '%s'" % assay
     
+    # the chipseq coverage is the fragment coverage, which isn't cached
+    if coverage_cache_dir != None and assay != 'chipseq':
+        reads.set_coverage_cache(coverage_cache_dir)
+        reads.coverage_cache.populate(
+            None if region == None else [region,], num_threads)
+    
     # if we want to build a bigwig, make sure that the script is on the path
     if build_bigwig:
         try: 
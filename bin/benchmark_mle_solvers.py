@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, os
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), ".." ) )
+from grit.frequency_estimation import (
+    estimate_transcript_frequencies, calc_lhd, MLE_SOLVERS )
+from grit.f_matrix import DesignMatrixStore
+import grit.config as config
+
+def time_fn(fn, n_reps, *args):
+    best_time = None
+    for i in xrange(n_reps):
+        start_time = time.time()
+        rv = fn(*args)
+        run_time = time.time() - start_time
+        if best_time == None or run_time < best_time:
+            best_time = run_time
+    return best_time, rv
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark the transcript frequency MLE solvers.')
+    parser.add_argument( 'design_matrices', nargs='+',
+        help='Design matrix stores (the .fmats files that quantification writes to the tmp directory).')
+    parser.add_argument( '--n-reps', type=int, default=1 )
+    args = parser.parse_args()
+    return args.design_matrices, args.n_reps
+
+def iter_design_matrices(fnames):
+    for fname in fnames:
+        store = DesignMatrixStore.load(fname)
+        for gene_id in sorted(store):
+            yield gene_id, store.get(gene_id)
+
+def main():
+    fnames, n_reps = parse_arguments()
+    config.log_statement = lambda *args, **kwargs: None
+    config.DEBUG_VERBOSE = False
+    
+    total_times = dict((solver, 0.0) for solver in MLE_SOLVERS)
+    print "\t".join(["gene", "transcripts", "bins"] + [
+            "%s %s" % (solver, x) for solver in MLE_SOLVERS 
+            for x in ("time", "lhd")])
+    for gene_id, f_mat in iter_design_matrices(fnames):
+        expected, observed = f_mat.expected_and_observed()
+        line = [gene_id, 
+                str(expected.shape[1]), str(expected.shape[0])]
+        for solver in MLE_SOLVERS:
+            run_time, x = time_fn(
+                estimate_transcript_frequencies, n_reps, 
+                observed, expected, solver)
+            total_times[solver] += run_time
+            line.append("%.3fs" % run_time)
+            line.append("%.4f" % calc_lhd(x, observed, expected))
+        print "\t".join(line)
+    
+    for solver in MLE_SOLVERS:
+        print "Total %s: %.3fs" % (solver, total_times[solver])
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, os
+import time
+
+import numpy
+
+sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), ".." ) )
+from grit.files.reads import RNAseqReads, CAGEReads, PolyAReads
+import grit.config as config
+
+def iter_cigar_blocks(read):
+    """Walk the cigar string in python, as we used to.
+
+    """
+    start = read.pos
+    for contig_type, length in read.cigar:
+        if contig_type == 0:
+            yield ( start, start + length - 1 )
+            start += length
+        elif contig_type in (2, 3):
+            start += length
+    return
+
+def build_read_coverage_array_by_block( reads, chrm, strand, start, stop ):
+    """The per block coverage accumulation that we used to use.
+
+    """
+    cvg = numpy.zeros(stop - start + 1)
+    for rd in reads.iter_reads( chrm, strand, start, stop ):
+        for b_start, b_stop in iter_cigar_blocks( rd ):
+            cvg[max(0, b_start-start):max(0, b_stop-start+1)] += 1
+    return cvg
+
+def build_signal_coverage_array_by_read( reads, chrm, strand, start, stop ):
+    """The per read signal accumulation that we used to use.
+
+    """
+    cvg = numpy.zeros(stop - start + 1)
+    for rd in reads.fetch( chrm, start, stop ):
+        for rd_strand, pos, weight in reads.iter_signal_for_read(rd):
+            if strand != rd_strand: continue
+            if pos < start or pos > stop: continue
+            cvg[pos-start] += weight
+    return cvg
+
+def time_fn(fn, n_reps, *args):
+    best_time = None
+    for i in xrange(n_reps):
+        start_time = time.time()
+        rv = fn(*args)
+        run_time = time.time() - start_time
+        if best_time == None or run_time < best_time:
+            best_time = run_time
+    return best_time, rv
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark building read coverage arrays.')
+    parser.add_argument( 'reads', help='Indexed bam file.')
+    parser.add_argument( 'region',
+        help='Region to benchmark, in the format chrm:strand:start-stop')
+    parser.add_argument( '--reads-type', default='rnaseq',
+        choices=['rnaseq', 'cage', 'polya'] )
+    parser.add_argument( '--reverse-read-strand', default=False,
+                         action='store_true' )
+    parser.add_argument( '--n-reps', type=int, default=3 )
+    args = parser.parse_args()
+
+    chrm, strand, pos = args.region.split(":")
+    start, stop = [int(x) for x in pos.split("-")]
+    return ( args.reads, args.reads_type, args.reverse_read_strand,
+             (chrm, strand, start, stop), args.n_reps )
+
+def main():
+    fname, reads_type, reverse_read_strand, region, n_reps = parse_arguments()
+    config.log_statement = lambda *args, **kwargs: None
+
+    if reads_type == 'rnaseq':
+        reads = RNAseqReads(fname).init(
+            reads_are_paired=True, pairs_are_opp_strand=True,
+            reads_are_stranded=True, reverse_read_strand=reverse_read_strand)
+        old_fn = build_read_coverage_array_by_block
+    elif reads_type == 'cage':
+        reads = CAGEReads(fname).init(reverse_read_strand=reverse_read_strand)
+        old_fn = build_signal_coverage_array_by_read
+    elif reads_type == 'polya':
+        reads = PolyAReads(fname).init(
+            reverse_read_strand=reverse_read_strand, pairs_are_opp_strand=True)
+        old_fn = build_signal_coverage_array_by_read
+
+    chrm, strand, start, stop = region
+    n_reads = sum(1 for rd in reads.fetch(chrm, start, stop))
+    # time the bam decoding alone, so that we can report the cost of
+    # building the coverage array
+    fetch_time, rv = time_fn(
+        lambda: sum(1 for rd in reads.iter_reads(chrm, strand, start, stop)),
+        n_reps)
+    old_time, old_cov = time_fn(old_fn, n_reps, reads, *region)
+    new_time, new_cov = time_fn(
+        reads.build_read_coverage_array, n_reps, *region)
+    assert numpy.abs(old_cov - new_cov).max() < 1e-6
+
+    print "Reads in region: %i" % n_reads
+    print "Fetch only:        %.3fs\t%i reads/s" % (
+        fetch_time, n_reads/fetch_time)
+    print "Per read coverage: %.3fs\t%i reads/s" % (
+        old_time, n_reads/old_time)
+    print "Vectorized:        %.3fs\t%i reads/s" % (
+        new_time, n_reads/new_time)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -35,14 +35,13 @@ import multiprocessing
 from multiprocessing.sharedctypes import RawArray, RawValue
 from lib.multiprocessing_utils import Pool
 
-import networkx as nx
-
 from lib.multiprocessing_utils import ThreadSafeFile
-from transcript import Transcript, Gene
+from transcript import Transcript, TranscriptSet, Gene
 from files.reads import fix_chrm_name_for_ucsc
 from proteomics.ORF import find_cds_for_gene
 from elements import \
     load_elements, cluster_elements, find_jn_connected_exons
+from splice_graph import SpliceGraph, EXON, SPLICE
 
 import config
 
@@ -60,38 +59,143 @@ REP_ID = None
 class TooManyCandidateTranscriptsError(Exception):
     pass
 
+def find_node_types(graph, tss_exons, tes_exons):
+    """Return boolean arrays marking the tss and tes exon nodes in graph.
+
+    """
+    is_tss = numpy.zeros(len(graph), dtype=bool)
+    is_tss[[graph.exon_indices[tuple(exon)] for exon in tss_exons]] = True
+    is_tes = numpy.zeros(len(graph), dtype=bool)
+    is_tes[[graph.exon_indices[tuple(exon)] for exon in tes_exons]] = True
+    return is_tss, is_tes
+
+def count_transcript_paths(graph, is_tss, is_tes):
+    """Count the transcripts that iter_transcripts would yield.
+
+    Transcripts start at a tss exon, and end at the first tes exon after
+    it. Returns the total number of transcripts, and the number that use 
+    every edge of graph. The counts are floats, so that they can't 
+    overflow.
+    """
+    levels = graph.topological_levels()
+    # n_paths_to[node] is the number of paths from a tss exon to node
+    # that can be extended. Paths that end at a tes exon are complete, 
+    # so they can only be extended from a tes exon that is their start
+    n_paths_to = numpy.zeros(len(graph), dtype=float)
+    n_complete_paths = 0.
+    for level in levels:
+        n_paths_to[level] += is_tss[level]
+        level_is_tes = is_tes[level]
+        n_complete_paths += (
+            n_paths_to[level][level_is_tes] 
+            - is_tss[level][level_is_tes]).sum()
+        n_paths_to[level[level_is_tes]] = is_tss[level[level_is_tes]]
+        edges = graph.out_edges(level)
+        numpy.add.at(n_paths_to, graph.edge_dsts[edges], 
+                     n_paths_to[graph.edge_srcs[edges]])
+    
+    # n_paths_from[node] is the number of paths from node to a tes exon,
+    # that don't pass through another tes exon
+    n_paths_from = numpy.zeros(len(graph), dtype=float)
+    for level in reversed(levels):
+        edges = graph.out_edges(level)
+        numpy.add.at(n_paths_from, graph.edge_srcs[edges], 
+                     n_paths_from[graph.edge_dsts[edges]])
+        n_paths_from[level[is_tes[level]]] = 1
+    
+    n_edge_paths = ( n_paths_to[graph.edge_srcs] 
+                     * n_paths_from[graph.edge_dsts] )
+    return n_complete_paths, n_edge_paths
+
+def prune_splice_graph(graph, is_tss, is_tes, max_num_transcripts):
+    """Remove junctions from graph until it has at most max_num_transcripts.
+
+    Junctions are scored by the number of candidate transcripts that use 
+    them, and the lowest scoring junctions are removed first. Every round
+    removes just enough of them to cover the excess transcripts, and then
+    the paths are recounted. Junctions that every transcript uses are 
+    never removed, and if only those are left then we raise 
+    TooManyCandidateTranscriptsError.
+    """
+    n_paths, n_edge_paths = count_transcript_paths(graph, is_tss, is_tes)
+    while n_paths > max_num_transcripts:
+        # never remove a junction that every transcript uses
+        edges = numpy.flatnonzero(n_edge_paths < n_paths)
+        if len(edges) == 0:
+            raise TooManyCandidateTranscriptsError, \
+                "Too many candidate transcripts"
+        edges = edges[numpy.argsort(n_edge_paths[edges], kind='mergesort')]
+        n_removed = numpy.searchsorted(
+            n_edge_paths[edges].cumsum(), n_paths - max_num_transcripts) + 1
+        pruned_graph = graph.without_edges(edges[:n_removed])
+        pruned_graph.exons = graph.exons
+        pruned_graph.exon_indices = graph.exon_indices
+        graph = pruned_graph
+        n_paths, n_edge_paths = count_transcript_paths(graph, is_tss, is_tes)
+    
+    return graph
+
 def iter_transcripts(graph, tss_exons, tes_exons):
-    paths = [[exon,] for exon in tss_exons]
+    """Iterate over the paths from a tss exon to the first tes exon after it.
+
+    Partial paths are stored as a node and a pointer to their parent path,
+    so extending a path doesn't copy it.
+    """
+    exons = graph.exons
+    is_tss, is_tes = find_node_types(graph, tss_exons, tes_exons)
+    is_tes = is_tes.tolist()
+    succ_indptr = graph.succ_indptr.tolist()
+    edge_dsts = graph.edge_dsts.tolist()
+    path_nodes = numpy.flatnonzero(is_tss).tolist()
+    path_parents = [-1,]*len(path_nodes)
+    
+    def build_path(path_i):
+        path = []
+        while path_i >= 0:
+            path.append(exons[path_nodes[path_i]])
+            path_i = path_parents[path_i]
+        path.reverse()
+        return path
+    
+    paths = range(len(path_nodes))
     while len(paths) > 0:
-        curr_path = paths.pop()
-        for child in graph.successors(curr_path[-1]):
-            if child in tes_exons:
-                yield curr_path + [child,]
+        path_i = paths.pop()
+        node = path_nodes[path_i]
+        for child in edge_dsts[succ_indptr[node]:succ_indptr[node+1]]:
+            path_nodes.append(child)
+            path_parents.append(path_i)
+            if is_tes[child]:
+                yield build_path(len(path_nodes)-1)
+                # complete paths are never extended, so reuse their slot
+                path_nodes.pop()
+                path_parents.pop()
             else:
-                paths.append(curr_path + [child,])
+                paths.append(len(path_nodes)-1)
     return
 
 def path_len(path):
     return sum(exon[1]-exon[0]+1 for exon in path)
 
 def iter_transcriptlets(graph, tss_exons, tes_exons, max_length):
-    start_exons = set(tss_exons)
+    exons = graph.exons
+    tes_exons = set(graph.exon_indices[tuple(exon)] for exon in tes_exons)
+    start_exons = set(graph.exon_indices[tuple(exon)] for exon in tss_exons)
     while len(start_exons) > 0:
         paths = [[exon,] for exon in start_exons]
         start_exons = set()
         while len(paths) > 0:
             curr_path = paths.pop()
-            for child in graph.successors(curr_path[-1]):
+            for child in graph.successors(curr_path[-1]).tolist():
                 new_path = curr_path + [child,]
                 # if child is a tes exon, then there
                 # is nowhere to go so we are done
                 if child in tes_exons:
-                    yield new_path
+                    yield [exons[i] for i in new_path]
                 # if this is greater than the maximum 
                 # length, then yield the path, and 
                 # add the first exon as a new start exon
-                elif path_len(new_path) > max_length:
-                    yield new_path
+                elif path_len([exons[i] for i in new_path]) > max_length:
+                    yield [exons[i] for i in new_path]
                     # new_path must have at least 2 elements, because
                     # of the start exon and child
                     start_exons.add(new_path[1])
@@ -103,15 +207,23 @@ def iter_transcriptlets(graph, tss_exons, tes_exons, max_length):
 
 def build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand ):
-    # build a directed graph, with edges leading from exon to exon via junctions
-    all_exons = sorted(chain(tss_exons, internal_exons, tes_exons))
-    graph = nx.DiGraph()
-    graph.add_nodes_from( tss_exons )
-    graph.add_nodes_from( internal_exons )
-    graph.add_nodes_from( tes_exons )
-    edges = find_jn_connected_exons(all_exons, jns, strand )
-    graph.add_edges_from( (start, stop) for jn, start, stop in edges )
-    assert nx.is_directed_acyclic_graph(graph)
+    # build a directed graph, with edges leading from exon to exon via 
+    # junctions. The nodes are the exons in sorted order, and graph.exons 
+    # and graph.exon_indices map between the nodes and exons
+    all_exons = sorted(set(
+        tuple(exon) for exon in chain(tss_exons, internal_exons, tes_exons)))
+    exon_indices = dict((exon, i) for i, exon in enumerate(all_exons))
+    edges = sorted(set( 
+        (exon_indices[start], exon_indices[stop]) 
+        for jn, start, stop in find_jn_connected_exons(all_exons, jns, strand)))
+    graph = SpliceGraph(
+        [EXON,]*len(all_exons), 
+        [exon[0] for exon in all_exons], [exon[1] for exon in all_exons],
+        [start for start, stop in edges], [stop for start, stop in edges],
+        [SPLICE,]*len(edges))
+    graph.exons = all_exons
+    graph.exon_indices = exon_indices
+    assert graph.is_dag()
     return graph
 
 def build_transcripts_from_elements( 
@@ -119,10 +231,24 @@ def build_transcripts_from_elements(
     graph = build_splice_graph(
         tss_exons, internal_exons, tes_exons, se_transcripts, jns, strand)
     transcripts = [ [x,] for x in se_transcripts ]
+    max_num_transcripts = (
+        config.MAX_NUM_CANDIDATE_TRANSCRIPTS - len(transcripts))
+    if max_num_transcripts < 0:
+        raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
+    # count the transcripts before we build them, and if there are too 
+    # many then remove the junctions that the fewest transcripts use
+    is_tss, is_tes = find_node_types(graph, tss_exons, tes_exons)
+    n_transcripts, n_edge_transcripts = count_transcript_paths(
+        graph, is_tss, is_tes)
+    if n_transcripts > max_num_transcripts:
+        config.log_statement(
+            "Pruning junctions from a gene with %i candidate transcripts" 
+            % n_transcripts, log=True)
+        graph = prune_splice_graph(
+            graph, is_tss, is_tes, max_num_transcripts)
+    
     for transcript in iter_transcripts(graph, tss_exons, tes_exons):
         transcripts.append( sorted(transcript) )
-        if len(transcripts) > config.MAX_NUM_CANDIDATE_TRANSCRIPTS:
-            raise TooManyCandidateTranscriptsError, "Too many candidate transcripts"
     return transcripts
 
 def build_transcript_fragments_from_elements( 
@@ -305,6 +431,11 @@ def build_gene(elements, fasta=None, ref_genes=None):
     if ref_genes != None:
         gene = rename_transcripts(gene, ref_genes)
     
+    # store the finished transcripts compactly, for pickling and 
+    # building the design matrices
+    gene.transcripts = TranscriptSet.from_transcripts(
+        gene.transcripts, gene.chrm, gene.strand, gene.id)
+    
     return gene
 
 def build_and_write_gene(gene_elements, output,
@@ -41,6 +41,10 @@ ONLY_BUILD_CANDIDATE_TRANSCRIPTS = None
 NTHREADS = None
 TOTAL_MAPPED_READS = None
 
+# the solver to use to find transcript frequency MLEs - see 
+# frequency_estimation.MLE_SOLVERS
+MLE_SOLVER = 'line_search'
+
 ESTIMATE_UPPER_CONFIDENCE_BOUNDS = True
 ESTIMATE_LOWER_CONFIDENCE_BOUNDS = True
 
@@ -79,6 +83,9 @@ TSS_EXON_MERGE_DISTANCE = 0
 MAX_DISTAL_SIZE_FOR_MATCH_OFFSET = 100
 
 tmp_dir = None
+# if set, cache the design matrix expected counts in this directory, so that
+# they can be reused when the same genes are quantified again
+EXPECTED_CNTS_CACHE_DIR = None
 
 def get_gene_tmp_fname(gene_id, sample_type=None, rep_id=None):
     rv = os.path.join(tmp_dir, "%s" % gene_id )
@@ -87,11 +94,11 @@ def get_gene_tmp_fname(gene_id, sample_type=None, rep_id=None):
     return rv + ".gene"
 
 
-def get_fmat_tmp_fname(gene_id, sample_type=None, rep_id=None):
-    rv = os.path.join(tmp_dir, "%s" % gene_id )
+def get_fmat_store_fname(sample_type=None, rep_id=None):
+    rv = os.path.join(tmp_dir, "design_matrices" )
     if sample_type != None: rv += ".%s" % sample_type
     if rep_id != None: rv += ".%s" % rep_id
-    return rv + ".fmat"
+    return rv + ".fmats"
 
 def log_statement(*args, **kwargs):
     print args[0]
@@ -30,7 +30,6 @@ from pysam import Fastafile, Samfile
 
 from itertools import izip, chain
 from collections import defaultdict, namedtuple
-import Queue
 
 import multiprocessing
 from multiprocessing.sharedctypes import RawArray, RawValue
@@ -50,6 +49,9 @@ import cPickle as pickle
 SAMPLE_ID = None
 REP_ID = None
 
+# the number of transcripts that a confidence bound worker claims at once
+NUM_TRANSCRIPTS_TO_CLAIM = 5
+
 class NoDesignMatrixError(Exception):
     pass
 
@@ -76,35 +78,24 @@ class SharedData(object):
         if self._cached_fmat_gene_id == gene_id:
             return self._cached_fmat
 
-        with self.design_mat_lock: 
-            fname = self.design_mat_filenames[gene_id].value
-        if fname == '': 
+        try: 
+            f_mat = self.design_matrices.get(gene_id)
+        except KeyError:
             raise NoDesignMatrixError, "No design matrix for '%s'" % gene_id
-        with open(fname) as fp:
-            f_mat = pickle.load(fp)
         self._cached_fmat_gene_id = gene_id
         self._cached_fmat = f_mat
         return f_mat
     
     def set_design_matrix(self, gene_id, f_mat):
-        ofname = config.get_fmat_tmp_fname(gene_id, SAMPLE_ID, REP_ID)
-        
         # because there's no cache invalidation mechanism, we're only
-        # allowed to set the f_mat object once. This also allows us to
-        # move the load outside of the lock
-        try: assert self.design_mat_filenames[gene_id].value == ''
-        except:
+        # allowed to set the f_mat object once
+        if gene_id in self.design_matrices:
             config.log_statement(
-                "%s has already had its design matrix set (%s)" % (
-                    gene_id, self.design_mat_filenames[gene_id].value ), 
+                "%s has already had its design matrix set" % gene_id, 
                 log=True)
             return
         
-        with open(ofname, "w") as ofp:
-            pickle.dump(f_mat, ofp)
-        
-        with self.design_mat_lock: 
-            self.design_mat_filenames[gene_id].value = ofname
+        self.design_matrices.add(gene_id, f_mat)
         
         if f_mat.num_rnaseq_reads != None:
             with self.num_rnaseq_reads.get_lock():
@@ -163,10 +154,6 @@ class SharedData(object):
         self.lbs = {}
         self.ubs = {}
         
-        # store data that all children need to be able to access        
-        self.design_mat_filenames = {}
-        self.design_mat_lock = multiprocessing.Lock()    
-        
         self.mle_lock = multiprocessing.Lock()    
         self.cbs_lock = multiprocessing.Lock()    
         
@@ -180,10 +167,10 @@ class SharedData(object):
             self.gene_fname_mapping[gene_id] = fname
             self.gene_ntranscripts_mapping[gene_id] = n_transcripts
             self.gene_ids.append(gene_id)
-            
-            self.design_mat_filenames[gene_id] = multiprocessing.Array(
-                'c', 1000)
-            self.design_mat_filenames[gene_id].value = ''
+        
+        # store data that all children need to be able to access        
+        self.design_matrices = f_matrix.DesignMatrixStore(
+            config.get_fmat_store_fname(SAMPLE_ID, REP_ID), self.gene_ids)
         
         self.num_rnaseq_reads = multiprocessing.Value('i', 0)
         self.num_cage_reads = multiprocessing.Value('i', 0)
@@ -255,7 +242,7 @@ def calc_fpkm( gene, fl_dists, freqs, num_reads_in_bam):
 def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
                                     f_mat, mle_estimate, 
                                     trans_indices, cntr,
-                                    cb_alpha):
+                                    bnd_types, cb_alpha):
     # update the mle_estimate array to only store observable transcripts
     # add 1 to skip the out of gene bin
     observable_trans_indices = (
@@ -275,39 +262,48 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
     #    observable_trans_indices, trans_indices]), log=True)
     #assert n_skipped == n_skipped_tmp
     
+    # this is built in the first transcript's try block, so that an error 
+    # only skips the transcripts
+    profile_lhd = None
+    
     res = []
     while True:
+        # claim a batch of adjacent transcripts, so that the bound 
+        # estimates can be warm started from their neighbours
         with cntr.get_lock():
             index = cntr.value
             if index == -1: 
                 config.log_statement('')
                 break
-            cntr.value -= 1
-                
-        trans_index, exp_mat_row, bnd_type = trans_indices[index]
+            n_claimed = min(NUM_TRANSCRIPTS_TO_CLAIM, index+1)
+            cntr.value -= n_claimed
         
-        config.log_statement( 
-            "Estimating %s confidence bound for gene %s (%i/%i remain)" % ( 
-                bnd_type, gene.id, cntr.value+1, len(gene.transcripts)))
-        try:
-            p_value, bnd = frequency_estimation.estimate_confidence_bound( 
-                f_mat, num_reads_in_bams,
-                exp_mat_row, mle_estimate, bnd_type, cb_alpha )
-        except Exception, inst:
-            p_value = 1.
-            bnd = 0.0 if bnd_type == 'lb' else 1.0
-            error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
-                os.getpid(), gene.id, 
-                gene.chrm, gene.strand, gene.start, gene.stop, inst)
-            config.log_statement( error_msg, log=True )
-            config.log_statement( traceback.format_exc(), log=True )
-        
-        if config.DEBUG_VERBOSE: config.log_statement( 
-            "FINISHED %s BOUND %s\t%s\t%i/%i\t%.2e\t%.2e" % (
-            bnd_type, gene.id, None, 
-            trans_index, len(gene.transcripts), 
-            bnd, p_value ) )
-        res.append((bnd_type, trans_index, bnd))
+        for index in xrange(index, index-n_claimed, -1):
+            trans_index, exp_mat_row = trans_indices[index]
+            config.log_statement( 
+                "Estimating confidence bounds for gene %s (%i/%i remain)" % ( 
+                    gene.id, index+1, len(gene.transcripts)))
+            try:
+                if profile_lhd is None:
+                    profile_lhd = frequency_estimation.ProfileLikelihood(
+                        f_mat, num_reads_in_bams, mle_estimate, cb_alpha)
+                bnds = profile_lhd.estimate_bounds(exp_mat_row, bnd_types)
+            except Exception, inst:
+                bnds = [ (1., 0.0 if bnd_type == 'lb' else 1.0) 
+                         for bnd_type in bnd_types ]
+                error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
+                    os.getpid(), gene.id, 
+                    gene.chrm, gene.strand, gene.start, gene.stop, inst)
+                config.log_statement( error_msg, log=True )
+                config.log_statement( traceback.format_exc(), log=True )
+            
+            for bnd_type, (p_value, bnd) in izip(bnd_types, bnds):
+                if config.DEBUG_VERBOSE: config.log_statement( 
+                    "FINISHED %s BOUND %s\t%s\t%i/%i\t%.2e\t%.2e" % (
+                    bnd_type, gene.id, None, 
+                    trans_index, len(gene.transcripts), 
+                    bnd, p_value ) )
+                res.append((bnd_type, trans_index, bnd))
 
     if config.VERBOSE:
         config.log_statement( 
@@ -315,322 +311,306 @@ def find_confidence_bounds_in_gene( gene, num_reads_in_bams,
     
     return res
 
-def find_confidence_bounds_worker( 
-        data, gene_ids, trans_index_cntrs, bnd_type ):
-    def get_new_gene():
-        
-        # get a gene to process
-        try: gene_id = gene_ids.get(timeout=0.1)
-        except Queue.Empty: 
-            assert gene_ids.qsize() == 0
-            config.log_statement("")
-            raise IndexError, "No genes left"
-        
-        config.log_statement(
-            "Loading design matrix for gene '%s'" % gene_id)
+def estimate_gene_confidence_bounds( data, gene_id, cntr, bnd_types ):
+    """Estimate the bounds for the transcripts of gene_id that are left in 
+       cntr.
 
-        gene = data.get_gene(gene_id)
-        try: 
-            f_mat = data.get_design_matrix(gene_id)
-        except NoDesignMatrixError:
-            if config.DEBUG_VERBOSE:
-                config.log_statement("No design matrix for '%s'" % gene_id, 
-                                     log=True)
-            raise
-
-        mle_estimate = data.get_mle(gene_id)
-        
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
+    Every confidence bound task for a gene shares cntr, so that several 
+    workers can split up a large gene.
+    """
+    config.log_statement(
+        "Loading design matrix for gene '%s'" % gene_id)
+    gene = data.get_gene(gene_id)
+    f_mat = data.get_design_matrix(gene_id)
+    mle_estimate = data.get_mle(gene_id)
 
-        cntr = trans_index_cntrs[gene_id]
-        with cntr.get_lock():
-            if cntr.value == -1000: 
-                cntr.value = len(trans_indices)-1
-        
-        return gene, f_mat, mle_estimate, trans_indices, cntr
-    
-    def get_gene_being_processed():
-        longest_gene_id = None
-        gene_len = 0
-        for gene_id, cntr in trans_index_cntrs.iteritems():
-            value = cntr.value
-            if value > gene_len:
-                longest_gene_id = gene_id
-                gene_len = value
-        
-        if longest_gene_id == None: 
-            return None
-        
-        gene = data.get_gene(longest_gene_id)
-        f_mat = data.get_design_matrix(longest_gene_id)
-        mle_estimate = data.get_mle(longest_gene_id)
+    trans_indices = []
+    for row_num, t_index in enumerate(f_mat.transcript_indices()):
+        trans_indices.append((t_index, row_num+1))
 
-        trans_indices = []
-        for row_num, t_index in enumerate(f_mat.transcript_indices()):
-            trans_indices.append((t_index, row_num+1, bnd_type))
-        
-        return ( gene, f_mat, mle_estimate, 
-                 trans_indices, trans_index_cntrs[longest_gene_id] )
-    
-    no_new_genes = False    
-    num_reads_in_bams = data.get_num_reads_in_bams()
-    while True:
-        try:
-            try: 
-                gene, f_mat, mle_estimate, trans_indices, cntr = get_new_gene()
-            except NoDesignMatrixError:
-                continue
-            except IndexError: 
-                res = get_gene_being_processed()
-                if res == None: 
-                    break
-                gene, f_mat, mle_estimate, trans_indices, cntr = res
-            
-            cbs = find_confidence_bounds_in_gene( 
-                gene, num_reads_in_bams,
-                f_mat, mle_estimate, 
-                trans_indices, cntr,
-                cb_alpha=config.CB_SIG_LEVEL)
-            data.set_cbs(gene.id, cbs)
-            
-            if config.VERBOSE:
-                config.log_statement("Finished processing '%s'" % gene.id)
-        except Exception, inst:
-            config.log_statement( traceback.format_exc(), log=True )
-    
-    config.log_statement("")
+    cbs = find_confidence_bounds_in_gene( 
+        gene, data.get_num_reads_in_bams(),
+        f_mat, mle_estimate, 
+        trans_indices, cntr,
+        bnd_types, cb_alpha=config.CB_SIG_LEVEL)
+    data.set_cbs(gene.id, cbs)
+
+    if config.VERBOSE:
+        config.log_statement("Finished processing '%s'" % gene.id)
     return
 
-def estimate_confidence_bounds( data, bnd_type ):
-    config.log_statement(
-        "Populating estimate confidence bounds queue.")
+def estimate_gene_mle( data, gene_id ):
+    """Estimate the transcript frequencies of gene_id, and store them in data.
 
-    ## populate the queue
-    # sort so that the biggest genes are processed first
-    gene_ids = multiprocessing.Queue()
-    trans_index_cntrs = {}
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    for i, gene_id in enumerate(sorted_gene_ids):
-        gene_ids.put(gene_id)
-        trans_index_cntrs[gene_id] = multiprocessing.Value( 'i', -1000)
-    
-    config.log_statement("Waiting on gene bounds children")
-
-    if False and config.NTHREADS == 1:
-        find_confidence_bounds_worker( 
-            data, gene_ids, trans_indices_queues, bnd_type )
-    else:
-        pids = []
-        for i in xrange(config.NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                try: 
-                    find_confidence_bounds_worker(
-                        data, gene_ids, 
-                        trans_index_cntrs, bnd_type)
-                except Exception, inst:
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            pids.append(pid)
-        
-        for pid in pids:
-            config.log_statement("Waiting on pid '%i'" % pid)
-            os.waitpid(pid, 0) 
-    
-    return
+    Returns the number of transcripts that the MLE was estimated for ( 0 if
+    the gene doesn't have a design matrix ).
+    """
+    config.log_statement(
+        "Loading gene %s" % gene_id )
+    gene = data.get_gene(gene_id)
 
+    config.log_statement(
+        "Finding MLE for Gene %s(%s:%s:%i-%i) - %i transcripts" \
+            % (gene.id, gene.chrm, gene.strand, 
+               gene.start, gene.stop, len(gene.transcripts) ) )
 
-def estimate_mle_worker( gene_ids, data ):
-    while True:
-        config.log_statement("Retrieving gene from queue")
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
-            config.log_statement("")
-            return
-        
-        try:
-            config.log_statement(
-                "Loading gene %s" % gene_id )
-            gene = data.get_gene(gene_id)
-              
+    try: 
+        f_mat = data.get_design_matrix(gene_id)
+    except NoDesignMatrixError:
+        if config.DEBUG_VERBOSE:
+            config.log_statement("No design matrix for '%s'" % gene_id, 
+                                 log=True)
+        return 0
+    num_reads_in_bams = data.get_num_reads_in_bams()
+    expected_array, observed_array = f_mat.expected_and_observed(
+        num_reads_in_bams)
+    if expected_array is None and observed_array is None: 
+        return 0
+    mle = frequency_estimation.estimate_transcript_frequencies( 
+        observed_array, expected_array)
+
+    log_lhd = frequency_estimation.calc_lhd( 
+        mle, observed_array, expected_array)
+
+    # add back in the missing trasncripts
+    full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
+    full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
+
+    data.set_mle(gene, full_mle)
+    config.log_statement( "FINISHED MLE %s\t%.2f" % ( gene.id, log_lhd ) )
+    # the first entry is the out of gene bin
+    return len(mle) - 1
+
+def build_gene_design_matrix( data, gene_id, fl_dists,
+                              (rnaseq_reads, promoter_reads, polya_reads),
+                              expected_cnts_cache ):
+    config.log_statement("Loading gene '%s'" % gene_id)
+    gene = data.get_gene(gene_id)
+    config.log_statement( 
+        "Finding design matrix for Gene %s(%s:%s:%i-%i) - %i transcripts"%(
+            gene.id, gene.chrm, gene.strand, 
+            gene.start, gene.stop, len(gene.transcripts) ) )
+
+    try:
+        expected_cnts_cache.load_gene(gene.id)
+        f_mat = f_matrix.DesignMatrix(
+            gene, fl_dists, 
+            rnaseq_reads, promoter_reads, polya_reads,
+            config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY,
+            expected_cnts_cache)
+        expected_cnts_cache.save_gene(gene.id)
+    except f_matrix.NoObservableTranscriptsError:
+        if config.DEBUG_VERBOSE:
             config.log_statement(
-                "Finding MLE for Gene %s(%s:%s:%i-%i) - %i transcripts" \
-                    % (gene.id, gene.chrm, gene.strand, 
-                       gene.start, gene.stop, len(gene.transcripts) ) )
-            
-            try: 
-                f_mat = data.get_design_matrix(gene_id)
-            except NoDesignMatrixError:
-                if config.DEBUG_VERBOSE:
-                    config.log_statement("No design matrix for '%s'" % gene_id, 
-                                         log=True)
-                continue
-            num_reads_in_bams = data.get_num_reads_in_bams()
-            expected_array, observed_array = f_mat.expected_and_observed(
-                num_reads_in_bams)
-            if (expected_array, observed_array) == (None, None): 
-                continue
-            mle = frequency_estimation.estimate_transcript_frequencies( 
-                observed_array, expected_array)
-        except Exception, inst:
-            error_msg = "%i: Skipping %s (%s:%s:%i-%i): %s" % (
-                os.getpid(), gene.id, 
-                gene.chrm, gene.strand, gene.start, gene.stop, inst)
-            config.log_statement( error_msg, log=True )
-            config.log_statement( traceback.format_exc(), log=True )
-            continue
-
-        log_lhd = frequency_estimation.calc_lhd( 
-            mle, observed_array, expected_array)
+                "No observable transcripts for '%s'" % gene_id, log=True)
+        return
 
-        # add back in the missing trasncripts
-        full_mle = -1*numpy.ones(len(gene.transcripts)+1, dtype=float)
-        full_mle[numpy.array([-1,]+f_mat.transcript_indices().tolist())+1] = mle
-        
-        data.set_mle(gene, full_mle)
-        config.log_statement( "FINISHED MLE %s\t%.2f - updating queues" % ( 
-                gene.id, log_lhd ) )
+    config.log_statement( "WRITING DESIGN MATRIX TO DISK %s" % gene.id )
+    data.set_design_matrix(gene.id, f_mat)
+    config.log_statement( "FINISHED DESIGN MATRICES %s" % gene.id )
+    return
 
-def estimate_mles( data ):
-    config.log_statement("Initializing MLE queue")
+class QuantificationTasks(object):
+    """The task queue shared by the quantification workers.
 
-    gene_ids = multiprocessing.Queue()
-    sorted_gene_ids = sorted(data.gene_ids, 
-                             key=lambda x:data.gene_ntranscripts_mapping[x],
-                             reverse=True)
-    # sort so that the biggest genes are processed first
+    Tasks are ( task_type, gene_id ) tuples. The type of the task that each
+    worker is running is stored in shared memory, so that if a worker dies
+    the parent can finish its task for it, rather than leaving the other
+    workers waiting on it forever. The parent, which outlives the workers, 
+    queues the 'FINISHED' sentinels once num_pending_tasks reaches 0.
+    """
+    TASK_TYPES = ('design_matrix', 'mle', 'cbs')
     
-    args = [ gene_ids, data ]
-    if False and config.NTHREADS == 1:
-        estimate_mle_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    estimate_mle_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
+    def __init__(self, gene_ids):
+        self.gene_ids = gene_ids
+        self._queue = multiprocessing.Queue()
+        self.num_pending_tasks = multiprocessing.Value('i', len(gene_ids))
+        self.num_unbuilt_genes = multiprocessing.Value('i', len(gene_ids))
+        self.current_task_types = RawArray('i', [-1]*config.NTHREADS)
+    
+    def add_design_matrix_tasks(self):
+        # these are already counted in num_pending_tasks
+        for gene_id in self.gene_ids:
+            self._queue.put(('design_matrix', gene_id))
+    
+    def get(self, worker_index):
+        task = self._queue.get()
+        if task != 'FINISHED':
+            self.current_task_types[worker_index] = self.TASK_TYPES.index(
+                task[0])
+        return task
+    
+    def finish(self, worker_index, data, new_tasks=()):
+        """Queue new_tasks, and mark worker_index's task as finished. 
+
+        """
+        task_type = self.TASK_TYPES[self.current_task_types[worker_index]]
+        new_tasks = list(new_tasks)
+        # the MLEs use the read counts from every design matrix, so they 
+        # are queued when the last design matrix is finished
+        if task_type == 'design_matrix':
+            with self.num_unbuilt_genes.get_lock():
+                self.num_unbuilt_genes.value -= 1
+                all_built = ( self.num_unbuilt_genes.value == 0 )
+            if all_built:
+                config.log_statement("Read counts: %s" % str(
+                        data.get_num_reads_in_bams()), log=True)
+                new_tasks.extend( 
+                    ('mle', x) for x in data.gene_ids 
+                    if x in data.design_matrices )
         
-        # populate the queue
-        config.log_statement("Populating MLE queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
+        # count the new tasks before we decrement for the finished task, so 
+        # that the count can only reach 0 once everything is done
+        with self.num_pending_tasks.get_lock():
+            self.num_pending_tasks.value += len(new_tasks) - 1
+            self.current_task_types[worker_index] = -1
+        for task in new_tasks:
+            self._queue.put(task)
+        return
+    
+    def finish_workers(self):
         for i in xrange(config.NTHREADS):
-            gene_ids.put("FINISHED")
-        config.log_statement("Waiting on MLE children")
-        
-        for pid in ps:
-            os.waitpid(pid, 0)
+            self._queue.put('FINISHED')
     
-    return
-
-def build_design_matrices_worker( gene_ids, 
-                                  data, fl_dists,
-                                  (rnaseq_reads, promoter_reads, polya_reads)):
+    def flush(self):
+        """Wait until this process's queued tasks are written to the queue.
+
+        os._exit skips the queue's feeder thread, so the workers call this
+        before they exit to make sure that the tasks they queued aren't lost.
+        """
+        self._queue.close()
+        self._queue.join_thread()
+
+def quantification_worker( worker_index, tasks, data, fl_dists,
+                           (rnaseq_reads, promoter_reads, polya_reads),
+                           bnd_types, trans_index_cntrs ):
     assert fl_dists != None
     config.log_statement("Reloading read data in subprocess")
     if rnaseq_reads != None: rnaseq_reads = rnaseq_reads.reload()
     if promoter_reads != None: promoter_reads = promoter_reads.reload()
     if polya_reads != None: polya_reads = polya_reads.reload()
+    reads = (rnaseq_reads, promoter_reads, polya_reads)
     
+    expected_cnts_cache = f_matrix.ExpectedCntsCache(
+        config.EXPECTED_CNTS_CACHE_DIR)
     while True:
-        config.log_statement("Acquiring gene to process")        
-        gene_id = gene_ids.get()
-        if gene_id == 'FINISHED': 
+        config.log_statement("Acquiring task to process")
+        task = tasks.get(worker_index)
+        if task == 'FINISHED': 
             config.log_statement("")
             return
+        
+        task_type, gene_id = task
+        new_tasks = []
         try:
-            config.log_statement("Loading gene '%s'" % gene_id)
-            gene = data.get_gene(gene_id)
-            config.log_statement( 
-                "Finding design matrix for Gene %s(%s:%s:%i-%i) - %i transcripts"%(
-                    gene.id, gene.chrm, gene.strand, 
-                    gene.start, gene.stop, len(gene.transcripts) ) )
-            
-            f_mat = f_matrix.DesignMatrix(
-                gene, fl_dists, 
-                rnaseq_reads, promoter_reads, polya_reads,
-                config.MAX_NUM_TRANSCRIPTS_TO_QUANTIFY)
-            
-            config.log_statement( "WRITING DESIGN MATRIX TO DISK %s" % gene.id )
-            data.set_design_matrix(gene.id, f_mat)
-            config.log_statement( "FINISHED DESIGN MATRICES %s" % gene.id )
-
-        except f_matrix.NoObservableTranscriptsError:
-            if config.DEBUG_VERBOSE:
-                config.log_statement(
-                    "No observable transcripts for '%s'" % gene_id, log=True)
-            continue
+            if task_type == 'design_matrix':
+                build_gene_design_matrix(
+                    data, gene_id, fl_dists, reads, expected_cnts_cache)
+            elif task_type == 'mle':
+                n_transcripts = estimate_gene_mle(data, gene_id)
+                if n_transcripts > 0 and len(bnd_types) > 0:
+                    cntr = trans_index_cntrs[gene_id]
+                    with cntr.get_lock():
+                        cntr.value = n_transcripts-1
+                    # queue enough tasks for the workers to split the gene
+                    n_cb_tasks = min( config.NTHREADS, 
+                        (n_transcripts + NUM_TRANSCRIPTS_TO_CLAIM - 1)
+                        //NUM_TRANSCRIPTS_TO_CLAIM )
+                    new_tasks.extend([('cbs', gene_id),]*n_cb_tasks)
+            elif task_type == 'cbs':
+                estimate_gene_confidence_bounds(
+                    data, gene_id, trans_index_cntrs[gene_id], bnd_types)
+            else:
+                assert False, "Unrecognized task type '%s'" % task_type
         except Exception, inst:
-            error_msg = "%i: Skipping %s: %s" % (
-                os.getpid(), gene_id, inst )
+            error_msg = "%i: Skipping %s for %s: %s" % (
+                os.getpid(), task_type, gene_id, inst )
             config.log_statement( 
                 error_msg + "\n" + traceback.format_exc(), log=True )
+        
+        tasks.finish(worker_index, data, new_tasks)
+
+def wait_on_quantification_workers( pids, tasks, data ):
+    """Wait for the workers in pids to exit.
+
+    If a worker dies ( e.g. it's killed for using too much memory ) then 
+    we finish the task that it was running as a failure, so that the other 
+    workers don't wait on it. If every worker dies, then we give up on the
+    remaining tasks. When every task is finished, we tell the workers to 
+    exit.
+    """
+    running = dict( (pid, i) for i, pid in enumerate(pids) )
+    workers_finished = False
+    while len(running) > 0:
+        for pid, worker_index in running.items():
+            ret_pid, status = os.waitpid(pid, os.WNOHANG)
+            if ret_pid == 0: continue
+            del running[pid]
+            if status == 0: continue
+            
+            config.log_statement( 
+                "Quantification worker %i exited unexpectedly (status %i)" % (
+                    pid, status), log=True )
+            if tasks.current_task_types[worker_index] >= 0:
+                tasks.finish(worker_index, data)
+        
+        if not workers_finished and tasks.num_pending_tasks.value == 0:
+            tasks.finish_workers()
+            workers_finished = True
+        time.sleep(0.1)
+    
+    if tasks.num_pending_tasks.value > 0:
+        config.log_statement( 
+            "Quantification workers exited with %i tasks remaining" 
+            % tasks.num_pending_tasks.value, log=True )
+    return
 
-def build_design_matrices( data, fl_dists,
-                           (rnaseq_reads, promoter_reads, polya_reads)):    
+def quantify_genes( data, fl_dists, 
+                    (rnaseq_reads, promoter_reads, polya_reads), bnd_types ):
+    """Build the design matrices, and estimate the MLEs and the bnd_types 
+       ( 'lb' and/or 'ub' ) confidence bounds, in one pool of processes.
+
+    Every gene starts as a design matrix task. When the last design matrix 
+    is finished the MLE tasks are queued, and each MLE task queues the 
+    confidence bound tasks for its gene, so that large genes' bounds are 
+    estimated alongside the other genes' MLEs.
+    """
     assert fl_dists != None
-    gene_ids = multiprocessing.Queue()
-    config.log_statement( "Populating build design matrices queue" )
+    # sort so that the biggest genes are processed first
     sorted_gene_ids = sorted(data.gene_ids, 
                              key=lambda x:data.gene_ntranscripts_mapping[x],
                              reverse=True)
-    # sort so that the biggest genes are processed first
-    config.log_statement("FINISHED Populating build design matrices queue")
-    
-    args = [ gene_ids, data, fl_dists, 
-             (rnaseq_reads, promoter_reads, polya_reads)]
-    if False and config.NTHREADS == 1:
-        build_design_matrices_worker(*args)
-    else:
-        ps = []
-        for i in xrange(config.NTHREADS):
-            #p = multiprocessing.Process(
-            #    target=build_design_matrices_worker, args=args)
-            #p.start()
-            #ps.append(p)
-            pid = os.fork()
-            if pid == 0:
-                try:
-                    build_design_matrices_worker(*args)
-                except Exception, inst:
-                    config.log_statement( str(error_msg), log=True )
-                    config.log_statement( traceback.format_exc(), log=True )
-                finally:
-                    os._exit(0)
-            ps.append(pid)
-        
-        # populate the queue
-        config.log_statement("Populating design matrix queue")
-        for i, gene_id in enumerate(sorted_gene_ids):
-            gene_ids.put(gene_id)
-        for i in xrange(config.NTHREADS):
-            gene_ids.put('FINISHED')
-        config.log_statement("Waiting on design matrix children")
-        
-        #while any( p != None and p.is_alive() for p in ps ):
-        #while len(ps) > 0:
-        #    config.log_statement(
-        #   "Waiting for design matrix children processes to finish (%i/%i genes remain)"%(
-        #            gene_ids.qsize(), len(data.gene_ids)))
-        #    time.sleep(1.)
-        for pid in ps:
-            config.log_statement("Waiting on pid '%i'" % pid)
-            os.waitpid(pid, 0)
-
-    config.log_statement("Read counts: %s" % str(data.get_num_reads_in_bams()), 
-                         log=True)
+    if len(sorted_gene_ids) == 0:
+        return
+    
+    tasks = QuantificationTasks(sorted_gene_ids)
+    trans_index_cntrs = dict( 
+        (gene_id, multiprocessing.Value('i', -1)) 
+        for gene_id in sorted_gene_ids )
+    
+    pids = []
+    for i in xrange(config.NTHREADS):
+        pid = os.fork()
+        if pid == 0:
+            exit_status = 0
+            try:
+                quantification_worker(
+                    i, tasks, data, fl_dists, 
+                    (rnaseq_reads, promoter_reads, polya_reads), 
+                    bnd_types, trans_index_cntrs )
+            except Exception, inst:
+                config.log_statement( traceback.format_exc(), log=True )
+                exit_status = 1
+            finally:
+                try: tasks.flush()
+                finally: os._exit(exit_status)
+        pids.append(pid)
+    
+    config.log_statement("Populating quantification queue")
+    tasks.add_design_matrix_tasks()
+    
+    config.log_statement("Waiting on quantification children")
+    wait_on_quantification_workers(pids, tasks, data)
     
     return
 
@@ -708,34 +688,21 @@ def quantify_transcript_expression(
     if config.VERBOSE: config.log_statement( 
         "Initializing processing data" )        
     data = SharedData(pickled_gene_fnames)
-    if config.VERBOSE: config.log_statement( 
-        "Building design matrices" )
-    build_design_matrices( data, rnaseq_reads.fl_dists,
-                           (rnaseq_reads, promoter_reads, polya_reads))
-    
-    if config.VERBOSE: config.log_statement( 
-        "Populating input queue from expression queue" )
     data.populate_expression_queue()
+    
+    # estimate both bounds for a transcript together, so that they share
+    # the design matrix and MLE set up
+    bnd_types = []
+    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS: bnd_types.append('lb')
+    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS: bnd_types.append('ub')
+    
     if config.VERBOSE: config.log_statement( 
-        "Estimating MLEs" )
-    estimate_mles( data )
-
+        "Quantifying genes" )
+    quantify_genes( data, rnaseq_reads.fl_dists,
+                    (rnaseq_reads, promoter_reads, polya_reads), bnd_types )
+    data.design_matrices.write_index()
     if config.VERBOSE: config.log_statement( 
-        "Calculating FPKMS and Writing mle's to output mle" )
-    
-    if config.ESTIMATE_LOWER_CONFIDENCE_BOUNDS:
-        if config.VERBOSE: config.log_statement( 
-            "Estimating lower confidence bounds" )
-        estimate_confidence_bounds(data, 'lb')
-        if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating lower confidence bounds" )
-    
-    if config.ESTIMATE_UPPER_CONFIDENCE_BOUNDS:
-        if config.VERBOSE: config.log_statement( 
-            "Estimating upper confidence bounds" )
-        estimate_confidence_bounds(data, 'ub')
-        if config.VERBOSE: config.log_statement( 
-            "FINISHED Estimating upper confidence bounds" )
+        "FINISHED Quantifying genes" )
     
     if config.VERBOSE: config.log_statement( 
         "Writing output data to tracking file" )
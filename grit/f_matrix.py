@@ -17,10 +17,18 @@ You should have received a copy of the GNU General Public License
 along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import os, sys
 sys.setrecursionlimit(10000)
 
+import cPickle as pickle
+from cStringIO import StringIO
+import mmap
+import struct
+import ctypes
+import multiprocessing
+
 import numpy
+import scipy.sparse
 from scipy.spatial import KDTree
 
 MIN_NUM_MAPPABLE_BASES = 1
@@ -40,7 +48,8 @@ from itertools import product, izip, chain
 from collections import defaultdict
 
 from grit.files.reads import ( iter_coverage_intervals_for_read, get_read_group,
-                               CAGEReads, RAMPAGEReads, PolyAReads )
+                               CAGEReads, RAMPAGEReads, PolyAReads, 
+                               ReadSummary )
 
 class NoObservableTranscriptsError(Exception):
     pass
@@ -76,6 +85,15 @@ def find_nonoverlapping_contig_indices( contigs, contig_boundaries ):
 def build_nonoverlapping_indices( transcripts, exon_boundaries ):
     # build the transcript composed of pseudo ( non overlapping ) exons. 
     # This means splitting the overlapping parts into new 'exons'
+    # ( grit.transcript imports grit.files.gtf, which imports it back, so 
+    # we can't import it when this module is loaded )
+    from grit.transcript import TranscriptSet
+    if isinstance( transcripts, TranscriptSet ):
+        for indices in transcripts.iter_nonoverlapping_indices(
+                exon_boundaries):
+            yield indices
+        return
+    
     for transcript in transcripts:
         yield find_nonoverlapping_contig_indices( 
             transcript.exons, exon_boundaries )
@@ -339,28 +357,117 @@ def iter_possible_fragment_bins_for_splice_graph(
     
     return
 
+def sum_fl_density_over_starts_slow( 
+        fl_dist, min_start, max_start, min_stop, max_stop ):
+    """Reference implementation of sum_fl_density_over_starts.
+
+    """
+    density = 0.0
+    for start_pos in xrange( min_start, max_start+1 ):
+        min_fl = max( min_stop - start_pos, fl_dist.fl_min )
+        max_fl = min( max_stop - start_pos, fl_dist.fl_max )
+        if min_fl > max_fl: continue
+        density += fl_dist.fl_density_cumsum[ max_fl - fl_dist.fl_min ]
+        if min_fl > fl_dist.fl_min:
+            density -= fl_dist.fl_density_cumsum[min_fl - fl_dist.fl_min-1]
+    return density
+
+def _sum_linearly_weighted_fl_density( fl_dist, min_fl, max_fl, a, b ):
+    """Return sum( density[fl]*(a + b*fl) ) for fl in [min_fl, max_fl].
+
+    """
+    min_fl = max( min_fl, fl_dist.fl_min )
+    max_fl = min( max_fl, fl_dist.fl_max )
+    if min_fl > max_fl: return 0.0
+    cumsum = fl_dist.fl_density_cumsum
+    weighted_cumsum = fl_dist.fl_density_weighted_cumsum
+    hi, lo = max_fl - fl_dist.fl_min, min_fl - fl_dist.fl_min - 1
+    density = cumsum[hi] - ( cumsum[lo] if lo >= 0 else 0.0 )
+    if b == 0: 
+        return a*density
+    weighted_density = ( weighted_cumsum[hi] 
+                         - ( weighted_cumsum[lo] if lo >= 0 else 0.0 ) )
+    return a*density + b*weighted_density
+
+def sum_fl_density_over_starts( 
+        fl_dist, min_start, max_start, min_stop, max_stop ):
+    """Sum the probability that a fragment starting in [min_start, max_start]
+       stops in [min_stop, max_stop] over the start positions.
+
+    Rather than summing over the start positions, we sum over the fragment 
+    lengths: a fragment of length fl can start at any position in
+    [max(min_start, min_stop-fl), min(max_start, max_stop-fl)], so the 
+    number of starts is piecewise linear in fl, with breaks at 
+    min_stop-min_start and max_stop-max_start. Each piece is a sum over the
+    density cumsum and the fragment length weighted density cumsum, so this 
+    takes constant time.
+    """
+    if max_start < min_start or max_stop < min_stop: 
+        return 0.0
+    
+    # the lower bound on the start is min_stop-fl for fl <= lower_brk, 
+    # and min_start after. The upper bound is max_start for fl <= upper_brk 
+    # and max_stop-fl after
+    lower_brk = min_stop - min_start
+    upper_brk = max_stop - max_start
+    
+    # the starts are in [min_stop-fl, max_start]
+    density = _sum_linearly_weighted_fl_density( 
+        fl_dist, min_stop - max_start, min(lower_brk, upper_brk), 
+        max_start - min_stop + 1, 1 )
+    # neither bound depends on fl, so the number of starts is fixed
+    if lower_brk < upper_brk:
+        density += _sum_linearly_weighted_fl_density( 
+            fl_dist, lower_brk+1, upper_brk, max_start - min_start + 1, 0 )
+    elif upper_brk < lower_brk:
+        density += _sum_linearly_weighted_fl_density( 
+            fl_dist, upper_brk+1, lower_brk, max_stop - min_stop + 1, 0 )
+    # the starts are in [min_start, max_stop-fl]
+    density += _sum_linearly_weighted_fl_density( 
+        fl_dist, max(lower_brk, upper_brk)+1, max_stop - min_start, 
+        max_stop - min_start + 1, -1 )
+    
+    return density
+
+def find_paired_bin_segment_lens( bin, transcript, exon_lens ):
+    """Return the lengths that determine the expected count of a paired bin.
+
+    These are the segment lengths in the first and second read bins, and
+    the total length of the transcript's segments from the start of the 
+    first bin to the start of the second.
+    """
+    # calculate the exon lens for the first and second reads
+    fr_exon_lens = tuple( int(exon_lens[i]) for i in bin[0] )
+    sr_exon_lens = tuple( int(exon_lens[i]) for i in bin[1] )
+    # find the length of the internal exons ( those not in either bin )
+    pre_sr_exon_lens = int( sum( exon_lens[i] for i in transcript \
+                                 if i < bin[1][0] and i >= bin[0][0] ) )
+    return fr_exon_lens, sr_exon_lens, pre_sr_exon_lens
+
 def estimate_num_paired_reads_from_bin( 
         bin, transcript, exon_lens,
         fl_dist, read_len, min_num_mappable_bases=1 ):
     """
 
     """
-    assert min_num_mappable_bases > 0, \
-        "It doesn't make sense to map a read into a segment with 0 bases"
     #global DEBUG
     #if transcript == (20, 21):
     #    print transcript, bin, fl_dist
     #    DEBUG = True
-    
-    # calculate the exon lens for the first and second reads
-    fr_exon_lens = [ exon_lens[i] for i in bin[0]  ]
-    sr_exon_lens = [ exon_lens[i] for i in bin[1]  ]
-    # find the length of the internal exons ( those not in either bin )
-    pre_sr_exon_lens = sum( exon_lens[i] for i in transcript \
-                            if i < bin[1][0] and i >= bin[0][0] )
-
     if DEBUG:
         print "Bin", bin
+    fr_exon_lens, sr_exon_lens, pre_sr_exon_lens = \
+        find_paired_bin_segment_lens( bin, transcript, exon_lens )
+    return estimate_num_paired_reads_from_segment_lens(
+        fr_exon_lens, sr_exon_lens, pre_sr_exon_lens,
+        fl_dist, read_len, min_num_mappable_bases )
+
+def estimate_num_paired_reads_from_segment_lens( 
+        fr_exon_lens, sr_exon_lens, pre_sr_exon_lens,
+        fl_dist, read_len, min_num_mappable_bases=1 ):
+    assert min_num_mappable_bases > 0, \
+        "It doesn't make sense to map a read into a segment with 0 bases"
+    if DEBUG:
         print "FR Exon Lens", fr_exon_lens
         print "SR Exon Lens", sr_exon_lens
         print "Pre FR Exon Lens", pre_sr_exon_lens
@@ -412,44 +519,115 @@ def estimate_num_paired_reads_from_bin(
 
     if DEBUG:
         print "Stop Bnds", min_stop, max_stop
-    def do():
-        density = 0.0
-        for start_pos in xrange( min_start, max_start+1 ):
-            min_fl = max( min_stop - start_pos, fl_dist.fl_min )
-            max_fl = min( max_stop - start_pos, fl_dist.fl_max )
-            if min_fl > max_fl: continue
-            density += fl_dist.fl_density_cumsum[ max_fl - fl_dist.fl_min ]
-            if min_fl > fl_dist.fl_min:
-                density -= fl_dist.fl_density_cumsum[min_fl - fl_dist.fl_min-1]
-        return density
     
-    density = do()
+    density = sum_fl_density_over_starts( 
+        fl_dist, min_start, max_start, min_stop, max_stop )
     if DEBUG:
+        assert abs( density - sum_fl_density_over_starts_slow( 
+                fl_dist, min_start, max_start, min_stop, max_stop ) ) < 1e-9
         print "Density", density
         print
     
     #DEBUG = False
     return float( density )
 
+class ExpectedCntsCache(object):
+    """Memoize the expected counts of paired read bins.
+
+    The expected count only depends on the lengths of the segments that the 
+    reads and fragment cover ( see find_paired_bin_segment_lens ), the 
+    fragment length distribution and the read length, so entries are keyed
+    by these. This means that they are shared between transcripts with 
+    common sub-paths, and between read groups with the same fragment 
+    length distribution.
+
+    If cache_dir is set, then the entries used in a gene are written to 
+    cache_dir by save_gene and read back by load_gene, so that quantifying 
+    the same genes again ( e.g. in another replicate ) reuses them. The keys 
+    only depend on the data, so it's safe to reuse cache_dir between runs.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            try: os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir): raise
+        self._entries = {}
+        self._num_loaded_entries = 0
+        return
+    
+    def _fname(self, gene_id):
+        return os.path.join(
+            self.cache_dir, "%s.expected_cnts" % gene_id.replace(os.sep, "_"))
+    
+    def load_gene(self, gene_id):
+        """Clear the cache, and load the entries saved for gene_id.
+        
+        """
+        self._entries = {}
+        if self.cache_dir is not None:
+            try:
+                with open(self._fname(gene_id), "rb") as fp:
+                    self._entries = pickle.load(fp)
+            except IOError:
+                pass
+        self._num_loaded_entries = len(self._entries)
+        return
+    
+    def save_gene(self, gene_id):
+        # there's nothing to do if we didn't add any entries
+        if ( self.cache_dir is None 
+             or len(self._entries) == self._num_loaded_entries ):
+            return
+        fname = self._fname(gene_id)
+        tmp_fname = "%s.%i.tmp" % (fname, os.getpid())
+        with open(tmp_fname, "wb") as ofp:
+            pickle.dump(self._entries, ofp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, fname)
+        self._num_loaded_entries = len(self._entries)
+        return
+    
+    def estimate_num_paired_reads_from_bin( 
+            self, bin, transcript, exon_lens, 
+            fl_dist, read_len, min_num_mappable_bases=1 ):
+        segment_lens = find_paired_bin_segment_lens(bin, transcript, exon_lens)
+        # use the fl dist's hash rather than the object, so that the keys 
+        # are cheap to pickle 
+        key = ( fl_dist.fl_min, fl_dist.fl_max, hash(fl_dist), 
+                read_len, min_num_mappable_bases, segment_lens )
+        try: 
+            return self._entries[key]
+        except KeyError:
+            pass
+        rv = estimate_num_paired_reads_from_segment_lens(
+            segment_lens[0], segment_lens[1], segment_lens[2],
+            fl_dist, read_len, min_num_mappable_bases )
+        self._entries[key] = rv
+        return rv
+
 def calc_expected_cnts( exon_boundaries, transcripts, fl_dist, 
                         r1_len, r2_len,
                         max_num_unmappable_bases=MIN_NUM_MAPPABLE_BASES,
-                        max_memory_usage=3.5 ):
+                        max_memory_usage=3.5, cache=None ):
     assert r1_len == r2_len, "Paired reads must have the same lengths"
     read_len = r1_len
     
-    # store all counts, and count vectors. Indexed by ( 
-    # read_group, read_len, bin )
-    cached_f_mat_entries = {}
+    # the expected counts of the paired bins. This can be shared between 
+    # calls, see ExpectedCntsCache
+    if cache is None: cache = ExpectedCntsCache()
     f_mat_entries = {}
     
     nonoverlapping_exon_lens = \
         numpy.array([ stop - start for start, stop in 
                       izip(exon_boundaries[:-1], exon_boundaries[1:])])
     
+    # the design matrices are sparse, so bound the memory usage by the number
+    # of non-zero entries ( a value, and a row and column index for each )
+    num_entries = 0
+    
     # for each candidate trasncript
     for transcript_index, nonoverlapping_indices in enumerate(transcripts):
-        if (len(exon_boundaries)*len(transcripts)*8.)/(1024**3) > max_memory_usage:
+        if (num_entries*24.)/(1024**3) > max_memory_usage:
             raise MemoryError, \
                 "Building the design matrix has exceeded the maximum allowed memory "
         nonoverlapping_indices = tuple(nonoverlapping_indices)
@@ -464,22 +642,13 @@ def calc_expected_cnts( exon_boundaries, transcripts, fl_dist,
         # add the expected counts for paired reads
         for full_bin, paired_bins in pair.iteritems():
             for bin in paired_bins:
-                # we can only re-use cached full_bin/bin combos
-                # because it's possible for the middle of a fragment
-                # to skip a region in one transcript, and be spliced
-                # out in another transcript
-                key = (full_bin, bin)
-                if key in cached_f_mat_entries:
-                    pseudo_cnt = cached_f_mat_entries[ key ]
-                else:
-                    pseudo_cnt = estimate_num_paired_reads_from_bin(
-                        bin, full_bin, 
-                        nonoverlapping_exon_lens, fl_dist,
-                        read_len, max_num_unmappable_bases )
-
-                    cached_f_mat_entries[ key ] = pseudo_cnt
+                pseudo_cnt = cache.estimate_num_paired_reads_from_bin(
+                    bin, full_bin, 
+                    nonoverlapping_exon_lens, fl_dist,
+                    read_len, max_num_unmappable_bases )
                 if pseudo_cnt > 0:
                     f_mat_entries[nonoverlapping_indices][bin] = pseudo_cnt
+        num_entries += len(f_mat_entries[nonoverlapping_indices])
     
     return f_mat_entries
 
@@ -519,42 +688,60 @@ def build_observed_cnts( binned_reads, fl_dists ):
     
     return rv
 
+def iter_transcript_cnts( transcript_cnts ):
+    # the RNAseq counts are stored in dicts keyed by transcript, and the 
+    # boundary counts in lists indexed by transcript
+    if isinstance( transcript_cnts, dict ):
+        return transcript_cnts.iteritems()
+    return enumerate( transcript_cnts )
+
 def build_expected_and_observed_arrays( 
         expected_cnts, observed_cnts, normalize=True ):
-    expected_mat = []
+    """Build a sparse ( CSR ) bins x transcripts expected array, and the 
+       observed bin counts.
+
+    """
     observed_mat = []
     unobservable_transcripts = set()
     
     # find and sort all transcripts
     transcripts = set()
-    for bin, transcript_cnts in sorted(expected_cnts.iteritems()):
-        for transcript in transcript_cnts:
+    for bin, transcript_cnts in expected_cnts.iteritems():
+        for transcript, cnt in iter_transcript_cnts(transcript_cnts):
             transcripts.add(transcript)
     transcripts = sorted(transcripts)
-
-    # turn the cnts into a more structured format
-    for bin, transcript_cnts in sorted(expected_cnts.iteritems()):
-        expected_cnts = [transcript_cnts[t] for t in transcripts]
-        expected_mat.append( expected_cnts )
-        try:
-            observed_mat.append( observed_cnts[bin] )
-        except KeyError:
-            observed_mat.append( 0 )
+    transcript_indices = dict( 
+        (transcript, i) for i, transcript in enumerate(transcripts) )
     
-    if len( expected_mat ) == 0:
+    # turn the cnts into a more structured format, only storing the 
+    # transcripts that can produce reads in each bin
+    rows, cols, vals = [], [], []
+    for bin, transcript_cnts in sorted(expected_cnts.iteritems()):
+        for transcript, cnt in iter_transcript_cnts(transcript_cnts):
+            if cnt == 0: continue
+            rows.append( len(observed_mat) )
+            cols.append( transcript_indices[transcript] )
+            vals.append( cnt )
+        observed_mat.append( observed_cnts.get(bin, 0) )
+    
+    if len( observed_mat ) == 0:
         raise ValueError, "No expected reads."
     
-    expected_mat = numpy.array( expected_mat, dtype=numpy.double )
+    expected_mat = scipy.sparse.csr_matrix( 
+        (numpy.array(vals, dtype=numpy.double), (rows, cols)), 
+        shape=(len(observed_mat), len(transcripts)) )
     if normalize:
-        nonzero_entries = expected_mat.sum(0).nonzero()[0]
+        col_sums = numpy.asarray(expected_mat.sum(0)).ravel()
         unobservable_transcripts = set(range(expected_mat.shape[1])) \
-            - set(nonzero_entries.tolist())
-        expected_mat = expected_mat/(expected_mat.sum(0)+1e-12)
+            - set(col_sums.nonzero()[0].tolist())
+        expected_mat = ( expected_mat*scipy.sparse.diags(
+                1./(col_sums+1e-12), 0) ).tocsr()
     
     observed_mat = numpy.array( observed_mat, dtype=numpy.int )
     return expected_mat, observed_mat, unobservable_transcripts
 
-def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
+def build_expected_and_observed_rnaseq_counts(
+        gene, reads, fl_dists, expected_cnts_cache=None):
     # find the set of non-overlapping exons, and convert the transcripts to 
     # lists of these non-overlapping indices. All of the f_matrix code uses
     # this representation.     
@@ -572,11 +759,20 @@ def build_expected_and_observed_rnaseq_counts(gene, reads, fl_dists):
     print exon_boundaries
     print observed_cnts.values()
     """
+    if expected_cnts_cache is None: 
+        expected_cnts_cache = ExpectedCntsCache()
+    # read groups often share a fragment length distribution, in which case 
+    # their expected counts are the same 
+    fl_dist_expected_cnts = {}
     expected_cnts = defaultdict(lambda: defaultdict(float))
     for (rg, (r1_len,r2_len)), (fl_dist, marginal_frac) in fl_dists.iteritems():
-        for transcript, read_bins_and_vals in calc_expected_cnts( 
+        key = (fl_dist, r1_len, r2_len)
+        if key not in fl_dist_expected_cnts:
+            fl_dist_expected_cnts[key] = calc_expected_cnts( 
                 exon_boundaries, transcripts_non_overlapping_exon_indices, 
-                fl_dist, r1_len, r2_len).iteritems():
+                fl_dist, r1_len, r2_len, cache=expected_cnts_cache)
+        for transcript, read_bins_and_vals in \
+                fl_dist_expected_cnts[key].iteritems():
             for read_bin, expected_bin_cnt in read_bins_and_vals.iteritems():
                 assert r1_len == r2_len
                 expected_cnts[(r1_len, rg, read_bin)][transcript] += (
@@ -640,103 +836,131 @@ def build_expected_and_observed_transcript_bndry_counts(
     
     return expected_cnts, observed_cnts
 
+# rows are clustered after normalizing them to sum to CLUSTER_ROWS_SCALE, 
+# and rounding
+CLUSTER_ROWS_SCALE = 100000
+
+# odd 64 bit constants to mix the quantized entries into row hashes
+_ROW_HASH_MULTS = ( numpy.uint64(0x9E3779B97F4A7C15), 
+                    numpy.uint64(0xC2B2AE3D27D4EB4F) )
+
+def find_row_clusters(expected_array):
+    """Find the rows of expected_array that are equal after normalization.
+
+    Rows are normalized to sum to CLUSTER_ROWS_SCALE and rounded, and then
+    grouped by a hash of their non-zero ( column, value ) entries. Rows 
+    with the same hash are compared entry by entry, so the clusters are 
+    exact. Returns an array of each row's cluster index, numbered in order
+    of each cluster's first row.
+    """
+    expected_array = scipy.sparse.csr_matrix(expected_array)
+    expected_array.sort_indices()
+    n_rows = expected_array.shape[0]
+    if n_rows == 0:
+        return numpy.zeros(0, dtype=int)
+    
+    # quantize the entries, and drop the entries that round to zero
+    row_lens = numpy.diff(expected_array.indptr)
+    entry_rows = numpy.repeat(numpy.arange(n_rows), row_lens)
+    row_sums = numpy.asarray(expected_array.sum(1)).ravel()
+    values = numpy.round( CLUSTER_ROWS_SCALE*expected_array.data
+                          /row_sums[entry_rows] ).astype(numpy.int64)
+    nonzero = (values != 0)
+    entry_rows = entry_rows[nonzero]
+    cols = expected_array.indices[nonzero].astype(numpy.int64)
+    values = values[nonzero]
+    row_lens = numpy.bincount(entry_rows, minlength=n_rows)
+    row_starts = numpy.zeros(n_rows, dtype=numpy.int64)
+    row_starts[1:] = row_lens.cumsum()[:-1]
+    
+    # hash each row by summing ( so that overflow just wraps ) hashes of 
+    # its entries
+    entry_hashes = ( (cols.astype(numpy.uint64)+numpy.uint64(1))
+                     *_ROW_HASH_MULTS[0] ) ^ ( 
+        values.astype(numpy.uint64)*_ROW_HASH_MULTS[1] )
+    entry_hashes *= _ROW_HASH_MULTS[0]
+    row_hashes = numpy.zeros(n_rows, dtype=numpy.uint64)
+    is_nonempty = (row_lens > 0)
+    if len(entry_hashes) > 0:
+        row_hashes[is_nonempty] = numpy.add.reduceat(
+            entry_hashes, row_starts[is_nonempty])
+    
+    # group rows with the same length and hash
+    order = numpy.lexsort((numpy.arange(n_rows), row_hashes, row_lens))
+    is_new_grp = numpy.ones(n_rows, dtype=bool)
+    is_new_grp[1:] = ( (row_hashes[order][1:] != row_hashes[order][:-1])
+                       | (row_lens[order][1:] != row_lens[order][:-1]) )
+    grp_firsts = order[is_new_grp]
+    row_grps = numpy.empty(n_rows, dtype=numpy.int64)
+    row_grps[order] = is_new_grp.cumsum() - 1
+    
+    # make sure that every row matches the first row of its group, and 
+    # split the groups with a hash collision by their exact entries
+    rep_entries = ( row_starts[grp_firsts[row_grps[entry_rows]]] 
+                    + numpy.arange(len(entry_rows)) - row_starts[entry_rows] )
+    collided_grps = numpy.unique( row_grps[entry_rows[
+        (cols != cols[rep_entries]) | (values != values[rep_entries]) ]] )
+    if len(collided_grps) > 0:
+        exact_grps = {}
+        next_grp = len(grp_firsts)
+        for i in numpy.flatnonzero(numpy.in1d(row_grps, collided_grps)):
+            entries = slice(row_starts[i], row_starts[i]+row_lens[i])
+            key = ( tuple(cols[entries].tolist()), 
+                    tuple(values[entries].tolist()) )
+            if key not in exact_grps:
+                exact_grps[key] = next_grp
+                next_grp += 1
+            row_grps[i] = exact_grps[key]
+    
+    # number the clusters in order of their first row
+    grps, first_rows, row_grps = numpy.unique(
+        row_grps, return_index=True, return_inverse=True)
+    grp_ranks = numpy.empty(len(grps), dtype=numpy.int64)
+    grp_ranks[first_rows.argsort()] = numpy.arange(len(grps))
+    return grp_ranks[row_grps]
+
 def cluster_bins(expected_rnaseq_cnts):
     if config.DEBUG_VERBOSE:
         config.log_statement( "Normalizing bin frequencies" )
     
+    bins = sorted(expected_rnaseq_cnts.iterkeys())
+    expected_array, observed_array, unobservable = \
+        build_expected_and_observed_arrays( 
+            expected_rnaseq_cnts, {}, normalize=False )
     clustered_bins = defaultdict(list)
-    for bin, transcripts_and_cnts in expected_rnaseq_cnts.items():
-        row = numpy.array([x[1] 
-                           for x in sorted(transcripts_and_cnts.iteritems())])
-        key = tuple((100000*row/row.sum()).round().tolist())
-        clustered_bins[key].append(bin)
-    return clustered_bins.values()
-
+    for bin, cluster in izip(bins, find_row_clusters(expected_array)):
+        clustered_bins[cluster].append(bin)
+    return [ clustered_bins[i] for i in xrange(len(clustered_bins)) ]
 
 def cluster_rows(expected_rnaseq_array, observed_rnaseq_array):
-    if config.DEBUG_VERBOSE:
-        config.log_statement( "Normalizing bin frequencies" )
-    
-    clustered_rows = defaultdict(list)
-    for i, row in enumerate(expected_rnaseq_array):
-        key = tuple((100000*row/row.sum()).round().tolist())
-        clustered_rows[key].append(i)
-    clusters = clustered_rows.values()
-    
-    """ This worked quickly, but could use way too much memory
-    norm_rows = []
-    for i, row in enumerate(expected_rnaseq_array):
-        norm_rows.append(row/row.sum())
-        
-    if config.DEBUG_VERBOSE:
-        config.log_statement( "Building KDTree to cluster bins" )
-    tree = KDTree(numpy.vstack(norm_rows), leafsize=30)
-    
-    edges = set()
-    points = set(xrange(len(norm_rows)))
-    while len(points) > 0:
-        i = points.pop()
-        neighbors = tree.query_ball_point(norm_rows[i], 1e-6, 1)
-        for j in neighbors:
-            edges.add((i, j))
-            points.discard(j)
-        if config.DEBUG_VERBOSE and len(points)%10 == 0:
-            config.log_statement("%i rows remain to be clustered" % len(points))
-
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(edges)
-    clusters = nx.connected_components(graph)
-    print len(clusters)
-    print sorted(clusters)
-    """
-    
-    """
-    Use the tree to find pairs. We dont use this because we only care about distance.
-    #for i, row in enumerate(norm_rows):
-    #    config.log_statement("%i/%i-%s" % (i, len(norm_rows), tree.query_ball_point(row, 1e-6, 1)))
-    pairs = tree.query_pairs(1e-6, 1)
+    """Merge the rows that are equal after normalization. 
 
-    if config.DEBUG_VERBOSE:
-        config.log_statement( "Finding clusters")    
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(pairs)
-    clusters = nx.connected_components(graph)
+    Returns the merged expected and observed arrays, and a dict mapping
+    each merged row to the indices of the rows that it contains.
     """
+    if config.DEBUG_VERBOSE:
+        config.log_statement( "Normalizing bin frequencies" )
     
-    """
-    Brute force code for finding the matching points. This works, but is slow.
-    norm_rows = []
-    edges = []
-    for i, row in enumerate(expected_rnaseq_array):
-        if config.DEBUG_VERBOSE and i%10 == 0:
-            config.log_statement( "Clustering bin %i/%s in RNAseq array" % (
-                    i, expected_rnaseq_array.shape) )
-        norm_row = row/row.sum()
-        matching_indices = [ j for j, x in enumerate(norm_rows)
-                             if float(numpy.abs(x-norm_row).sum()) < 1e-6  ]
-        for j in matching_indices:
-            edges.append(( i, j))
-        norm_rows.append( norm_row  )
-    
-    graph = nx.Graph()
-    graph.add_nodes_from(xrange(expected_rnaseq_array.shape[0]))
-    graph.add_edges_from(edges)
-    clusters = nx.connected_components(graph)
-    print clusters
-    assert False
-    """
+    expected_rnaseq_array = scipy.sparse.csr_matrix(expected_rnaseq_array)
+    row_clusters = find_row_clusters(expected_rnaseq_array)
+    n_clusters = row_clusters.max()+1 if len(row_clusters) > 0 else 0
+    
+    # sum the rows in each cluster
+    order = numpy.argsort(row_clusters, kind='mergesort')
+    cluster_starts = numpy.flatnonzero(numpy.diff(numpy.hstack(
+        (-1, row_clusters[order]))))
+    cluster_mapping = dict( enumerate( 
+            rows.tolist() for rows in numpy.split(order, cluster_starts[1:]) ))
+    cluster_indicators = scipy.sparse.csr_matrix(
+        ( numpy.ones(len(row_clusters)), 
+          (row_clusters, numpy.arange(len(row_clusters))) ), 
+        shape=(n_clusters, len(row_clusters)) )
+    new_expected_array = (cluster_indicators*expected_rnaseq_array).tocsr()
+    new_observed_array = numpy.zeros(n_clusters, dtype=int)
+    if n_clusters > 0:
+        new_observed_array[:] = numpy.add.reduceat(
+            numpy.asarray(observed_rnaseq_array)[order], cluster_starts)
     
-    new_expected_array = numpy.zeros( 
-        (len(clusters), expected_rnaseq_array.shape[1]) )
-    new_observed_array = numpy.zeros( len(clusters), dtype=int )
-    cluster_mapping = {}
-    for i, node in enumerate(clusters):
-        cluster_mapping[i] = node
-        new_expected_array[i,:] = expected_rnaseq_array[node,].sum(0)
-        new_observed_array[i] = observed_rnaseq_array[node].sum()
-
     return new_expected_array, new_observed_array, cluster_mapping
 
 def find_nonoverlapping_exons_covered_by_segment(exon_bndrys, start, stop):
@@ -758,6 +982,48 @@ def find_nonoverlapping_exons_covered_by_segment(exon_bndrys, start, stop):
     return tuple(xrange( bin_1, bin_2+1 ))
  
 
+def iter_paired_read_blocks( reads, chrm, strand, start, stop ):
+    """Iterate over (rlen, rg, r1 blocks, r2 blocks) for read pairs.
+    
+    reads can either be a reads object, or a ReadSummary in which case the 
+    already decoded read pairs are used. Either way every pair that we yield 
+    counts as one read, so uniquely mapped pairs are binned identically. 
+    ( They pair multi-mapped reads differently - a reads object pairs each 
+    first read with one mapping of its mate, and a ReadSummary yields every 
+    combination of mappings on the same strand. )
+    """
+    if isinstance(reads, ReadSummary):
+        for qname, mappings in reads.iter_paired_read_data():
+            for ( qname, rd_strand, rg, flen, r1_data, r2_data, post_prb 
+                  ) in mappings:
+                if r1_data.read_len != r2_data.read_len: continue
+                yield ( r1_data.read_len, rg, 
+                        r1_data.cov_regions, r2_data.cov_regions )
+        return
+    
+    for r1, r2 in reads.iter_paired_reads(chrm, strand, start, stop):
+        if r1.rlen == 0: 
+            rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
+        else: 
+            rlen = r1.rlen
+            if rlen != r2.rlen:
+                if config.DEBUG_VERBOSE:
+                    config.log_statement(
+                        "WARNING: read lengths are not the same for %s and %s" % (
+                            r1.qname, r2.qname),
+                        log=True, display=False)
+                    config.log_statement(
+                        str(r1), log=True, display=False)
+                    config.log_statement(
+                        str(r2), log=True, display=False)                    
+                continue
+        
+        yield ( rlen, get_read_group( r1, r2 ), 
+                tuple(iter_coverage_intervals_for_read( r1 )),
+                tuple(iter_coverage_intervals_for_read( r2 )) )
+    
+    return
+
 def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=True ):
     """Bin reads into non-overlapping exons.
 
@@ -769,14 +1035,14 @@ def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=Tr
     # first get the paired reads
     gene_start = int(exon_boundaries[0])
     gene_stop = int(exon_boundaries[-1])
-    paired_reads = list( reads.iter_paired_reads(
-            chrm, strand, gene_start, gene_stop+1) )
+    paired_reads = list( iter_paired_read_blocks(
+            reads, chrm, strand, gene_start, gene_stop+1) )
     
     # find the unique subset of contiguous read sub-locations
     read_locs = set()
-    for r in chain(*paired_reads):
-        for start, stop in iter_coverage_intervals_for_read( r ):
-            read_locs.add( (start, stop) )
+    for rlen, rg, r1_blocks, r2_blocks in paired_reads:
+        read_locs.update( r1_blocks )
+        read_locs.update( r2_blocks )
     
     # build a mapping from contiguous regions into the non-overlapping exons (
     # ie, exon segments ) that they overlap
@@ -786,34 +1052,17 @@ def bin_rnaseq_reads( reads, chrm, strand, exon_boundaries, include_read_type=Tr
             find_nonoverlapping_exons_covered_by_segment( 
                 exon_boundaries, start, stop )
 
-    def build_bin_for_read( read ):
+    def build_bin_for_read( blocks ):
         bin = set()
-        for start, stop in iter_coverage_intervals_for_read( read ):
+        for start, stop in blocks:
             bin.update( read_locs_into_bins[(start, stop)] )
         return tuple(sorted(bin))
     
     # finally, aggregate the bins
     binned_reads = defaultdict( int )
-    for r1, r2 in paired_reads:
-        if r1.rlen == 0: 
-            rlen = sum( x[1] for x in r1.cigar if x[0] == 0 )
-        else: 
-            rlen = r1.rlen
-            if rlen != r2.rlen:
-                if config.DEBUG_VERBOSE:
-                    config.log_statement(
-                        "WARNING: read lengths are not the same for %s and %s" % (
-                            r1.qname, r2.qname),
-                        log=True, display=False)
-                    config.log_statement(
-                        str(r1), log=True, display=False)
-                    config.log_statement(
-                        str(r2), log=True, display=False)                    
-                continue
-        
-        rg = get_read_group( r1, r2 )
-        bin1 = build_bin_for_read( r1 )
-        bin2 = build_bin_for_read( r2 )
+    for rlen, rg, r1_blocks, r2_blocks in paired_reads:
+        bin1 = build_bin_for_read( r1_blocks )
+        bin2 = build_bin_for_read( r2_blocks )
         # skip any reads that don't completely overlap the gene
         if bin1 == () or bin2== () or any(x==() for x in chain(bin1, bin2)): continue
         assert len(bin1) > 0
@@ -893,21 +1142,18 @@ class DesignMatrix(object):
     def filter_design_matrix(self):        
         return
     
-    def _build_rnaseq_arrays(self, gene, rnaseq_reads, fl_dists):
+    def _build_rnaseq_arrays(self, gene, rnaseq_reads, fl_dists, 
+                             expected_cnts_cache=None):
         # bin the rnaseq reads
         expected_rnaseq_cnts, observed_rnaseq_cnts = \
             build_expected_and_observed_rnaseq_counts( 
-                gene, rnaseq_reads, fl_dists )
-        clustered_bins = cluster_bins(expected_rnaseq_cnts)
-        for cluster in clustered_bins:
-            print cluster
-        print
-        
+                gene, rnaseq_reads, fl_dists, expected_cnts_cache )
         # if no transcripts are observable given the fl dist, then return nothing
         if len( expected_rnaseq_cnts ) == 0:
             self.array_types.append('RNASeq')
             self.obs_cnt_arrays.append(None)
             self.expected_freq_arrays.append(None)
+            self.bin_clusters.append(None)
             return 
         
         # build the expected and observed counts, and convert them to frequencies
@@ -925,6 +1171,7 @@ class DesignMatrix(object):
         self.array_types.append('RNASeq')
         self.obs_cnt_arrays.append(observed_rnaseq_array)
         self.expected_freq_arrays.append(expected_rnaseq_array)
+        self.bin_clusters.append(clusters)
         self.unobservable_transcripts.update(unobservable_rnaseq_trans)
     
     def _build_gene_bnd_arrays(self, gene, reads, reads_type):
@@ -936,10 +1183,13 @@ class DesignMatrix(object):
             build_expected_and_observed_arrays( 
             expected_cnts, observed_cnts, normalize=True )
         del expected_cnts, observed_cnts
+        expected_array, observed_array, clusters = cluster_rows(
+            expected_array, observed_array)
 
         self.array_types.append(reads_type)
         self.obs_cnt_arrays.append(observed_array)
         self.expected_freq_arrays.append(expected_array)
+        self.bin_clusters.append(clusters)
         self.unobservable_transcripts.update(unobservable_trans)
         return
     
@@ -949,7 +1199,7 @@ class DesignMatrix(object):
         # it doesn't matter which design matric we use, because they 
         # al have the same number of transcripts
         for array in self.expected_freq_arrays:
-            if array == None: continue
+            if array is None: continue
             num_transcripts = array.shape[1]
             break
         
@@ -978,29 +1228,28 @@ class DesignMatrix(object):
         obs_arrays_to_stack = []
         for i, (expected, observed) in enumerate(izip(
                 self.expected_freq_arrays, self.obs_cnt_arrays)):
-            if expected == None:
-                assert observed == None
+            if expected is None:
+                assert observed is None
                 continue
             if bam_cnts != None: 
-                #obs_arrays_to_stack.append( bam_cnts[i]-sum(observed) )
+                # add the out of gene bin, which only the out of gene 
+                # 'transcript' can produce reads in
                 observed = numpy.hstack((bam_cnts[i]-sum(observed), observed))
-                expected = numpy.vstack(
-                    (numpy.zeros(expected.shape[1]), expected))
-                #print "zeros", numpy.zeros((expected.shape[0], 1)).shape, expected.shape,
-                expected = numpy.hstack(
-                    (numpy.zeros((expected.shape[0], 1)), expected))
-                #print expected.shape,
-                expected[0,0] = 1
+                expected = scipy.sparse.bmat( 
+                    [[scipy.sparse.csr_matrix([[1.0]]), None], 
+                     [None, expected]] )
             
             exp_arrays_to_stack.append(expected)
             obs_arrays_to_stack.append(observed)
 
         # stack all of the data type arrays
-        expected = numpy.vstack(exp_arrays_to_stack)[:,indices]
+        expected = scipy.sparse.vstack(exp_arrays_to_stack).tocsc()[:,indices]
+        expected = expected.tocsr()
         observed = numpy.hstack(obs_arrays_to_stack)
         
         # find which bins have 0 expected reads
-        bins_to_keep = (expected.sum(1) > 1e-6)
+        bins_to_keep = (
+            numpy.asarray(expected.sum(1)).ravel() > 1e-6).nonzero()[0]
         self._expected_and_observed = (
             expected[bins_to_keep,], observed[bins_to_keep])
         self._cached_bam_cnts = bam_cnts
@@ -1008,9 +1257,7 @@ class DesignMatrix(object):
         return self._expected_and_observed
 
     def find_transcripts_to_filter(self,expected,observed,max_num_transcripts):
-        # cluster bins
-        expected, observed = cluster_rows(expected, observed)
-        
+        # the bins were clustered when the arrays were built
         num_transcripts = expected.shape[1]
         low_expression_ts = set(self.unobservable_transcripts)
         if num_transcripts <= max_num_transcripts: 
@@ -1018,11 +1265,13 @@ class DesignMatrix(object):
         
 
         # transcripts to remove
-        test = (observed+1)/expected.max(1)
+        test = (observed+1)/expected.max(1).toarray().ravel()
         for index in numpy.arange(observed.shape[0])[test.argsort()]:
             if num_transcripts - len(low_expression_ts) <= max_num_transcripts:
                 break
-            new_low_expression = set(expected[index,].nonzero()[0])
+            new_low_expression = set(
+                expected.indices[expected.indptr[index]:
+                                 expected.indptr[index+1]].tolist())
             # if this would remove every transcript, skip it
             if len( low_expression_ts.union(new_low_expression) ) == num_transcripts:
                 continue
@@ -1032,12 +1281,15 @@ class DesignMatrix(object):
     
     def __init__(self, gene, fl_dists,
                  rnaseq_reads, five_p_reads, three_p_reads,
-                 max_num_transcripts=None):
+                 max_num_transcripts=None, expected_cnts_cache=None):
         assert fl_dists != None
         self.array_types = []
 
         self.obs_cnt_arrays = []
         self.expected_freq_arrays = []
+        # the rows of each expected array are clustered bins, this maps 
+        # each row to the indices of the sorted bins that it contains
+        self.bin_clusters = []
         self.unobservable_transcripts = set()
 
         self._cached_bam_cnts = None
@@ -1061,13 +1313,15 @@ class DesignMatrix(object):
             self.num_fp_reads = sum(self.obs_cnt_arrays[-1])
         else:
             self.expected_freq_arrays.append(None)
+            self.bin_clusters.append(None)
             self.obs_cnt_arrays.append(None)
             self.num_fp_reads = None
         
         if config.DEBUG_VERBOSE:
             config.log_statement( "Building RNAseq arrays for %s" % gene.id )
-        self._build_rnaseq_arrays(gene, rnaseq_reads, fl_dists)
-        if self.obs_cnt_arrays[-1] != None:
+        self._build_rnaseq_arrays(
+            gene, rnaseq_reads, fl_dists, expected_cnts_cache)
+        if self.obs_cnt_arrays[-1] is not None:
             self.num_rnaseq_reads = sum(self.obs_cnt_arrays[-1])
         
         if three_p_reads != None:
@@ -1077,10 +1331,11 @@ class DesignMatrix(object):
             self.num_tp_reads = sum(self.obs_cnt_arrays[-1])
         else:
             self.expected_freq_arrays.append(None)
+            self.bin_clusters.append(None)
             self.obs_cnt_arrays.append(None)
             self.num_tp_reads = None
 
-        if all( mat == None for mat in self.obs_cnt_arrays ):
+        if all( mat is None for mat in self.obs_cnt_arrays ):
             raise NoObservableTranscriptsError, "No observable transcripts"
         
         # initialize the filtered_transcripts to the unobservable transcripts
@@ -1099,6 +1354,149 @@ class DesignMatrix(object):
         return
 
 
+class DesignMatrixStore(object):
+    """An append only file of design matrices, shared between processes.
+
+    Each entry is a header with the size of its array data and pickle, the
+    array data, and then a pickle of the design matrix in which the numpy 
+    arrays ( including the arrays inside of the sparse matrices ) have been
+    replaced by their offsets into the array data. Entries are padded to 
+    ARRAY_ALIGNMENT bytes, so that every array is aligned.
+
+    get unpickles the design matrix with its arrays pointing into a copy on 
+    write mmap of the file, so that reading a design matrix doesn't copy or
+    deserialize its arrays. The entry offsets are stored in shared memory, 
+    so the store must be created before the processes that use it fork.
+    """
+    HEADER_FORMAT = '<qq'
+    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    ARRAY_ALIGNMENT = 8
+    
+    def __init__(self, fname, gene_ids, offsets=None):
+        self.fname = fname
+        self.gene_indices = dict(
+            (gene_id, i) for i, gene_id in enumerate(gene_ids))
+        if offsets is None:
+            offsets = [-1]*len(self.gene_indices)
+            open(fname, "wb").close()
+        self._offsets = multiprocessing.Array(
+            ctypes.c_int64, offsets, lock=False)
+        # the file size, including the entries that are still being written
+        self._size = multiprocessing.Value(
+            ctypes.c_int64, os.path.getsize(fname), lock=False)
+        self._lock = multiprocessing.Lock()
+        self._mmap = None
+        return
+    
+    @classmethod
+    def load(cls, fname):
+        """Load a store that has been saved with write_index.
+
+        """
+        with open(fname + ".index", "rb") as fp:
+            offsets = pickle.load(fp)
+        gene_ids = sorted(offsets)
+        return cls(fname, gene_ids, [offsets[x] for x in gene_ids])
+    
+    def write_index(self):
+        """Write the gene entry offsets to fname.index, so that load can 
+           reopen the store.
+
+        """
+        with open(self.fname + ".index", "wb") as ofp:
+            pickle.dump(dict((gene_id, self._offsets[i]) 
+                             for gene_id, i in self.gene_indices.iteritems()
+                             if self._offsets[i] >= 0),
+                        ofp, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+    
+    def _padding(self, size):
+        return '\0'*(-size%self.ARRAY_ALIGNMENT)
+    
+    def __contains__(self, gene_id):
+        return self._offsets[self.gene_indices[gene_id]] >= 0
+    
+    def __iter__(self):
+        return ( gene_id for gene_id in self.gene_indices if gene_id in self )
+    
+    def add(self, gene_id, f_mat):
+        arrays = []
+        array_ids = {}
+        arrays_size = [0,]
+        def persistent_id(obj):
+            if type(obj) is not numpy.ndarray or obj.dtype.hasobject: 
+                return None
+            try: return array_ids[id(obj)]
+            except KeyError: pass
+            array = numpy.ascontiguousarray(obj)
+            pid = (arrays_size[0], array.dtype.str, array.shape)
+            array_ids[id(obj)] = pid
+            arrays.append(array)
+            arrays_size[0] += array.nbytes + len(self._padding(array.nbytes))
+            return pid
+
+        data = StringIO()
+        pickler = pickle.Pickler(data, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(f_mat)
+        data = data.getvalue()
+        entry_size = ( self.HEADER_SIZE + arrays_size[0] 
+                       + len(data) + len(self._padding(len(data))) )
+        
+        # reserve space at the end of the file, and then write the entry 
+        # outside of the lock so that processes can write concurrently
+        with self._lock:
+            offset = self._size.value
+            self._size.value += entry_size
+        with open(self.fname, "r+b") as ofp:
+            ofp.seek(offset)
+            ofp.write(struct.pack(self.HEADER_FORMAT, arrays_size[0], len(data)))
+            for array in arrays:
+                ofp.write(buffer(array))
+                ofp.write(self._padding(array.nbytes))
+            ofp.write(data)
+            ofp.write(self._padding(len(data)))
+        
+        # only publish the offset once the entry has been written
+        with self._lock:
+            self._offsets[self.gene_indices[gene_id]] = offset
+        return
+    
+    def _get_mmap(self, min_size):
+        # the file grows as entries are added, so remap it if the entry is
+        # past the end of our map. We don't close the old map, because 
+        # previously loaded arrays may still point into it
+        if self._mmap is None or len(self._mmap) < min_size:
+            with open(self.fname, "rb") as fp:
+                self._mmap = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._mmap
+    
+    def get(self, gene_id):
+        offset = self._offsets[self.gene_indices[gene_id]]
+        if offset < 0:
+            raise KeyError, "No design matrix for '%s'" % gene_id
+        data = self._get_mmap(offset + self.HEADER_SIZE)
+        arrays_size, pickle_size = struct.unpack_from(
+            self.HEADER_FORMAT, data, offset)
+        arrays_start = offset + self.HEADER_SIZE
+        pickle_start = arrays_start + arrays_size
+        data = self._get_mmap(pickle_start + pickle_size)
+        
+        def persistent_load(pid):
+            array_offset, dtype, shape = pid
+            dtype = numpy.dtype(dtype)
+            count = int(numpy.prod(shape))
+            if count == 0: 
+                return numpy.zeros(shape, dtype=dtype)
+            return numpy.frombuffer(
+                data, dtype, count, arrays_start+array_offset).reshape(shape)
+        
+        unpickler = pickle.Unpickler(
+            StringIO(data[pickle_start:pickle_start+pickle_size]))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
 def tests( ):
     exon_lens = [100,1,100]
     transcript = range( len(exon_lens) )
@@ -0,0 +1,271 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import hashlib
+
+import numpy
+
+import grit.config as config
+from grit.lib.multiprocessing_utils import run_in_parallel
+
+# build contigs in chunks of this many bases, to bound the memory usage
+CHUNK_SIZE = 5000000
+
+strand_names = {'+': 'plus', '-': 'minus', '.': 'unstranded'}
+
+def calc_cache_key(reads):
+    """Build a string that identifies the coverage that reads produce.
+
+    The key includes the bam's path, size and mtime, and the parameters that
+    determine the read strands, so that changing any of these invalidates
+    the cached coverage.
+    """
+    fname = os.path.realpath(reads.filename)
+    fstat = os.stat(fname)
+    key_data = [fname, str(fstat.st_size), repr(fstat.st_mtime),
+                type(reads).__name__]
+    for key, val in sorted(reads._init_kwargs.iteritems()):
+        key_data.append("%s=%s" % (key, val))
+    return "\n".join(key_data) + "\n"
+
+def write_array_atomically(fname, array):
+    tmp_fname = "%s.%i.tmp" % (fname, os.getpid())
+    with open(tmp_fname, "wb") as ofp:
+        numpy.save(ofp, array)
+    os.rename(tmp_fname, fname)
+    return
+
+def populate_contig_in_subprocess(reads, cache_dir, contig):
+    # re-open the reads to make this multi-process safe
+    reads = reads.reload()
+    CoverageCache(reads, cache_dir).populate_contig(contig)
+    return
+
+class CoverageCache(object):
+    """Store per contig, per strand coverage arrays for a reads object on disk.
+
+    Read coverage is stored as dense uint32 arrays, indexed by the read
+    strand ( '.' stores unstranded reads ). Signal coverage ( e.g. the
+    TSS positions for CAGE reads ) is sparse and weighted, so we store the
+    sorted positions and weights. Arrays are memory mapped, so a read
+    coverage region is served without copying the data.
+
+    The cache lives in a sub-directory of cache_dir that is keyed by
+    calc_cache_key, so it is safe to share cache_dir between runs and bams.
+    """
+    def __init__(self, reads, cache_dir):
+        self.reads = reads
+        self.cache_dir = os.path.abspath(cache_dir)
+        key = calc_cache_key(reads)
+        self.data_dir = os.path.join(self.cache_dir, "%s.%s" % (
+            os.path.basename(reads.filename),
+            hashlib.sha1(key).hexdigest()[:16]))
+        try:
+            os.makedirs(self.data_dir)
+        except OSError:
+            if not os.path.isdir(self.data_dir): raise
+        key_fname = os.path.join(self.data_dir, "key.txt")
+        if not os.path.exists(key_fname):
+            with open(key_fname, "w") as ofp:
+                ofp.write(key)
+
+        # the strands with observed coverage, and the opened memmaps
+        self._nonempty_strands = {}
+        self._arrays = {}
+        return
+
+    def _fname(self, contig, strand, data_type):
+        return os.path.join(self.data_dir, "%s.%s.%s.npy" % (
+            contig.replace(os.sep, "_"), strand_names[strand], data_type))
+
+    def _done_fname(self, contig):
+        return os.path.join(
+            self.data_dir, "%s.done" % contig.replace(os.sep, "_"))
+
+    def is_populated(self, contig):
+        return os.path.exists(self._done_fname(contig))
+
+    def populate_contig(self, contig):
+        """Decode the reads in contig, and write their coverage to disk.
+
+        """
+        if config.VERBOSE: config.log_statement(
+            "Building the coverage cache for %s in %s" % (
+                contig, self.reads.filename))
+        contig_len = self.reads.contig_len(contig)
+        signal_is_read_cov = self.reads.signal_is_read_coverage
+
+        tmp_cov_fnames, covs = {}, {}
+        for strand in '+-.':
+            tmp_cov_fnames[strand] = "%s.%i.tmp" % (
+                self._fname(contig, strand, 'cov'), os.getpid())
+            covs[strand] = numpy.lib.format.open_memmap(
+                tmp_cov_fnames[strand], mode='w+',
+                dtype=numpy.uint32, shape=(contig_len,))
+        signal_poss = dict((strand, []) for strand in '+-.')
+        signal_weights = dict((strand, []) for strand in '+-.')
+
+        nonempty_strands = set()
+        for c_start in xrange(0, contig_len, CHUNK_SIZE):
+            c_stop = min(c_start + CHUNK_SIZE, contig_len) - 1
+            chunk_cov, chunk_signal = self.reads.build_strand_coverage_arrays(
+                contig, c_start, c_stop)
+            for strand, cov in chunk_cov.iteritems():
+                # skip empty chunks so that they stay sparse on disk
+                if not cov.any(): continue
+                nonempty_strands.add(('cov', strand))
+                covs[strand][c_start:c_stop+1] = cov
+            if signal_is_read_cov: continue
+            for strand, signal in chunk_signal.iteritems():
+                poss = signal.nonzero()[0]
+                if len(poss) == 0: continue
+                nonempty_strands.add(('signal', strand))
+                signal_poss[strand].append(poss + c_start)
+                signal_weights[strand].append(signal[poss])
+
+        for strand in '+-.':
+            covs[strand].flush()
+            del covs[strand]
+            os.rename(tmp_cov_fnames[strand], self._fname(contig, strand, 'cov'))
+            if signal_is_read_cov: continue
+            write_array_atomically(
+                self._fname(contig, strand, 'signal_poss'),
+                numpy.concatenate(signal_poss[strand] + [
+                    numpy.zeros(0, dtype=int),]))
+            write_array_atomically(
+                self._fname(contig, strand, 'signal_weights'),
+                numpy.concatenate(signal_weights[strand] + [
+                    numpy.zeros(0, dtype=float),]))
+
+        # the done file is written last, so that it marks a complete contig
+        tmp_fname = "%s.%i.tmp" % (self._done_fname(contig), os.getpid())
+        with open(tmp_fname, "w") as ofp:
+            for data_type, strand in sorted(nonempty_strands):
+                ofp.write("%s\t%s\n" % (data_type, strand))
+        os.rename(tmp_fname, self._done_fname(contig))
+
+        return
+
+    def populate(self, contigs=None, nthreads=1):
+        """Populate the cache for contigs ( default: every contig ).
+
+        """
+        if contigs == None: contigs = self.reads.references
+        contigs = [ self._find_contig(contig) for contig in contigs ]
+        contigs = [ contig for contig in contigs
+                    if contig != None and not self.is_populated(contig) ]
+        if nthreads == 1 or len(contigs) <= 1:
+            for contig in contigs:
+                self.populate_contig(contig)
+        else:
+            run_in_parallel(
+                min(nthreads, len(contigs)), populate_contig_in_subprocess,
+                [(self.reads, self.cache_dir, contig) for contig in contigs])
+        return
+
+    def _find_contig(self, chrm):
+        # return None if these reads don't contain chrm
+        try: 
+            return self.reads.fix_chrm_name(chrm)
+        except KeyError:
+            return None
+
+    def _find_nonempty_strands(self, contig):
+        try:
+            return self._nonempty_strands[contig]
+        except KeyError:
+            if not self.is_populated(contig):
+                self.populate_contig(contig)
+            with open(self._done_fname(contig)) as fp:
+                nonempty_strands = set(
+                    tuple(line.split()) for line in fp if line.strip() != '')
+            self._nonempty_strands[contig] = nonempty_strands
+            return nonempty_strands
+
+    def _load_array(self, contig, strand, data_type):
+        key = (contig, strand, data_type)
+        try:
+            return self._arrays[key]
+        except KeyError:
+            self._arrays[key] = numpy.load(
+                self._fname(contig, strand, data_type), mmap_mode='r')
+            return self._arrays[key]
+
+    def find_read_coverage(self, chrm, strand, start, stop):
+        """Return the coverage from reads on exactly strand in start-stop.
+
+        If the region is in the contig this is a read-only view of the
+        memory mapped array.
+        """
+        contig = self._find_contig(chrm)
+        if ( contig == None or 
+             ('cov', strand) not in self._find_nonempty_strands(contig) ):
+            return numpy.zeros(stop-start+1, dtype=numpy.uint32)
+        cov = self._load_array(contig, strand, 'cov')
+        if start >= 0 and stop < len(cov):
+            return cov[start:stop+1]
+        rv = numpy.zeros(stop-start+1, dtype=numpy.uint32)
+        rv[max(0, -start):max(0, len(cov)-start)] = cov[
+            max(0, start):stop+1]
+        return rv
+
+    def find_signal_coverage(self, chrm, strand, start, stop):
+        """Return the signal from reads on exactly strand in start-stop.
+
+        """
+        contig = self._find_contig(chrm)
+        rv = numpy.zeros(stop-start+1, dtype=float)
+        if ( contig == None or 
+             ('signal', strand) not in self._find_nonempty_strands(contig) ):
+            return rv
+        poss = self._load_array(contig, strand, 'signal_poss')
+        weights = self._load_array(contig, strand, 'signal_weights')
+        i, j = poss.searchsorted(start), poss.searchsorted(stop, 'right')
+        rv[poss[i:j]-start] = weights[i:j]
+        return rv
+
+    def build_read_coverage_array(self, chrm, strand, start, stop):
+        """Serve Reads.build_read_coverage_array from the cache.
+
+        """
+        assert stop >= start
+        if not self.reads.signal_is_read_coverage:
+            # the signal is only returned for reads on exactly strand
+            if strand not in strand_names:
+                return numpy.zeros(stop-start+1, dtype=float)
+            return self.find_signal_coverage(chrm, strand, start, stop)
+
+        # reads with an unknown strand are on both strands, and the
+        # None strand includes all reads
+        if strand == None: strands = '+-.'
+        elif strand == '.': strands = '.'
+        else: strands = strand + '.'
+        contig = self._find_contig(chrm)
+        if contig == None:
+            return numpy.zeros(stop-start+1, dtype=float)
+        nonempty_strands = self._find_nonempty_strands(contig)
+        strands = [ x for x in strands if ('cov', x) in nonempty_strands ]
+        # if there is a single strand, we can serve the region directly
+        if len(strands) == 1:
+            return self.find_read_coverage(chrm, strands[0], start, stop)
+        cvg = numpy.zeros(stop-start+1, dtype=float)
+        for x in strands:
+            cvg += self.find_read_coverage(chrm, x, start, stop)
+        return cvg
@@ -18,6 +18,8 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys, os
+import array
+import gzip
 from itertools import chain
 from collections import defaultdict, namedtuple
 from copy import copy
@@ -29,6 +31,7 @@ import grit.config as config
 from grit.frag_len import build_normal_density
 
 import junctions
+from coverage_cache import CoverageCache
 
 ReadData = namedtuple('ReadData', [
         'strand', 'read_len', 'read_grp', 'map_prb', 'cov_regions'])
@@ -240,34 +243,46 @@ def read_pairs_are_on_same_strand( bam_obj, min_num_reads_to_check=50000,
     assert False, 'Unexpecgted return values: "%s"' % read_strand_attributes
 
 def iter_coverage_intervals_for_read(read):
-    # we loop through each contig in the cigar string to deal
-    # with junctions reads.
-    # note that the bam files are 0 based
-    start = read.pos
-    for contig_type, length in read.cigar:
-        # if this is a match, add it 
-        if contig_type == 0:
-            yield ( start, start + length - 1 )
-            start += length
-        # skip reference insertions
-        elif contig_type == 1:
-            pass
-            # start += length
-        # move past refernce deletions
-        elif contig_type == 2:
-            start += length
-        # skip past skipped regions
-        elif contig_type == 3:
-            start += length
-        # since read positions dont include clipped regions, 
-        # ignore clipping
-        elif contig_type == 4 or contig_type == 5:
-            pass
-        else:
-            print >> sys.stderr, "Unrecognized cigar format:", read.cigar
+    # pysam walks the cigar string for us - each match yields a block, and 
+    # deletions and skipped regions ( junctions ) move the position forward.
+    # note that the bam files are 0 based, and the blocks are half open
+    for start, stop in read.get_blocks():
+        yield ( start, stop - 1 )
 
     return
 
+def build_coverage_from_intervals(starts, stops, r_start, r_stop, weights=None):
+    """Build the coverage of the closed intervals over (r_start, r_stop).
+
+    We add the weights ( or 1 ) at each interval start and subtract them one 
+    past each interval stop, and then take the cumulative sum of this 
+    difference array. Intervals are clipped to the region.
+    """
+    reg_len = r_stop - r_start + 1
+    starts = numpy.clip(
+        numpy.asarray(starts, dtype=int) - r_start, 0, reg_len)
+    stops = numpy.clip(
+        numpy.asarray(stops, dtype=int) - r_start + 1, 0, reg_len)
+    in_region = starts < stops
+    if weights is not None: 
+        weights = numpy.asarray(weights, dtype=float)[in_region]
+    cov_diff = ( 
+        numpy.bincount(starts[in_region], weights, minlength=reg_len+1)
+        - numpy.bincount(stops[in_region], weights, minlength=reg_len+1) )
+    return numpy.asarray(cov_diff.cumsum()[:reg_len], dtype=float)
+
+def build_coverage_from_positions(poss, r_start, r_stop, weights=None):
+    """Sum the weights ( or 1 ) at each position in (r_start, r_stop).
+
+    """
+    reg_len = r_stop - r_start + 1
+    poss = numpy.asarray(poss, dtype=int) - r_start
+    in_region = (poss >= 0)&(poss < reg_len)
+    if weights is not None: 
+        weights = numpy.asarray(weights, dtype=float)[in_region]
+    return numpy.asarray(numpy.bincount(
+        poss[in_region], weights, minlength=reg_len), dtype=float)
+
 def iter_coverage_regions_for_read( 
     read, bam_obj, reverse_read_strand, pairs_are_opp_strand ):
     """Find the regions covered by this read
@@ -283,116 +298,616 @@ def iter_coverage_regions_for_read(
     
     return
 
-def extract_jns_and_reads_in_region(
-        (chrm, strand, r_start, r_stop), reads, max_n_reads_to_store=1e6):
-    assert strand in '+-.', "Strand must be -, +, or . for either"
-
-    reg_len = r_stop-r_start+1
-    
-    jn_reads = {'+': defaultdict(int), '-': defaultdict(int)}
-
-    cov = { '+': numpy.zeros(reg_len, dtype=float), 
-            '-': numpy.zeros(reg_len, dtype=float) }
+def calc_frag_len_from_read_data(read1_data, read2_data):
+    frag_start = min(min(read1_data.cov_regions[0]), 
+                     min(read2_data.cov_regions[0]))
+    frag_stop = max(max(read1_data.cov_regions[0]), 
+                    max(read2_data.cov_regions[0]))
+    return frag_stop - frag_start + 1
 
-    pair1_reads = defaultdict(list)
-    pair2_reads = defaultdict(list)
+class ReadDataStore(object):
+    """Store the data needed to pair reads in numpy columns.
 
-    num_unique_reads = 0.0
+    Each read is a row. We store the read's qname id ( an index into qnames ),
+    whether it is the first read in a pair, its strand ( an index into '+-.' ), its read group
+    ( an index into read_grps ), its mapping probability, its length, and 
+    the offset and number of its coverage blocks in block_starts/block_lens.
+    
+    Reads are appended into compact python arrays, and then frozen into 
+    numpy arrays with finalize.
+    """
+    _columns = (
+        ('qname_id', 'l'), ('is_read1', 'b'), ('strand', 'b'), 
+        ('read_grp', 'i'), ('map_prb', 'd'), ('read_len', 'i'),
+        ('blocks_offset', 'l'), ('n_blocks', 'i') )
+    _block_columns = ( ('block_starts', 'l'), ('block_lens', 'i') )
+    
+    def __init__(self):
+        self.read_grps = []
+        self._read_grp_ids = {}
+        self.qnames = []
+        self._qname_ids = {}
+        for name, typecode in self._columns + self._block_columns:
+            setattr(self, name, array.array(typecode))
+        self._is_finalized = False
     
-    config.log_statement("Finding reads in %s" % str((chrm, strand, r_start, r_stop)))        
-    for n_obs_reads, (read, rd_strand) in enumerate(reads.iter_reads_and_strand(
-            chrm, r_start, r_stop+1)):
-        # break if we've surpassed the read
-        if read.pos > r_stop: break
+    def __len__(self):
+        return len(self.qname_id)
+    
+    def add(self, qname, is_read1, strand, read_grp, map_prb, read_len, 
+            cov_regions):
+        assert not self._is_finalized
+        try: 
+            read_grp_id = self._read_grp_ids[read_grp]
+        except KeyError:
+            read_grp_id = len(self.read_grps)
+            self._read_grp_ids[read_grp] = read_grp_id
+            self.read_grps.append(read_grp)
         
-        # -probability that the read originated in this location
-        # if we can't find it, assume that it's uniform over alternate
-        # mappings. If we can't find that, then assume that it's unique
-        map_prb = get_rd_posterior_prb(read)
-
-        if n_obs_reads > 0 and n_obs_reads%100000 == 0:
-            config.log_statement("Processed %i reads in %s" % (
-                n_obs_reads, str((chrm, strand, r_start, r_stop))))
-        for jn in junctions.iter_jns_in_read(read):
-            # skip jns whose start does not overlap this region, we subtract one
-            # because the start refers to the first covered intron base, and 
-            # we are talking about covered regions
-            if jn[0]-1 < r_start or jn[0]-1 > r_stop: continue
-            jn_reads[rd_strand][jn] += 1
-        # if this is an anti-strand read, then we only care about the jns
-        if strand != '.' and rd_strand != strand: continue
-        
-        # extract the information we care about:
-        # -strand, alread have this
-        # -regions covered
-        cov_regions = list(iter_coverage_intervals_for_read(read))
-        # -read length
-        read_len = read.inferred_length
-        # -read group
-        try: read_grp = read.opt('RG')
-        except KeyError: read_grp = 'mean'
-        
-        num_unique_reads += (
-            map_prb/2. if read.is_paired else map_prb )
+        try:
+            qname_id = self._qname_ids[qname]
+        except KeyError:
+            qname_id = len(self.qnames)
+            self._qname_ids[qname] = qname_id
+            self.qnames.append(qname)
         
+        self.qname_id.append(qname_id)
+        self.is_read1.append(is_read1)
+        self.strand.append('+-.'.index(strand))
+        self.read_grp.append(read_grp_id)
+        self.map_prb.append(map_prb)
+        self.read_len.append(read_len)
+        self.blocks_offset.append(len(self.block_starts))
+        self.n_blocks.append(len(cov_regions))
         for start, stop in cov_regions:
-            # if start - r_start > reg_len, then it doesn't do 
-            # anything, so the next line is not necessary
-            # if start - r_start > reg_len: continue
-            cov[rd_strand][
-                max(0, start-r_start):max(0, stop-r_start+1)] += 1
+            self.block_starts.append(start)
+            self.block_lens.append(stop-start+1)
+        return
+    
+    def finalize(self):
+        if self._is_finalized: return self
+        for name, typecode in self._columns + self._block_columns:
+            setattr(self, name, numpy.frombuffer(
+                getattr(self, name), dtype=numpy.dtype(typecode)))
+        self.is_read1 = numpy.asarray(self.is_read1, dtype=bool)
+        # we only need the ids to add reads
+        self._qname_ids = None
+        self._is_finalized = True
+        return self
+    
+    def read_starts(self, indices):
+        """Return the first covered base of the reads at indices.
 
-        
-        # store the read data - we will join them later
-        if max(len(pair1_reads), len(pair2_reads)) < max_n_reads_to_store:
-            read_data = ReadData(
-                rd_strand, read_len, read_grp, map_prb, tuple(cov_regions))
+        """
+        return self.block_starts[self.blocks_offset[indices]]
 
-            if read.is_read1:
-                pair1_reads[read.qname].append(read_data) 
-            else:
-                pair2_reads[read.qname].append(read_data) 
+    def read_stops(self, indices):
+        """Return the last covered base of the reads at indices.
 
-        # if we ar in a long region and have surpassed the maximum number 
-        # of allowed reads, then 
-        #if r_stop - r_start > 1000 and n_obs_reads > 1e5: 
-        #    raise TooManyReadsError, "Too many reads"
+        """
+        last_block = self.blocks_offset[indices] + self.n_blocks[indices] - 1
+        return self.block_starts[last_block] + self.block_lens[last_block] - 1
 
-    return ( pair1_reads, pair2_reads, 
-             jn_reads['+'], jn_reads['-'], 
-             cov, num_unique_reads )
+    def calc_frag_lens(self, r1_indices, r2_indices):
+        """Calculate the fragment lengths of the read pairs.
+        
+        The fragment spans both reads' first coverage block ( see 
+        calc_frag_len_from_read_data ).
+        """
+        r1_starts = self.block_starts[self.blocks_offset[r1_indices]]
+        r2_starts = self.block_starts[self.blocks_offset[r2_indices]]
+        r1_stops = r1_starts + self.block_lens[
+            self.blocks_offset[r1_indices]] - 1
+        r2_stops = r2_starts + self.block_lens[
+            self.blocks_offset[r2_indices]] - 1
+        return ( numpy.maximum(r1_stops, r2_stops) 
+                 - numpy.minimum(r1_starts, r2_starts) + 1 )
+
+    def get_read(self, i):
+        """Build a ReadData tuple for the read at index i.
+        
+        """
+        offset, n_blocks = self.blocks_offset[i], self.n_blocks[i]
+        cov_regions = tuple( 
+            (int(start), int(start+length-1)) for start, length in zip(
+                self.block_starts[offset:offset+n_blocks],
+                self.block_lens[offset:offset+n_blocks]) )
+        return ReadData( '+-.'[self.strand[i]], int(self.read_len[i]), 
+                         self.read_grps[self.read_grp[i]], 
+                         float(self.map_prb[i]), cov_regions )
+
+class PairedReadData(object):
+    """Read pairs in a ReadDataStore.
+
+    Each pair is a row, indexing the first and second reads in the store.
+    qname_indices groups the pairs ( i.e. the alternate mappings ) of each 
+    read name, and post_prbs are the pair mapping probabilities normalized 
+    within each of these groups. 
+    """
+    def __init__(self, read_data, r1_indices, r2_indices, 
+                 qname_indices, post_prbs, frag_lens):
+        self.read_data = read_data
+        self.r1_indices = r1_indices
+        self.r2_indices = r2_indices
+        self.qname_indices = qname_indices
+        self.post_prbs = post_prbs
+        self.frag_lens = frag_lens
+        self.num_qnames = ( 0 if len(qname_indices) == 0 
+                            else int(qname_indices.max()) + 1 )
+    
+    def __len__(self):
+        return self.num_qnames
 
-def calc_frag_len_from_read_data(read1_data, read2_data):
-    frag_start = min(min(read1_data.cov_regions[0]), 
-                     min(read2_data.cov_regions[0]))
-    frag_stop = max(max(read1_data.cov_regions[0]), 
-                    max(read2_data.cov_regions[0]))
-    return frag_stop - frag_start + 1
+def pair_reads(read_data):
+    """Pair the reads in a ReadDataStore.
 
-def iter_paired_reads(p1_reads, p2_reads, fl_dist=None):
-    for qname, r1_mappings_data in p1_reads.iteritems():
-        if qname not in p2_reads: continue
-        r2_mappings_data = p2_reads[qname]
-        paired_reads = []
-        post_prb_sum = 0.0
-        for r1_data in r1_mappings_data:
-            for r2_data in r2_mappings_data:
-                if r1_data.strand != r2_data.strand: continue
-                assert r1_data.read_grp == r1_data.read_grp
-                flen = calc_frag_len_from_read_data(r1_data, r2_data)
-                # if there is no fragment length data, then 
-                # assume that the fragment sizes are all equally likely
-                post_prb = r1_data.map_prb*r2_data.map_prb
-                if fl_dist != None: assert False
-                post_prb_sum += post_prb
-                paired_reads.append( [
-                        qname, r1_data.strand, r1_data.read_grp, flen, 
-                        r1_data, r2_data, post_prb])
-        for x in paired_reads: x[-1] = x[-1]/post_prb_sum
-        yield qname, paired_reads
+    We find every combination of first and second read mappings with the same
+    qname that are on the same strand, by sorting the second reads by qname 
+    id and merging the first reads into them.
+    """
+    read_data.finalize()
+    r1_indices = numpy.nonzero(read_data.is_read1)[0]
+    r2_indices = numpy.nonzero(~read_data.is_read1)[0]
+    r2_indices = r2_indices[
+        read_data.qname_id[r2_indices].argsort(kind='mergesort')]
+    r2_qname_ids = read_data.qname_id[r2_indices]
+    
+    # find the range of matching second reads for each first read, and
+    # expand these into every combination
+    r1_qname_ids = read_data.qname_id[r1_indices]
+    lower = r2_qname_ids.searchsorted(r1_qname_ids, side='left')
+    upper = r2_qname_ids.searchsorted(r1_qname_ids, side='right')
+    cnts = upper - lower
+    pair_offsets = numpy.arange(cnts.sum()) - numpy.repeat(
+        cnts.cumsum() - cnts, cnts)
+    r2_indices = r2_indices[numpy.repeat(lower, cnts) + pair_offsets]
+    r1_indices = numpy.repeat(r1_indices, cnts)
+    
+    # only pair reads that are on the same strand
+    same_strand = (
+        read_data.strand[r1_indices] == read_data.strand[r2_indices])
+    r1_indices, r2_indices = r1_indices[same_strand], r2_indices[same_strand]
+    
+    frag_lens = read_data.calc_frag_lens(r1_indices, r2_indices)
+    
+    # normalize the pair mapping probabilities within each read name. If 
+    # there is no fragment length data, then assume that the fragment sizes 
+    # are all equally likely
+    post_prbs = ( read_data.map_prb[r1_indices]
+                  *read_data.map_prb[r2_indices] )
+    qname_ids, qname_indices = numpy.unique(
+        read_data.qname_id[r1_indices], return_inverse=True)
+    post_prb_sums = numpy.bincount(qname_indices, weights=post_prbs)
+    post_prbs = post_prbs/post_prb_sums[qname_indices]
+    
+    return PairedReadData(read_data, r1_indices, r2_indices, 
+                          qname_indices, post_prbs, frag_lens)
 
+def iter_paired_reads(read_data, fl_dist=None):
+    """Iterate over the read pairs in a ReadDataStore, grouped by read name.
+    
+    This yields (qname, mappings) tuples, where each mapping is a list of
+    [qname, strand, read group, fragment length, 
+     read 1 data, read 2 data, posterior probability].
+    """
+    # if there is no fragment length data, then 
+    # assume that the fragment sizes are all equally likely
+    if fl_dist != None: assert False
+    paired_reads = pair_reads(read_data)
+    order = paired_reads.qname_indices.argsort(kind='mergesort')
+    group_bnds = numpy.nonzero(
+        numpy.diff(paired_reads.qname_indices[order]))[0] + 1
+    for pair_indices in numpy.split(order, group_bnds):
+        if len(pair_indices) == 0: continue
+        mappings = []
+        for i in pair_indices:
+            r1_data = read_data.get_read(paired_reads.r1_indices[i])
+            r2_data = read_data.get_read(paired_reads.r2_indices[i])
+            assert r1_data.read_grp == r2_data.read_grp
+            qname = read_data.qnames[
+                read_data.qname_id[paired_reads.r1_indices[i]]]
+            mappings.append( [
+                qname, r1_data.strand, r1_data.read_grp, 
+                int(paired_reads.frag_lens[i]), r1_data, r2_data, 
+                float(paired_reads.post_prbs[i])] )
+        yield mappings[0][0], mappings
+    
     return
 
+class ReadSummary(object):
+    """Summarize the reads in a region with a single pass through the bam.
+
+    Every read is decoded exactly once, and we store the strand specific 
+    coverage, the junction counts and the data needed to pair reads ( and 
+    hence estimate fragment lengths ). A summary can be used in place of the
+    reads object that it was built from to build coverage arrays, so later 
+    stages don't need to re-fetch the same reads.
+    
+    regions is an optional list of closed sub-regions of (start, stop) to 
+    fetch reads from - by default we fetch reads from the full region.
+    """
+    def __init__(self, reads, chrm, strand, start, stop, 
+                 regions=None):
+        assert strand in '+-.', "Strand must be -, +, or . for either"
+        assert stop >= start
+        self.chrm = chrm
+        self.strand = strand
+        self.start = start
+        self.stop = stop
+        self.regions = [(start, stop),] if regions == None else regions
+        
+        # copy the attributes that the downstream code uses
+        self.type = getattr(reads, 'type', None)
+        self.reads_are_stranded = reads.reads_are_stranded
+        self.fl_dists = reads.fl_dists
+        self.num_reads = reads.num_reads
+        
+        # coverage is indexed by read strand - '.' stores unstranded reads.
+        # cov is the read coverage, and signal_cov is the coverage defined
+        # by the read type ( e.g. the TSS position for CAGE reads ). 
+        # MergedReads objects wrap multiple underlying reads objects, which 
+        # are all of the same type
+        all_reads = getattr(reads, '_reads', [reads,])
+        reg_len = stop - start + 1
+        self.cov = dict((s, numpy.zeros(reg_len, dtype=float)) for s in '+-.')
+        if all_reads[0].signal_is_read_coverage:
+            self.signal_cov = self.cov
+        else:
+            self.signal_cov = dict(
+                (s, numpy.zeros(reg_len, dtype=float)) for s in '+-.')
+        self.jn_reads = dict((s, defaultdict(int)) for s in '+-.')
+        
+        self.read_data = ReadDataStore()
+        self._paired_reads = None
+        
+        self.num_unique_reads = 0.0
+        self.num_obs_reads = 0
+        
+        for sub_reads in all_reads:
+            prev_r_stop = -1
+            for r_start, r_stop in sorted(self.regions):
+                self._add_reads_in_region(
+                    sub_reads, r_start, r_stop, prev_r_stop)
+                prev_r_stop = r_stop
+        self.read_data.finalize()
+        
+        return
+    
+    def _add_reads_in_region(self, reads, r_start, r_stop, prev_r_stop):
+        """Add the reads in (r_start, r_stop) to the summary.
+
+        Reads that start at or before prev_r_stop were already fetched in the 
+        previous region, so we only add their coverage in this region.
+        """
+        config.log_statement("Finding reads in %s" % str(
+                (self.chrm, self.strand, r_start, r_stop)))
+        signal_is_read_cov = reads.signal_is_read_coverage
+        # if the coverage is cached, then we only need the reads for the 
+        # junctions and the read data
+        use_cached_cov = ( reads.coverage_cache != None )
+        # collect the coverage intervals and signal positions, and build
+        # the coverage arrays after we've seen all of the reads
+        cov_starts = dict((s, []) for s in '+-.')
+        cov_stops = dict((s, []) for s in '+-.')
+        signal_poss = dict((s, []) for s in '+-.')
+        signal_weights = dict((s, []) for s in '+-.')
+        for read, rd_strand in reads.iter_reads_and_strand(
+                self.chrm, r_start, r_stop+1):
+            # break if we've surpassed the read
+            if read.pos > r_stop: break
+            
+            self.num_obs_reads += 1
+            if self.num_obs_reads%100000 == 0:
+                config.log_statement("Processed %i reads in %s" % (
+                    self.num_obs_reads, str(
+                        (self.chrm, self.strand, r_start, r_stop))))
+            
+            for jn in junctions.iter_jns_in_read(read):
+                # skip jns whose start does not overlap this region, we 
+                # subtract one because the start refers to the first 
+                # covered intron base, and we are talking about covered regions
+                if jn[0]-1 < r_start or jn[0]-1 > r_stop: continue
+                self.jn_reads[rd_strand][jn] += 1
+            
+            # if this is an anti-strand read, then we only care about the jns
+            if ( self.strand != '.' and rd_strand != '.' 
+                 and rd_strand != self.strand ): 
+                continue
+            
+            cov_regions = tuple(iter_coverage_intervals_for_read(read))
+            if not use_cached_cov:
+                for start, stop in cov_regions:
+                    cov_starts[rd_strand].append(start)
+                    cov_stops[rd_strand].append(stop)
+            
+            if not signal_is_read_cov and not use_cached_cov:
+                for sig_strand, pos, weight in reads.iter_signal_for_read(
+                        read):
+                    signal_poss[sig_strand].append(pos)
+                    signal_weights[sig_strand].append(weight)
+            
+            if read.pos <= prev_r_stop: continue
+            
+            # -probability that the read originated in this location
+            # if we can't find it, assume that it's uniform over alternate
+            # mappings. If we can't find that, then assume that it's unique
+            map_prb = get_rd_posterior_prb(read)
+            self.num_unique_reads += (
+                map_prb/2. if read.is_paired else map_prb )
+            
+            # store the read data - we will join them later
+            try: read_grp = read.opt('RG')
+            except KeyError: read_grp = 'mean'
+            self.read_data.add(
+                read.qname, read.is_read1, rd_strand, read_grp, map_prb, 
+                read.inferred_length, cov_regions)
+        
+        # only add coverage in this region, so that reads which span 
+        # multiple regions aren't double counted
+        if use_cached_cov:
+            self._add_cached_coverage_in_region(reads, r_start, r_stop)
+            return
+        r_slice = slice(r_start-self.start, r_stop-self.start+1)
+        for strand in '+-.':
+            self.cov[strand][r_slice] += build_coverage_from_intervals(
+                cov_starts[strand], cov_stops[strand], r_start, r_stop)
+            if not signal_is_read_cov:
+                self.signal_cov[strand][r_slice] += \
+                    build_coverage_from_positions(
+                        signal_poss[strand], r_start, r_stop, 
+                        signal_weights[strand])
+        
+        return
+    
+    def _add_cached_coverage_in_region(self, reads, r_start, r_stop):
+        r_slice = slice(r_start-self.start, r_stop-self.start+1)
+        # anti-strand reads don't contribute coverage to the summary
+        strands = '+-.' if self.strand == '.' else self.strand + '.'
+        for strand in strands:
+            self.cov[strand][r_slice] += \
+                reads.coverage_cache.find_read_coverage(
+                    self.chrm, strand, r_start, r_stop)
+            if not reads.signal_is_read_coverage:
+                self.signal_cov[strand][r_slice] += \
+                    reads.coverage_cache.find_signal_coverage(
+                        self.chrm, strand, r_start, r_stop)
+        return
+    
+    def find_jns(self, strand):
+        """Return the junction counts for strand, including unstranded reads.
+        
+        """
+        jns = defaultdict(int, self.jn_reads[strand])
+        for jn, cnt in self.jn_reads['.'].iteritems():
+            jns[jn] += cnt
+        return jns
+    
+    def find_read_coverage(self, strand):
+        """Return the read coverage for strand, including unstranded reads.
+        
+        """
+        return self.cov[strand] + self.cov['.']
+    
+    def build_read_coverage_array( self, chrm, strand, 
+                                   start, stop, read_pair=None ):
+        assert read_pair == None
+        assert clean_chr_name(chrm) == clean_chr_name(self.chrm)
+        assert start >= self.start and stop <= self.stop, \
+            "Region (%i, %i) is not in the read summary" % (start, stop)
+        cvg = self.signal_cov['.'][start-self.start:stop-self.start+1].copy()
+        for sig_strand in ('+-' if strand == '.' else strand):
+            cvg += self.signal_cov[sig_strand][
+                start-self.start:stop-self.start+1]
+        return cvg
+    
+    def find_paired_reads(self):
+        """Pair the reads in the summary - see pair_reads.
+
+        """
+        if self._paired_reads is None:
+            self._paired_reads = pair_reads(self.read_data)
+        return self._paired_reads
+    
+    def iter_paired_read_data(self, fl_dist=None):
+        return iter_paired_reads(self.read_data, fl_dist)
+    
+    def find_fragment_lengths(self):
+        """Count the fragment lengths of uniquely mapping read pairs.
+        
+        Counts are keyed by (read group, (read 1 length, read 2 length)).
+        """
+        rd = self.read_data
+        # find the reads whose qname is unique within the first or second 
+        # reads. If there are multiple mappings, or the read isn't paired, 
+        # then we don't use it for fragment length estimation
+        def find_unique_reads(indices):
+            qname_ids, first_indices, cnts = numpy.unique(
+                rd.qname_id[indices], return_index=True, return_counts=True)
+            indices = indices[first_indices[cnts == 1]]
+            return indices[rd.map_prb[indices] == 1.0]
+        r1_indices = find_unique_reads(numpy.nonzero(rd.is_read1)[0])
+        r2_indices = find_unique_reads(numpy.nonzero(~rd.is_read1)[0])
+        
+        qname_ids, r1_i, r2_i = numpy.intersect1d(
+            rd.qname_id[r1_indices], rd.qname_id[r2_indices], 
+            assume_unique=True, return_indices=True)
+        r1_indices, r2_indices = r1_indices[r1_i], r2_indices[r2_i]
+        assert ( rd.read_grp[r1_indices] == rd.read_grp[r2_indices] ).all()
+        
+        frag_lens = rd.calc_frag_lens(r1_indices, r2_indices)
+        
+        fragment_lengths = defaultdict(lambda: defaultdict(int))
+        if len(frag_lens) == 0: return fragment_lengths
+        keys, cnts = numpy.unique(numpy.vstack((
+            rd.read_grp[r1_indices], rd.read_len[r1_indices], 
+            rd.read_len[r2_indices], frag_lens)).T, 
+                                  axis=0, return_counts=True)
+        for (read_grp, r1_len, r2_len, frag_len), cnt in zip(keys, cnts):
+            fl_key = (rd.read_grps[read_grp], (int(r1_len), int(r2_len)))
+            # we add 1 for each read because we know that it is unique
+            fragment_lengths[fl_key][int(frag_len)] += float(cnt)
+        return fragment_lengths
+
+# the size of the windows in the bam index's linear index
+BAM_INDEX_WINDOW_SIZE = 16384
+BAM_INDEX_PSEUDO_BIN = 37450
+
+def parse_bai_window_offsets(data):
+    """Parse the linear index of each contig from the contents of a .bai.
+
+    returns a list, with an entry for each contig, of (window size, 
+    window offsets, max offset) where the window offsets are the virtual 
+    file offsets of the first read that overlaps each window, and max 
+    offset is the largest offset of a read in the contig.
+    """
+    if data[:4] != "BAI\1": 
+        raise ValueError, "This is not a .bai index"
+    
+    def read_ints(dtype, offset, n):
+        return numpy.frombuffer(data, dtype=dtype, count=n, offset=offset)
+    
+    rv = []
+    offset = 4
+    n_ref = int(read_ints('<i4', offset, 1)[0])
+    offset += 4
+    for ref_i in xrange(n_ref):
+        # skip the binning index, but keep track of the last read's offset
+        max_offset = 0
+        n_bin = int(read_ints('<i4', offset, 1)[0])
+        offset += 4
+        for bin_i in xrange(n_bin):
+            bin_id = int(read_ints('<u4', offset, 1)[0])
+            n_chunk = int(read_ints('<i4', offset+4, 1)[0])
+            offset += 8
+            # the pseudo bin stores the contig's offsets and read counts
+            if n_chunk > 0 and bin_id != BAM_INDEX_PSEUDO_BIN:
+                chunks = read_ints('<u8', offset, 2*n_chunk)
+                max_offset = max(max_offset, int(chunks[1::2].max()))
+            offset += 16*n_chunk
+        n_intv = int(read_ints('<i4', offset, 1)[0])
+        offset += 4
+        rv.append( (BAM_INDEX_WINDOW_SIZE, 
+                    read_ints('<u8', offset, n_intv), max_offset) )
+        offset += 8*n_intv
+    
+    return rv
+
+def parse_csi_window_offsets(data):
+    """Parse the window offsets of each contig from the contents of a .csi.
+
+    A .csi doesn't have a linear index, but every bin stores the offset of
+    the first read that overlaps it, so we use the smallest bins ( which are
+    2**min_shift bases long ) as the windows. The data should already be 
+    decompressed. See parse_bai_window_offsets for the return value.
+    """
+    if data[:4] != "CSI\1": 
+        raise ValueError, "This is not a .csi index"
+    
+    def read_ints(dtype, offset, n):
+        return numpy.frombuffer(data, dtype=dtype, count=n, offset=offset)
+    
+    min_shift, depth, l_aux = [int(x) for x in read_ints('<i4', 4, 3)]
+    offset = 16 + l_aux
+    first_leaf_bin = ((1 << 3*depth) - 1)//7
+    pseudo_bin = ((1 << 3*(depth+1)) - 1)//7 + 1
+    
+    rv = []
+    n_ref = int(read_ints('<i4', offset, 1)[0])
+    offset += 4
+    for ref_i in xrange(n_ref):
+        max_offset = 0
+        leaf_offsets = {}
+        n_bin = int(read_ints('<i4', offset, 1)[0])
+        offset += 4
+        for bin_i in xrange(n_bin):
+            bin_id = int(read_ints('<u4', offset, 1)[0])
+            loffset = int(read_ints('<u8', offset+4, 1)[0])
+            n_chunk = int(read_ints('<i4', offset+12, 1)[0])
+            offset += 16
+            if n_chunk > 0 and bin_id != pseudo_bin:
+                chunks = read_ints('<u8', offset, 2*n_chunk)
+                max_offset = max(max_offset, int(chunks[1::2].max()))
+                if bin_id >= first_leaf_bin:
+                    leaf_offsets[bin_id - first_leaf_bin] = loffset
+            offset += 16*n_chunk
+        
+        # windows without a bin of their own get a 0 offset, like the empty
+        # windows of a linear index
+        ioffsets = numpy.zeros(
+            max(leaf_offsets)+1 if len(leaf_offsets) > 0 else 0, 
+            dtype=numpy.uint64)
+        for window_i, loffset in leaf_offsets.iteritems():
+            ioffsets[window_i] = loffset
+        rv.append( (1 << min_shift, ioffsets, max_offset) )
+    
+    return rv
+
+def estimate_read_density_from_index( reads, est_compression_ratio=3.0 ):
+    """Estimate the read density along each contig from the bam index.
+
+    The linear index of a .bai file stores the virtual file offset of the
+    first read that overlaps each BAM_INDEX_WINDOW_SIZE window, so the
+    difference between successive offsets estimates the number of bytes
+    of reads in each window ( the compressed offsets are scaled by
+    est_compression_ratio ). A .csi stores the same offsets for each of its
+    smallest bins, which are resampled to BAM_INDEX_WINDOW_SIZE windows. 
+    This is only used for load balancing, so it doesn't need to be exact, 
+    but it is free to compute.
+
+    returns a dict, keyed by the cleaned contig name, of arrays with one
+    density per window, or None if the bam doesn't have a .bai or .csi 
+    index. Raises a ValueError if the index is neither.
+    """
+    fname = reads.filename
+    for index_fname in (fname + ".bai", os.path.splitext(fname)[0] + ".bai",
+                        fname + ".csi", os.path.splitext(fname)[0] + ".csi"):
+        if os.path.exists(index_fname): break
+    else:
+        return None
+    
+    if index_fname.endswith(".csi"):
+        # a .csi is bgzf compressed, which is a valid multi-member gzip file
+        with gzip.open(index_fname, "rb") as fp:
+            data = fp.read()
+        parse_window_offsets = parse_csi_window_offsets
+    else:
+        with open(index_fname, "rb") as fp:
+            data = fp.read()
+        parse_window_offsets = parse_bai_window_offsets
+    try: 
+        all_window_offsets = parse_window_offsets(data)
+    except ValueError, inst:
+        raise ValueError, "Can't read the bam index '%s': %s" % (
+            index_fname, inst)
+    
+    densities = {}
+    for ref_i, (window_size, ioffsets, max_offset) in enumerate(
+            all_window_offsets):
+        # empty windows may store a 0 offset, so fill them in with the
+        # offset of the previous window
+        ioffsets = numpy.maximum.accumulate(
+            numpy.append(ioffsets, numpy.uint64(max_offset)))
+        # but the reads after an empty window start in a later window, so 
+        # give each run of repeated offsets the offset that follows it
+        is_repeat = numpy.append(False, ioffsets[1:] == ioffsets[:-1])
+        for window_i in reversed(numpy.flatnonzero(is_repeat[:-1])):
+            ioffsets[window_i] = ioffsets[window_i+1]
+        est_pos = ( (ioffsets >> numpy.uint64(16)).astype(float)
+                    *est_compression_ratio
+                    + (ioffsets & numpy.uint64(0xFFFF)).astype(float) )
+        density = numpy.clip(numpy.diff(est_pos), 0, None)
+        # resample the windows by interpolating the cumulative density
+        if window_size != BAM_INDEX_WINDOW_SIZE:
+            length = len(density)*window_size
+            bnds = numpy.arange(
+                0, length + BAM_INDEX_WINDOW_SIZE, BAM_INDEX_WINDOW_SIZE)
+            density = numpy.diff(numpy.interp(
+                bnds, numpy.arange(len(density)+1)*window_size, 
+                numpy.append(0, density.cumsum())))
+        densities[clean_chr_name(reads.references[ref_i])] = density
+
+    return densities
+
 def get_contigs_and_lens( reads_files ):
     """Get contigs and their lengths from a set of bam files.
     
@@ -532,6 +1047,16 @@ class MergedReads( object ):
         
         return cvg
 
+    def set_coverage_cache( self, cache_dir ):
+        for reads in self._reads:
+            reads.set_coverage_cache(cache_dir)
+        return self
+    
+    def populate_coverage_cache( self, contigs=None, nthreads=1 ):
+        for reads in self._reads:
+            reads.coverage_cache.populate(contigs, nthreads)
+        return
+    
     def reload( self ):
         new_reads = MergedReads([ reads.reload() for reads in self._reads ])
         new_reads.fl_dists = self.fl_dists
@@ -621,6 +1146,20 @@ class Reads( pysam.Samfile ):
     def is_indexed( self ):
         return True
     
+    # whether the signal for this read type is the read coverage. If not,
+    # then iter_signal_for_read defines the signal that each read provides
+    signal_is_read_coverage = True
+
+    # the CoverageCache to serve coverage arrays from - see set_coverage_cache
+    coverage_cache = None
+    
+    def iter_signal_for_read(self, read):
+        """Iterate over (strand, pos, weight) tuples of the read's signal.
+
+        """
+        raise NotImplementedError, \
+            "Reads whose signal isn't the read coverage must define iter_signal_for_read"
+    
     def get_strand(self, read):
         if self.reads_are_stranded:
             return get_strand( 
@@ -683,20 +1222,74 @@ class Reads( pysam.Samfile ):
 
         return
 
-    def build_read_coverage_array( self, chrm, strand, 
+    def set_coverage_cache( self, cache_dir ):
+        """Serve coverage arrays from an on disk cache in cache_dir.
+
+        The cache for each contig is built the first time that it's needed,
+        or by a call to self.coverage_cache.populate().
+        """
+        self.coverage_cache = CoverageCache(self, cache_dir)
+        return self
+
+    def build_strand_coverage_arrays( self, chrm, start, stop ):
+        """Build the read and signal coverage in start-stop for each strand.
+
+        returns dicts, keyed by the read strand, of the read coverage and
+        ( if the signal isn't the read coverage ) the signal coverage.
+        """
+        assert stop >= start
+        cov_starts = dict((s, []) for s in '+-.')
+        cov_stops = dict((s, []) for s in '+-.')
+        signal_poss = dict((s, []) for s in '+-.')
+        signal_weights = dict((s, []) for s in '+-.')
+        for rd, rd_strand in self.iter_reads_and_strand(chrm, start, stop+1):
+            for block_start, block_stop in iter_coverage_intervals_for_read(rd):
+                cov_starts[rd_strand].append(block_start)
+                cov_stops[rd_strand].append(block_stop)
+            if self.signal_is_read_coverage: continue
+            for sig_strand, pos, weight in self.iter_signal_for_read(rd):
+                signal_poss[sig_strand].append(pos)
+                signal_weights[sig_strand].append(weight)
+
+        cov = dict((s, build_coverage_from_intervals(
+                    cov_starts[s], cov_stops[s], start, stop)) for s in '+-.')
+        if self.signal_is_read_coverage:
+            return cov, {}
+        signal = dict((s, build_coverage_from_positions(
+                    signal_poss[s], start, stop, signal_weights[s]))
+                      for s in '+-.')
+        return cov, signal
+
+    def build_read_coverage_array( self, chrm, strand,
                                    start, stop, read_pair=None ):
+        if self.coverage_cache != None and read_pair == None:
+            return self.coverage_cache.build_read_coverage_array(
+                chrm, strand, start, stop)
+
         assert stop >= start
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
-        for rd in self.iter_reads( chrm, strand, start, stop ):
+        if not self.signal_is_read_coverage:
+            assert read_pair == None
+            poss, weights = [], []
+            for rd in self.fetch( chrm, start, stop+1 ):
+                for rd_strand, pos, weight in self.iter_signal_for_read(rd):
+                    # skip sites that aren't on the requested strand. Sites
+                    # outside of the requested range are skipped when we
+                    # build the coverage array
+                    if strand != rd_strand: continue
+                    poss.append(pos)
+                    weights.append(weight)
+            return build_coverage_from_positions(poss, start, stop, weights)
+
+        cov_starts, cov_stops = [], []
+        for rd in self.iter_reads( chrm, strand, start, stop+1 ):
             if read_pair != None:
                 if read_pair==1 and not rd.is_read1: continue
                 if read_pair==2 and not rd.is_read2: continue
-            for region in iter_coverage_regions_for_read( 
-                    rd, self, self.RRR, self.PAOS):
-                cvg[max(0, region[2]-start):max(0, region[3]-start)] += 1
-        
-        return cvg
+            for block_start, block_stop in iter_coverage_intervals_for_read(rd):
+                cov_starts.append(block_start)
+                cov_stops.append(block_stop)
+
+        return build_coverage_from_intervals(cov_starts, cov_stops, start, stop)
 
     def build_paired_reads_fragment_coverage_array( 
             self, chrm, strand, start, stop ):
@@ -741,6 +1334,8 @@ class Reads( pysam.Samfile ):
         reads.init(**kw_args)
         reads.fl_dists = fl_dists
         reads.num_reads = num_reads
+        if self.coverage_cache != None:
+            reads.set_coverage_cache(self.coverage_cache.cache_dir)
         return reads
 
 class RNAseqReads(Reads):    
@@ -853,28 +1448,21 @@ class CAGEReads(Reads):
         
         return self
     
-    def build_read_coverage_array( self, chrm, strand, start, stop, 
-                                   read_pair=None ):
-        assert read_pair == None
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
-        for rd in self.fetch( chrm, start, stop ):
-            #assert not rd.is_paired
-            if rd.mapq <= 1: continue
-            rd_strand = '-' if rd.is_reverse else '+'
-            if self.reverse_read_strand:
-                rd_strand = '+' if rd_strand == '-' else '-'
-            if strand != rd_strand: continue
-            if strand == '-':
-                peak_pos = max(rd.pos, rd.aend-1)
-            else:
-                peak_pos = min(rd.pos, rd.aend-1)
-            if peak_pos < start or peak_pos > stop:
-                continue
-            
-            cvg[peak_pos-start] += get_rd_posterior_prb(rd)
-        return cvg
-
+    signal_is_read_coverage = False
+    
+    def iter_signal_for_read(self, rd):
+        #assert not rd.is_paired
+        if rd.mapq <= 1: return
+        rd_strand = '-' if rd.is_reverse else '+'
+        if self.reverse_read_strand:
+            rd_strand = '+' if rd_strand == '-' else '-'
+        if rd_strand == '-':
+            peak_pos = max(rd.pos, rd.aend-1)
+        else:
+            peak_pos = min(rd.pos, rd.aend-1)
+        yield rd_strand, peak_pos, get_rd_posterior_prb(rd)
+        return
+    
 class RAMPAGEReads(Reads):
     def init(self, reverse_read_strand, pairs_are_opp_strand=None,
              reads_are_paired=True, ref_genes=None ):
@@ -917,30 +1505,22 @@ class RAMPAGEReads(Reads):
         
         return self
     
-    def build_read_coverage_array( self, chrm, strand, start, stop,
-                                   read_pair=None ):
-        assert read_pair == None
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
-        for rd in self.fetch( chrm, start, stop ):
-            #assert not rd.is_paired
-            if rd.mapq <= 1: continue
-            if not rd.is_read1: continue
-            rd_strand = '-' if rd.is_reverse else '+'
-            if self.reverse_read_strand:
-                rd_strand = '+' if rd_strand == '-' else '-'            
-            if strand != rd_strand: continue
-            peak_pos = rd.pos
-            if strand == '-':
-                peak_pos = max(rd.pos, rd.aend-1)
-            else:
-                peak_pos = min(rd.pos, rd.aend-1)
-            if peak_pos < start or peak_pos > stop:
-                continue
-            cvg[peak_pos-start] += get_rd_posterior_prb(rd)
-        
-        return cvg
-
+    signal_is_read_coverage = False
+    
+    def iter_signal_for_read(self, rd):
+        #assert not rd.is_paired
+        if rd.mapq <= 1: return
+        if not rd.is_read1: return
+        rd_strand = '-' if rd.is_reverse else '+'
+        if self.reverse_read_strand:
+            rd_strand = '+' if rd_strand == '-' else '-'            
+        if rd_strand == '-':
+            peak_pos = max(rd.pos, rd.aend-1)
+        else:
+            peak_pos = min(rd.pos, rd.aend-1)
+        yield rd_strand, peak_pos, get_rd_posterior_prb(rd)
+        return
+    
 
 class PolyAReads(Reads):
     def init(self, reverse_read_strand=None, pairs_are_opp_strand=None, 
@@ -981,38 +1561,29 @@ class PolyAReads(Reads):
         
         return self
     
-    def build_read_coverage_array( self, chrm, strand, start, stop,
-                                   read_pair=None ):
-        assert read_pair == None
+    signal_is_read_coverage = False
+    
+    def iter_signal_for_read(self, rd):
+        # skip the read pair which doesn't contain a poly(a) site
+        if rd.is_paired and (
+                (rd.is_read2 and self.reverse_read_strand)
+                or (rd.is_read1 and not self.reverse_read_strand)
+            ): 
+            return
         
-        full_region_len = stop - start + 1
-        cvg = numpy.zeros(full_region_len)
-        for rd in self.fetch( chrm, start, stop ):
-            # skip the read pair which doesn't contain a poly(a) site
-            if rd.is_paired and (
-                    (rd.is_read2 and self.reverse_read_strand)
-                    or (rd.is_read1 and not self.reverse_read_strand)
-                ): 
-                continue
-            
-            # determine the strand of the poly(A) site
-            rd_strand = self.get_strand(rd)
-            
-            # determine which pos of the read corresponds to the 
-            # poly(a) site
-            if rd_strand == '+': 
-                pos = max(rd.pos, rd.aend-1)
-            else: 
-                pos = min(rd.pos, rd.aend-1)
-            
-            # skip sites that aren't within the requested range
-            if strand != rd_strand: continue
-            if pos < start or pos > stop: continue
-            
-            cvg[pos-start] += get_rd_posterior_prb(rd)
+        # determine the strand of the poly(A) site
+        rd_strand = self.get_strand(rd)
         
-        return cvg
-
+        # determine which pos of the read corresponds to the 
+        # poly(a) site
+        if rd_strand == '+': 
+            pos = max(rd.pos, rd.aend-1)
+        else: 
+            pos = min(rd.pos, rd.aend-1)
+        
+        yield rd_strand, pos, get_rd_posterior_prb(rd)
+        return
+    
 class ChIPSeqReads(Reads):
     def __repr__(self):
         paired = 'paired' if self.reads_are_paired else 'unpaired'
@@ -21,11 +21,14 @@ import sys, os
 import time
 import math
 import traceback
+import heapq
+import tempfile
 
 import shutil
 
 import numpy
 from scipy.stats import beta, binom
+from scipy.special import betaincinv
 
 from collections import defaultdict, namedtuple
 from itertools import chain, izip
@@ -45,13 +48,17 @@ from genes import (
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
     fix_chrm_name_for_ucsc, get_contigs_and_lens, \
-    iter_paired_reads, extract_jns_and_reads_in_region
+    iter_paired_reads, ReadSummary
 import files.junctions
 from files.bed import create_bed_line
 from files.gtf import parse_gtf_line, load_gtf
 
 from peaks import call_peaks, build_control_in_gene
 
+from splice_graph import (
+    SpliceGraph, labels_to_bitmask, bitmask_to_labels,
+    SEGMENT, TSS, TES, ADJACENT, SPLICE, TSS_EDGE, TES_EDGE )
+
 from elements import find_jn_connected_exons
 
 from frag_len import FlDist, find_fls_from_annotation
@@ -64,19 +71,6 @@ frequency_estimation.PARAM_ABS_TOL = 1e-3
 
 import config
 
-class ThreadSafeFile( file ):
-    def __init__( self, *args ):
-        args = list( args )
-        args.insert( 0, self )
-        file.__init__( *args )
-        self.lock = multiprocessing.Lock()
-
-    def write( self, line ):
-        with self.lock:
-            file.write( self, line )
-            self.flush()
-
-
 def filter_exon(exon, wig, num_start_bases_to_skip=0, num_stop_bases_to_skip=0):
     '''Find all the exons that are sufficiently homogenous and expressed.
     
@@ -112,9 +106,6 @@ def reverse_strand(bins_iter, contig_len):
         rev_bins.append( bin.reverse_strand( contig_len ) )
     return rev_bins
 
-class SpliceGraph(nx.DiGraph):
-    pass
-
 def find_cage_peak_bins_in_gene( gene, cage_reads, rnaseq_reads ):
     rnaseq_cov = gene.find_coverage( rnaseq_reads )
     print rnaseq_cov
@@ -412,27 +403,26 @@ def find_transcribed_fragments_covering_region(
         while len(partial_paths) > 0:
             curr_path, curr_path_len = partial_paths.pop()
             if side == 'BEFORE':
-                neighbors = list(
-                    segment_graph.predecessors(curr_path[0]))
+                neighbors = segment_graph.predecessors(curr_path[0]).tolist()
             else:
-                neighbors = list(
-                    segment_graph.successors(curr_path[-1]))
+                neighbors = segment_graph.successors(curr_path[-1]).tolist()
             if len(neighbors) == 0: 
                 complete_paths.append((curr_path, curr_path_len))
             else:
                 for child in neighbors:
-                    if segment_graph.node[child]['type'] in ('TSS', 'TES'):
+                    if segment_graph.node_types[child] in (TSS, TES):
                         complete_paths.append((curr_path, curr_path_len))
                         continue
-                    assert segment_graph.node[child]['type'] == 'segment'
+                    assert segment_graph.node_types[child] == SEGMENT
                     
                     if side == 'BEFORE':
                         new_path = [child,] + curr_path
                     else:
                         new_path = curr_path + [child,]
                     
-                    new_path_len = ( 
-                        segment_graph.node[child]['bin'].length()+curr_path_len)
+                    new_path_len = ( segment_graph.stops[child] 
+                                     - segment_graph.starts[child] + 1
+                                     + curr_path_len )
                     if new_path_len >= max_frag_len:
                         complete_paths.append((new_path, new_path_len))
                     else:
@@ -472,90 +462,19 @@ def find_transcribed_fragments_covering_region(
     return transcripts
 
 def extract_jns_and_paired_reads_in_gene(gene, reads):
-    pair1_reads = defaultdict(list)
-    pair2_reads = defaultdict(list)
-    plus_jns = defaultdict(int)
-    minus_jns = defaultdict(int)
-    
-    for region in gene.regions:
-        ( r_pair1_reads, r_pair2_reads, r_plus_jns, r_minus_jns, 
-          ) = extract_jns_and_reads_in_region(
-            (gene.chrm, gene.strand, region.start, region.stop), reads)
-        for jn, cnt in r_plus_jns.iteritems(): 
-            plus_jns[jn] += cnt 
-        for jn, cnt in r_minus_jns.iteritems(): 
-            minus_jns[jn] += cnt 
-        for qname, read_mappings in r_pair1_reads.iteritems(): 
-            pair1_reads[qname].extend(read_mappings)
-        for qname, read_mappings in r_pair2_reads.iteritems(): 
-            pair2_reads[qname].extend(read_mappings)
-
-    paired_reads = list(iter_paired_reads(pair1_reads, pair2_reads))
+    if not isinstance(reads, ReadSummary):
+        reads = gene.summarize_reads(reads)
+    
+    paired_reads = reads.find_paired_reads()
+    plus_jns, minus_jns = reads.find_jns('+'), reads.find_jns('-')
     jns, opp_strand_jns = (
         (plus_jns, minus_jns) if gene.strand == '+' else (minus_jns, plus_jns)) 
     return paired_reads, jns, opp_strand_jns
 
 def find_widest_path(splice_graph):
+    # the widest path filter is disabled, so the expression threshold is
+    # always config.MIN_EXON_FPKM
     return None, 0
-    try: 
-        tss_max = max(data['bin'].fpkm_lb
-                      for node, data in splice_graph.nodes(data=True)
-                      if data['type'] == 'TSS')
-    except:
-        tss_max = 0
-    try:
-        tes_max = max(data['bin'].fpkm_lb
-                      for node, data in splice_graph.nodes(data=True)
-                      if data['type'] == 'TES')
-    except:
-        tes_max = 0
-    return None, max(tss_max, tss_max)
-
-    splice_graph = copy(splice_graph)
-    assert nx.is_directed_acyclic_graph(splice_graph)
-    config.log_statement("Finding widest path")
-    curr_paths = [ [[node,], data['bin'].fpkm, data['bin'].fpkm] 
-                  for node, data in splice_graph.nodes(data=True)
-                  if data['type'] == 'TSS']
-    max_path = None
-    max_min_fpkm = min( x[1] for x in curr_paths )/10. if len(curr_paths) > 0 else 0
-    while len(curr_paths) > 0:
-        # find a path to check
-        curr_path, curr_fpkm, prev_fpkm = curr_paths.pop()
-        # if the paths fpkm is less than the maximum,
-        # then there is no need to consider anything else
-        if curr_fpkm < max_min_fpkm: continue
-        successors = splice_graph.successors(curr_path[-1])
-
-        # if there are no successors, then still allow this path
-        # to contribute in case we cant build a full path
-        # (e.g. there are no TES sites)
-        if len(successors) == 0:
-            if max_min_fpkm < curr_fpkm:
-                max_path = curr_path
-                max_min_fpkm = curr_fpkm
-
-        config.log_statement("%i paths in queue (%e, %e, %i, %i)" % (
-            len(curr_paths), max_min_fpkm, prev_fpkm, 
-            len(successors), len([x for x, data in splice_graph.nodes(data=True)
-                                  if data['bin'].fpkm > max_min_fpkm])))
-            
-        # otherwise, build new paths and update the fpkms            
-        for successor in successors:
-            bin = splice_graph.node[successor]['bin']
-            new_path = curr_path + [successor,]
-            new_fpkm = min(bin.fpkm, curr_fpkm)
-            if new_fpkm < max_min_fpkm: 
-                splice_graph.remove_node(successor)
-                continue
-            if bin.type == 'POLYA':
-                if new_fpkm > max_min_fpkm:
-                    max_path = new_path
-                    max_min_fpkm = new_fpkm
-            else:
-                curr_paths.append((new_path, new_fpkm, bin.fpkm))
-        curr_paths.sort(key=lambda x:len(x[0]))
-    return max_path, max_min_fpkm
 
 def build_splice_graph_and_binned_reads_in_gene( 
         gene, 
@@ -584,11 +503,12 @@ def build_splice_graph_and_binned_reads_in_gene(
     # add in connectivity junctions
     for distal_reads in (tss_reads, tes_reads):
         if distal_reads == None: continue
-        for jn, cnt, entropy in files.junctions.load_junctions_in_bam(
-              distal_reads, 
-              [ (gene.chrm, gene.strand, r.start, r.stop) for r in gene.regions]
-              )[(gene.chrm, gene.strand)]:
-            jns[jn] += 0
+        if not isinstance(distal_reads, ReadSummary):
+            distal_reads = gene.summarize_reads(distal_reads)
+        # only add jns that are contained in a single gene region
+        for (start, stop) in distal_reads.find_jns(gene.strand):
+            if any(r.start <= start and stop <= r.stop for r in gene.regions):
+                jns[(start, stop)] += 0
     
     # add in reference junctions
     for jn in ref_elements['introns']: jns[jn] += observed_jns[jn]
@@ -650,7 +570,6 @@ def build_splice_graph_and_binned_reads_in_gene(
                 peak_cov,
                 ).set_tpm(tes_reads.num_reads))
     
-    splice_graph = SpliceGraph()
     tss_segment_map = {}
     for tss_bin in tss_regions:
         tss_start = tss_bin.start if gene.strand == '+' else tss_bin.stop + 1
@@ -681,58 +600,97 @@ def build_splice_graph_and_binned_reads_in_gene(
         if in_empty_region:
             empty_segments.add(index)
 
-    # build the exon segment connectivity graph
+    # build the exon segment connectivity graph. Segment nodes are numbered
+    # in genome order, skipping the empty segments, followed by the TSS 
+    # and then the TES nodes
     segment_bnds = numpy.array(sorted(segment_bnds))
+    n_segments = len(segment_bnds)-1
+    is_empty = numpy.zeros(n_segments, dtype=bool)
+    is_empty[list(empty_segments)] = True
+    segment_nodes = numpy.cumsum(~is_empty) - 1
+    segment_nodes[is_empty] = -1
+    n_segment_nodes = int((~is_empty).sum())
+    segment_is = numpy.flatnonzero(~is_empty)
     
-    for element_i in (x for x in xrange(0, len(segment_bnds)-1) 
-                      if x not in empty_segments):
-        start, stop = segment_bnds[element_i], segment_bnds[element_i+1]-1
-        left_labels = segment_bnd_labels[start]
-        right_labels = segment_bnd_labels[stop+1]
-        bin = SegmentBin( start, stop, left_labels, right_labels, type=None)
-        splice_graph.add_node(element_i, type='segment', bin=bin)
-    
-    for i in xrange(len(segment_bnds)-1-1):
-        if i not in empty_segments and i+1 not in empty_segments:
-            if gene.strand == '+':
-                splice_graph.add_edge(i, i+1, type='adjacent', bin=None)
-            else:
-                splice_graph.add_edge(i+1, i, type='adjacent', bin=None)
+    bnd_label_masks = dict( 
+        (bnd, labels_to_bitmask(labels))
+        for bnd, labels in segment_bnd_labels.iteritems() )
+    node_types = [SEGMENT,]*n_segment_nodes
+    starts = segment_bnds[segment_is].tolist()
+    stops = (segment_bnds[segment_is+1]-1).tolist()
+    left_labels = [ bnd_label_masks.get(start, 0) for start in starts ]
+    right_labels = [ bnd_label_masks.get(stop+1, 0) for stop in stops ]
+    
+    edge_srcs, edge_dsts, edge_types, edge_cnts = [], [], [], []
+    def add_edge(src, dst, edge_type, cnt=0):
+        edge_srcs.append(src)
+        edge_dsts.append(dst)
+        edge_types.append(edge_type)
+        edge_cnts.append(cnt)
+    
+    for i in numpy.flatnonzero(~is_empty[:-1] & ~is_empty[1:]):
+        if gene.strand == '+':
+            add_edge(segment_nodes[i], segment_nodes[i+1], ADJACENT)
+        else:
+            add_edge(segment_nodes[i+1], segment_nodes[i], ADJACENT)
 
-    jn_edges = []
-    for (start, stop), cnt in jns.iteritems():
+    for (start, stop), cnt in sorted(jns.iteritems()):
         start_i = segment_bnds.searchsorted(start)-1
         assert segment_bnds[start_i+1] == start
         stop_i = segment_bnds.searchsorted(stop+1)-1+1
         assert segment_bnds[stop_i] == stop+1
-        assert start_i in splice_graph
+        assert segment_nodes[start_i] >= 0
         # skip junctions that splice to the last base in the gene XXX
-        if stop_i == splice_graph.number_of_nodes(): continue
-        assert stop_i in splice_graph, str((stop_i, splice_graph.nodes(data=True)))
+        if stop_i == n_segment_nodes: continue
+        assert stop_i < n_segments and segment_nodes[stop_i] >= 0, \
+            str((stop_i, segment_bnds))
         if gene.strand == '+':
-            bin = SegmentBin( start, stop, 'D_JN', 'R_JN', type='INTRON', cnt=cnt)
-            splice_graph.add_edge(start_i, stop_i, type='splice', bin=bin)
+            add_edge(segment_nodes[start_i], segment_nodes[stop_i], 
+                     SPLICE, cnt)
         else:
-            bin = SegmentBin( start, stop, 'R_JN', 'D_JN', type='INTRON', cnt=cnt)
-            splice_graph.add_edge(stop_i, start_i, type='splice', bin=bin)
-
-    for i, (tss_bin, tss_segments) in enumerate(tss_segment_map.iteritems()):
-        node_id = "TSS_%i" % i
-        splice_graph.add_node( node_id, type='TSS', bin=tss_bin)
+            add_edge(segment_nodes[stop_i], segment_nodes[start_i], 
+                     SPLICE, cnt)
+    
+    node_bins = {}
+    for tss_bin, tss_segments in tss_segment_map.iteritems():
+        node_id = len(node_types)
+        node_types.append(TSS)
+        starts.append(tss_bin.start)
+        stops.append(tss_bin.stop)
+        left_labels.append(0)
+        right_labels.append(0)
+        node_bins[node_id] = tss_bin
         for tss_start in tss_segments:
             bin_i = segment_bnds.searchsorted(tss_start)
             assert segment_bnds[bin_i] == tss_start
             if gene.strand == '-': bin_i -= 1
-            splice_graph.add_edge(node_id, bin_i, type='tss', bin=None)
+            assert segment_nodes[bin_i] >= 0
+            add_edge(node_id, segment_nodes[bin_i], TSS_EDGE)
     
-    for i, (tes_bin, tes_segments) in enumerate(tes_segment_map.iteritems()):
-        node_id = "TES_%i"% i
-        splice_graph.add_node( node_id, type='TES', bin=tes_bin)
+    for tes_bin, tes_segments in tes_segment_map.iteritems():
+        node_id = len(node_types)
+        node_types.append(TES)
+        starts.append(tes_bin.start)
+        stops.append(tes_bin.stop)
+        left_labels.append(0)
+        right_labels.append(0)
+        node_bins[node_id] = tes_bin
         for tes_start in tes_segments:
             bin_i = segment_bnds.searchsorted(tes_start)
             assert segment_bnds[bin_i] == tes_start
             if gene.strand == '+': bin_i -= 1
-            splice_graph.add_edge(bin_i, node_id, type='tes', bin=None)
+            assert segment_nodes[bin_i] >= 0
+            add_edge(segment_nodes[bin_i], node_id, TES_EDGE)
+    
+    splice_graph = SpliceGraph(
+        node_types, starts, stops, 
+        edge_srcs, edge_dsts, edge_types, edge_cnts,
+        left_labels, right_labels)
+    for node_id, bin in node_bins.iteritems():
+        splice_graph.node_bins[node_id] = bin
+        if bin.fpkm != None:
+            splice_graph.set_node_expression(
+                node_id, (bin.fpkm_lb, bin.fpkm, bin.fpkm_ub))
     
     return splice_graph, None
     
@@ -747,6 +705,47 @@ def build_splice_graph_and_binned_reads_in_gene(
     
     return splice_graph, binned_reads
 
+def find_median_coverage_in_segments(cov, starts, stops):
+    """Find the median of cov[start:stop] for every (start, stop) pair.
+
+    The medians are found together by sorting the coverage within each
+    segment, and segments that don't overlap cov have median 0.
+    """
+    starts = numpy.clip(starts, 0, len(cov))
+    stops = numpy.maximum(numpy.clip(stops, 0, len(cov)), starts)
+    lens = stops - starts
+    medians = numpy.zeros(len(starts), dtype=float)
+    if lens.sum() == 0: return medians
+    # concatenate the segment coverages, and sort them within each segment
+    offsets = numpy.zeros(len(lens), dtype=numpy.int64)
+    numpy.cumsum(lens[:-1], out=offsets[1:])
+    segment_ids = numpy.repeat(numpy.arange(len(lens)), lens)
+    cov_indices = ( numpy.repeat(starts - offsets, lens) 
+                    + numpy.arange(lens.sum()) )
+    values = numpy.asarray(cov, dtype=float)[cov_indices]
+    values = values[numpy.lexsort((values, segment_ids))]
+    # the median is the mean of the two middle values ( which are the same
+    # value for odd length segments )
+    non_empty = lens > 0
+    lens, offsets = lens[non_empty], offsets[non_empty]
+    medians[non_empty] = ( values[offsets + (lens-1)//2]
+                           + values[offsets + lens//2] )/2.
+    return medians
+
+def estimate_fpkm_bounds(n_reads, lens, total_num_reads, quantiles):
+    """Estimate the fpkm quantiles for elements with n_reads reads.
+
+    Returns an (len(n_reads), len(quantiles)) array. This is the same as
+    calling beta.ppf for every element, but only makes a single call into
+    scipy.
+    """
+    n_reads = numpy.asarray(n_reads, dtype=float)[:,None]
+    lens = numpy.asarray(lens, dtype=float)
+    if lens.ndim == 1: lens = lens[:,None]
+    return 1e6*(1000./lens)*betaincinv(
+        n_reads+1e-6, total_num_reads-n_reads+1e-6, 
+        numpy.asarray(quantiles, dtype=float)[None,:])
+
 def fast_quantify_segment_expression(gene, splice_graph, 
                                      rnaseq_reads, cage_reads, polya_reads):
     config.log_statement( 
@@ -760,29 +759,24 @@ def fast_quantify_segment_expression(gene, splice_graph,
         avg_read_len += marginal_frac*(r1_len + r2_len)/2
     
     rnaseq_cov = gene.find_coverage(rnaseq_reads)
-    for element_i, data in splice_graph.nodes(data=True):
-        #element = splice_graph.nodes(element_i)
-        element = splice_graph.node[element_i]
-        if element['type'] != 'segment': continue
-        coverage = rnaseq_cov[element['bin'].start-gene.start
-                              :element['bin'].stop-gene.start+1]
-        n_reads_in_segment = 0 if len(coverage) == 0 else numpy.median(coverage)
-        fpkms = 1e6*(1000./element['bin'].length())*beta.ppf(
-            quantiles, 
-            n_reads_in_segment+1e-6, 
-            rnaseq_reads.num_reads-n_reads_in_segment+1e-6)
-        element['bin'].set_expression(*fpkms)
-
-    for start, stop, data in splice_graph.edges(data=True):
-        if data['type'] != 'splice': continue
-        n_reads_in_segment = float(data['bin'].cnt)
-        effective_len = float(max(
-            1, avg_read_len - 2*config.MIN_INTRON_FLANKING_SIZE))
-        fpkms = 1e6*(1000./effective_len)*beta.ppf(
-            quantiles, 
-            n_reads_in_segment+1e-6, 
-            rnaseq_reads.num_reads-n_reads_in_segment+1e-6)
-        data['bin'].set_expression(*fpkms)
+    segment_nodes = splice_graph.nodes_of_type(SEGMENT)
+    starts = splice_graph.starts[segment_nodes]
+    stops = splice_graph.stops[segment_nodes]
+    n_reads_in_segments = find_median_coverage_in_segments(
+        rnaseq_cov, starts-gene.start, stops-gene.start+1)
+    splice_graph.set_node_expression(
+        segment_nodes, 
+        estimate_fpkm_bounds(n_reads_in_segments, stops-starts+1,
+                             rnaseq_reads.num_reads, quantiles))
+
+    splice_edges = splice_graph.edges_of_type(SPLICE)
+    effective_len = float(max(
+        1, avg_read_len - 2*config.MIN_INTRON_FLANKING_SIZE))
+    splice_graph.set_edge_expression(
+        splice_edges,
+        estimate_fpkm_bounds(splice_graph.edge_cnts[splice_edges], 
+                             effective_len, 
+                             rnaseq_reads.num_reads, quantiles))
 
     return splice_graph
 
@@ -796,11 +790,7 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
     min_fl = min(fl_dist.fl_min for (fl_dist, prb) in fl_dists.values())
     transcripts = set()
     segment_transcripts_map = {}
-    for segment_id, data in splice_graph.nodes(data=True):
-        if 'type' not in data: 
-            assert False, str((gene, splice_graph.nodes(data=True), 
-                               splice_graph.node[segment_id], segment_id, data))
-        if data['type'] != 'segment': continue        
+    for segment_id in splice_graph.nodes_of_type(SEGMENT).tolist():
         segment_transcripts = find_transcribed_fragments_covering_region(
             splice_graph, segment_id, max_fl)
         segment_transcripts = [tuple(t) for t in segment_transcripts]
@@ -819,8 +809,11 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
         return False
     
     # add in the splice elements
-    for start_i, stop_i, data in splice_graph.edges(data=True):
-        if data['type'] != 'splice': continue
+    splice_edges = {}
+    for edge in splice_graph.edges_of_type(SPLICE):
+        start_i = int(splice_graph.edge_srcs[edge])
+        stop_i = int(splice_graph.edge_dsts[edge])
+        splice_edges[(start_i, stop_i)] = edge
         # find transcripts that contain this splice
         segment_transcripts_map[(start_i, stop_i)] = [
             t for t in segment_transcripts_map[(start_i,)]
@@ -829,13 +822,10 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
     # build the old segment bnd, label style list. We need this for read binning
     # and expected fragment count calculations - this should probably be done
     # in the splice graph class, TODO
-    segment_nodes = {}
     segment_bnds = set()
     segment_bnd_labels = defaultdict(set)
-    for segment_i, data in sorted(splice_graph.nodes(data=True)):
-        if data['type'] != 'segment': continue
-        segment_bin = data['bin']
-        segment_nodes[segment_i] = segment_bin
+    for segment_i in splice_graph.nodes_of_type(SEGMENT):
+        segment_bin = build_segment_bin(splice_graph, segment_i)
         segment_bnds.add(segment_bin.start)
         segment_bnd_labels[segment_bin.start].update(segment_bin.left_labels)
         segment_bnds.add(segment_bin.stop+1)
@@ -848,11 +838,14 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
     #print segment_bnds
     #print segment_bnd_labels
 
+    # share the paired bin expected counts between the read groups
+    expected_cnts_cache = f_matrix.ExpectedCntsCache()
     weighted_expected_cnts = defaultdict(lambda: defaultdict(float))
     for (rg, (r1_len,r2_len)), (fl_dist, marginal_frac) in fl_dists.iteritems():
         for tr, bin_cnts in f_matrix.calc_expected_cnts( 
                 segment_bnds, transcripts, 
-                fl_dist, r1_len, r2_len).iteritems():
+                fl_dist, r1_len, r2_len, 
+                cache=expected_cnts_cache).iteritems():
             for bin, cnt in bin_cnts.iteritems():
                 weighted_expected_cnts[tr][bin] += cnt*marginal_frac
         
@@ -927,7 +920,7 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
             except frequency_estimation.TooFewReadsError: 
                 mean_t_len = effective_t_lens.mean()
 
-        assert mean_t_len > 0, str((element, transcripts, exon_lens, all_transcripts, sorted(segment_bnd_labels.iteritems()), splice_graph.edges(data=True)))
+        assert mean_t_len > 0, str((element, transcripts, exon_lens, all_transcripts, sorted(segment_bnd_labels.iteritems())))
         n_reads_in_segment = float(sum(obs_bin_cnts_in_segment.values()))
         quantiles = [0.01, 0.5, 1-.01]
         fpkms = 1e6*(1000./mean_t_len)*beta.ppf(
@@ -935,9 +928,9 @@ def quantify_segment_expression(gene, splice_graph, binned_reads ):
             n_reads_in_segment+1e-6, 
             rnaseq_reads.num_reads-n_reads_in_segment+1e-6)
         if len(element) == 1:
-            segment_nodes[element[0]].set_expression(*fpkms)
+            splice_graph.set_node_expression(element[0], fpkms)
         else:
-            splice_graph[element[0]][element[1]]['bin'].set_expression(*fpkms)
+            splice_graph.set_edge_expression(splice_edges[element], fpkms)
     
     return splice_graph
 
@@ -958,57 +951,98 @@ def determine_exon_type(left_label, right_label):
     assert left_label == 'R_JN' and right_label == 'D_JN'
     return 'EXON'
 
+def build_segment_bin(splice_graph, node):
+    """Build a SegmentBin for a segment node in splice_graph.
+
+    """
+    return SegmentBin(
+        splice_graph.starts[node], splice_graph.stops[node],
+        bitmask_to_labels(splice_graph.left_labels[node]),
+        bitmask_to_labels(splice_graph.right_labels[node]),
+        fpkm_lb=splice_graph.node_fpkms[node,0], 
+        fpkm=splice_graph.node_fpkms[node,1], 
+        fpkm_ub=splice_graph.node_fpkms[node,2])
+
+def build_intron_bin(splice_graph, edge, strand):
+    """Build a SegmentBin for a splice edge in splice_graph.
+
+    """
+    if strand == '+':
+        start, stop = splice_graph.stops[splice_graph.edge_srcs[edge]]+1, \
+            splice_graph.starts[splice_graph.edge_dsts[edge]]-1
+        left_labels, right_labels = ['D_JN',], ['R_JN',]
+    else:
+        start, stop = splice_graph.stops[splice_graph.edge_dsts[edge]]+1, \
+            splice_graph.starts[splice_graph.edge_srcs[edge]]-1
+        left_labels, right_labels = ['R_JN',], ['D_JN',]
+    return SegmentBin(
+        start, stop, left_labels, right_labels, type='INTRON', 
+        cnt=splice_graph.edge_cnts[edge],
+        fpkm_lb=splice_graph.edge_fpkms[edge,0], 
+        fpkm=splice_graph.edge_fpkms[edge,1], 
+        fpkm_ub=splice_graph.edge_fpkms[edge,2])
+
 def build_exons_from_exon_segments(gene, splice_graph, max_min_expression):
     config.log_statement( 
         "Building Exons from Segments in Chrm %s Strand %s Pos %i-%i" %
         (gene.chrm, gene.strand, gene.start, gene.stop) )
-
-    exon_segments = [ data['bin']
-                      for node_id, data in splice_graph.nodes(data=True)
-                      if data['type'] == 'segment' ]
+    
+    segment_nodes = splice_graph.nodes_of_type(SEGMENT)
+    starts = splice_graph.starts[segment_nodes]
+    stops = splice_graph.stops[segment_nodes]
+    left_labels = splice_graph.left_labels[segment_nodes]
+    right_labels = splice_graph.right_labels[segment_nodes]
+    fpkm_lbs = splice_graph.node_fpkms[segment_nodes,0]
+    fpkms = splice_graph.node_fpkms[segment_nodes,1]
     if gene.strand == '-':
-        exon_segments = reverse_strand(exon_segments, gene.stop)
-    exon_segments = sorted(exon_segments, key=lambda x:x.start)
+        starts, stops = gene.stop-1-stops, gene.stop-1-starts
+        left_labels, right_labels = right_labels, left_labels
+    order = numpy.argsort(starts, kind='mergesort')
+    # use lists in the inner loop, because indexing numpy arrays one
+    # element at a time is slow
+    starts, stops = starts[order].tolist(), stops[order].tolist()
+    left_labels = [ bitmask_to_labels(x) for x in left_labels[order] ]
+    right_labels = [ bitmask_to_labels(x) for x in right_labels[order] ]
+    fpkm_lbs, fpkms = fpkm_lbs[order].tolist(), fpkms[order].tolist()
+    n_segments = len(starts)
     
     EXON_START_LABELS = ('TSS', 'R_JN')
     EXON_STOP_LABELS = ('TES', 'D_JN')
     
     # find all of the exon start bins
     exons = []
-    for i in xrange(len(exon_segments)):
+    for i in xrange(n_segments):
         # if this is not allowed to be the start of an exon
-        start_segment = exon_segments[i]
-        for start_label in start_segment.left_labels:
+        for start_label in left_labels[i]:
             if start_label not in EXON_START_LABELS:
                 continue
-
-            for j in xrange(i, len(exon_segments)):
-                stop_segment = exon_segments[j]
-
+            
+            min_fpkm = fpkms[i]
+            for j in xrange(i, n_segments):
                 #if ( start_label == 'D_JN'
-                #     and 'R_JN' in stop_segment.right_labels ):
+                #     and 'R_JN' in right_labels[j] ):
                 #    break
                 
                 local_max_min_expression = max_min_expression
-                if j+i < len(exon_segments):
+                if j+i < n_segments:
                     local_max_min_expression = max(
                         local_max_min_expression, 
-                        exon_segments[j+1].fpkm_lb/config.MAX_EXPRESSION_RATIO)
+                        fpkm_lbs[j+1]/config.MAX_EXPRESSION_RATIO)
                 if j-i >= 0:
                     local_max_min_expression = max(
                         local_max_min_expression, 
-                        exon_segments[j-1].fpkm_lb/config.MAX_EXPRESSION_RATIO)
-                if stop_segment.fpkm < local_max_min_expression: 
+                        fpkm_lbs[j-1]/config.MAX_EXPRESSION_RATIO)
+                if fpkms[j] < local_max_min_expression: 
                     break
                 
-                for stop_label in stop_segment.right_labels:
+                min_fpkm = min(min_fpkm, fpkms[j])
+                for stop_label in right_labels[j]:
                     if stop_label not in EXON_STOP_LABELS:
                         continue
-                    fpkm = min(segment.fpkm for segment in exon_segments[i:j+1])
                     exon_bin = TranscriptElement(
-                        start_segment.start, stop_segment.stop, 
+                        starts[i], stops[j], 
                         determine_exon_type(start_label, stop_label),
-                        fpkm)
+                        min_fpkm)
                     exons.append(exon_bin)
             
     if gene.strand == '-':
@@ -1032,6 +1066,12 @@ def find_exons_in_gene( gene, contig_lens, ofp,
     config.log_statement( "Finding Exons in Chrm %s Strand %s Pos %i-%i" %
                    (gene.chrm, gene.strand, gene.start, gene.stop) )
     
+    # decode the reads in this gene once - the summaries are used in place 
+    # of the reads objects in all of the below steps
+    rnaseq_reads = gene.summarize_reads(rnaseq_reads)
+    if cage_reads != None: cage_reads = gene.summarize_reads(cage_reads)
+    if polya_reads != None: polya_reads = gene.summarize_reads(polya_reads)
+    
     # build the transcribed segment splice graph, and bin observe rnasseq reads 
     # based upon this splice graph in this gene.
     splice_graph, binned_reads = build_splice_graph_and_binned_reads_in_gene(
@@ -1048,20 +1088,22 @@ def find_exons_in_gene( gene, contig_lens, ofp,
     
     # introns are both elements and element segments
     gene.elements.extend(
-        data['bin'] for n1, n2, data in splice_graph.edges(data=True)
-        if data['type'] == 'splice'
-        and data['bin'].fpkm > min_max_exp)
+        build_intron_bin(splice_graph, edge, gene.strand)
+        for edge in splice_graph.edges_of_type(SPLICE)
+        if splice_graph.edge_fpkms[edge,1] > min_max_exp)
 
     if config.DEBUG_VERBOSE:
         gene.elements.extend(
-            data['bin'] for node_id, data in splice_graph.nodes(data=True)
-            if data['bin'].fpkm > min_max_exp )
+            build_segment_bin(splice_graph, node)
+            for node in splice_graph.nodes_of_type(SEGMENT)
+            if splice_graph.node_fpkms[node,1] > min_max_exp )
     
     # add T*S's
     gene.elements.extend(
-        data['bin'] for node_id, data in splice_graph.nodes(data=True)
-        if data['type'] in ('TSS', 'TES')
-        and data['bin'].fpkm > min_max_exp)
+        splice_graph.node_bins[node] 
+        for node in numpy.flatnonzero(
+            (splice_graph.node_types == TSS)|(splice_graph.node_types == TES))
+        if splice_graph.node_fpkms[node,1] > min_max_exp)
 
     # merge in the reference exons
     for tss_exon in gene_ref_elements['tss_exon']:
@@ -1080,63 +1122,110 @@ def find_exons_in_gene( gene, contig_lens, ofp,
                    (gene.chrm, gene.strand, gene.start, gene.stop) )
     return None
 
-def find_exons_worker( (genes_queue, genes_queue_lock, n_threads_running), 
-                       ofp, contig_lens, ref_elements, ref_elements_to_include,
+def pack_gene(gene):
+    """Pack a gene boundary bin into a compact tuple for the work queue.
+
+    """
+    return ( gene.chrm, gene.strand, 
+             tuple((x.start, x.stop) for x in gene.regions) )
+
+def unpack_gene((chrm, strand, regions)):
+    gene = GeneElements(chrm, strand)
+    for start, stop in regions:
+        gene.regions.append(
+            SegmentBin(start, stop, ["ESTART",], ["ESTOP",], "GENE"))
+    return gene
+
+class ElementsBuffer(object):
+    """Buffer the bed lines that a worker writes in memory.
+
+    """
+    def __init__(self):
+        self.lines = []
+    
+    def write(self, data):
+        self.lines.extend(line + "\n" for line in data.splitlines())
+
+def bed_line_sort_key(line):
+    data = line.split("\t")
+    return (data[0], data[5], int(data[1]), int(data[2]), line)
+
+def write_elements_shard(lines, ofname):
+    """Write the bed lines, sorted by contig, strand and start, to ofname.
+
+    """
+    lines.sort(key=bed_line_sort_key)
+    with open(ofname + ".tmp", "w") as ofp:
+        ofp.writelines(lines)
+    os.rename(ofname + ".tmp", ofname)
+    return
+
+def merge_elements_shards(fnames, ofp):
+    """Merge the sorted element shards in fnames, and write them to ofp.
+
+    """
+    def iter_keyed_lines(fp):
+        for line in fp:
+            yield bed_line_sort_key(line), line
+    
+    fps = [ open(fname) for fname in fnames ]
+    try:
+        for key, line in heapq.merge(*[iter_keyed_lines(fp) for fp in fps]):
+            ofp.write(line)
+    finally:
+        for fp in fps: fp.close()
+    return
+
+def find_exons_worker( worker_id, (genes_queue, n_pending_genes, stats_queue),
+                       shard_fname, contig_lens, 
+                       ref_elements, ref_elements_to_include,
                        rnaseq_reads, cage_reads, polya_reads ):
+    """Find exons in the genes in genes_queue until we get a None sentinel.
+
+    Genes are packed with pack_gene, and n_pending_genes counts the genes 
+    that are queued or being processed. The elements are buffered in memory,
+    and written, sorted, to shard_fname when we're finished. Then we put 
+    (worker_id, n_genes, busy_time, run_time) into stats_queue.
+    """
+    start_time = time.time()
     rnaseq_reads = rnaseq_reads.reload()
     cage_reads = cage_reads.reload() if cage_reads != None else None
     polya_reads = polya_reads.reload() if polya_reads != None else None
     
+    ofp = ElementsBuffer()
+    n_genes, busy_time = 0, 0.0
     while True:
-        # try to get a gene
-        with genes_queue_lock:
-            try: gene = genes_queue.pop()
-            except IndexError: gene = None
+        config.log_statement("Waiting for gene to process")
+        packed_gene = genes_queue.get()
+        if packed_gene == None: break
+        gene = unpack_gene(packed_gene)
         
-        # if there is no gene it process, but threads are still running, then 
-        # wait for the queue to fill or the process to finish
-        if gene == None and n_threads_running.value > 0:
-            config.log_statement( 
-                "Waiting for gene to process (%i)" % n_threads_running.value)
-            time.sleep(0.1)
-            continue
-        # otherwise, take a lock to make sure that the queue is empty and no 
-        # threads are running. If so, then return
-        elif gene == None:
-            with genes_queue_lock:
-                if len(genes_queue) == 0 and n_threads_running.value == 0:
-                    config.log_statement( "" )
-                    return
-                else: continue
-
-        # otherwise, we have a gene to process, so process it
-        assert gene != None
-        with genes_queue_lock: n_threads_running.value += 1
-
-        # find the exons and genes
+        gene_start_time = time.time()
         try:
-            rv = find_exons_in_gene(gene, contig_lens, ofp,
-                                    ref_elements, ref_elements_to_include,
-                                    rnaseq_reads, cage_reads, polya_reads )
+            find_exons_in_gene(gene, contig_lens, ofp,
+                               ref_elements, ref_elements_to_include,
+                               rnaseq_reads, cage_reads, polya_reads )
         except Exception, inst:
             config.log_statement( 
                 "Uncaught exception in find_exons_in_gene", log=True )
             config.log_statement( traceback.format_exc(), log=True, display=False )
-            rv = None
+        busy_time += time.time() - gene_start_time
+        n_genes += 1
         
-        # if the return value is new genes, then add these to the queue
-        if rv != None:
-            with genes_queue_lock:
-                for gene in rv:
-                    genes_queue.append( gene )
-                n_threads_running.value -= 1
-        # otherwise, we found the exons and wrote out the element data,
-        # so just decrease the number of running threads
-        else:
-            with genes_queue_lock:
-                n_threads_running.value -= 1
+        with n_pending_genes.get_lock():
+            n_pending_genes.value -= 1
     
-    assert False
+    write_elements_shard(ofp.lines, shard_fname)
+    config.log_statement("")
+    stats_queue.put((worker_id, n_genes, busy_time, time.time()-start_time))
+    return
+
+def log_exon_finding_worker_stats(all_stats):
+    for worker_id, n_genes, busy_time, run_time in sorted(all_stats):
+        config.log_statement( 
+            "Exon finding worker %i processed %i genes (%.1f%% utilization)" % (
+                worker_id, n_genes, 100*busy_time/max(run_time, 1e-6)), 
+            log=True)
     return
 
 def extract_reference_elements(genes, ref_elements_to_include):
@@ -1174,53 +1263,66 @@ def find_exons( contig_lens, gene_bndry_bins, ofp,
                 rnaseq_reads, cage_reads, polya_reads,
                 ref_genes, ref_elements_to_include,
                 junctions=None, nthreads=None):
+    """Find the elements in gene_bndry_bins, and write them to ofp.
+
+    Every worker writes its elements to a sorted shard, and the shards are
+    merged so that the output is sorted by contig, strand and start.
+    """
     assert not any(ref_elements_to_include) or ref_genes != None
     if nthreads == None: nthreads = config.NTHREADS
     assert junctions == None
     
     ref_elements = extract_reference_elements( 
         ref_genes, ref_elements_to_include )
-    genes_queue_lock = multiprocessing.Lock()
-    threads_are_running = multiprocessing.Value('i', 0)
-    if config.NTHREADS > 1:
-        manager = multiprocessing.Manager()
-        genes_queue = manager.list()
-    else:
-        genes_queue = []
-
-    genes_queue.extend( gene_bndry_bins )
-    """
-    for ref_gene in ref_genes:
-        gene = GeneElements(ref_gene.chrm, ref_gene.strand)
-        gene.regions.append(
-            SegmentBin(ref_gene.start, ref_gene.stop, 
-                       ["ESTART",], ["ESTOP",], "GENE"))
-        genes_queue.append(gene)
-    """
-    args = [ (genes_queue, genes_queue_lock, threads_are_running), 
-             ofp, contig_lens, ref_elements, ref_elements_to_include,
+    genes_queue = multiprocessing.Queue()
+    n_pending_genes = multiprocessing.Value('i', len(gene_bndry_bins))
+    stats_queue = multiprocessing.Queue()
+    for gene in gene_bndry_bins:
+        genes_queue.put(pack_gene(gene))
+    n_genes = len(gene_bndry_bins)
+    # the queue is FIFO, so the workers get the sentinels after every gene
+    for i in xrange(nthreads): genes_queue.put(None)
+    
+    shards_dir = tempfile.mkdtemp(prefix=".elements", dir=config.tmp_dir)
+    shard_fnames = [ os.path.join(shards_dir, "%i.bed" % i)
+                     for i in xrange(nthreads) ]
+    args = [ contig_lens, ref_elements, ref_elements_to_include,
              rnaseq_reads, cage_reads, polya_reads ]
     
-    n_genes = len(genes_queue)
     if nthreads == 1:
-        find_exons_worker(*args)
+        find_exons_worker(
+            0, (genes_queue, n_pending_genes, stats_queue), 
+            shard_fnames[0], *args)
+        log_exon_finding_worker_stats([stats_queue.get(),])
     else:
-        config.log_statement("Waiting on exon finding children (%i/%i remain)"%(
-                len(genes_queue), n_genes))
         ps = []
         for i in xrange( nthreads ):
-            p = multiprocessing.Process(target=find_exons_worker, args=args)
+            p = multiprocessing.Process(
+                target=find_exons_worker, 
+                args=[i, (genes_queue, n_pending_genes, stats_queue), 
+                      shard_fnames[i]] + args)
             p.start()
             ps.append( p )
         
-        while True:
+        # wait for the worker stats, logging the queue depth as we go
+        all_stats = []
+        while len(all_stats) < nthreads:
             config.log_statement(
-                "Waiting on exon finding children (%i/%i remain)"%(
-                    len(genes_queue), n_genes))
-            if all( not p.is_alive() for p in ps ):
-                break
-            time.sleep( 1.0 )
-
+                "Waiting on exon finding children (%i/%i genes remain)"%(
+                    n_pending_genes.value, n_genes))
+            try: 
+                all_stats.append(stats_queue.get(timeout=1.0))
+            except Queue.Empty:
+                if any( p.exitcode not in (None, 0) for p in ps ):
+                    for p in ps: 
+                        if p.is_alive(): p.terminate()
+                    raise OSError, "An exon finding child exited with an error"
+        for p in ps: p.join()
+        log_exon_finding_worker_stats(all_stats)
+
+    config.log_statement( "Merging the elements from the exon finding workers" )
+    merge_elements_shards(shard_fnames, ofp)
+    shutil.rmtree(shards_dir)
     config.log_statement( "" )    
     return
 
@@ -1230,7 +1332,7 @@ def find_elements( promoter_reads, rnaseq_reads, polya_reads,
     # wrap everything in a try block so that we can with elegantly handle
     # uncaught exceptions
     try:
-        ofp = ThreadSafeFile( ofname + "unfinished", "w" )
+        ofp = open( ofname + "unfinished", "w" )
         ofp.write(
             'track name="%s" visibility=2 itemRgb="On" useScore=1\n' % ofname)
         
@@ -642,7 +642,9 @@ def build_fl_dists_from_fls_dict(frag_lens):
         for fl, cnt in fls_and_cnts:
             if fl > max_fl: continue
             fl_density[fl-min_fl] += cnt
-        fl_dists[(rd_grp, (rd_len, rd_len))] = [
+        # the read lengths are either a single length, or a pair of lengths
+        rd_lens = rd_len if isinstance(rd_len, tuple) else (rd_len, rd_len)
+        fl_dists[(rd_grp, rd_lens)] = [
             FlDist(min_fl, max_fl, fl_density/fl_density.sum()),
             fl_density.sum()]
     total_sum = sum(x[1] for x in fl_dists.values())
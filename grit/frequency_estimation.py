@@ -26,6 +26,7 @@ from itertools import izip
 import numpy
 numpy.seterr(all='ignore')
 
+import scipy.sparse
 from scipy.linalg import svd, inv
 from scipy.stats import chi2
 from scipy.optimize import brentq, fminbound, nnls
@@ -74,9 +75,57 @@ except ImportError:
 
 import sparsify_support_fns
 
+def csr_kernel_args( freqs, observed_array, expected_array ):
+    """Convert the arrays to the types that the sparsify_support_fns 
+       calc_csr_* kernels take. 
+
+    This doesn't copy arrays that already have the right type and layout.
+    """
+    expected_array = scipy.sparse.csr_matrix(expected_array)
+    return ( numpy.ascontiguousarray(freqs, dtype=numpy.double),
+             numpy.ascontiguousarray(observed_array, dtype=numpy.int64),
+             numpy.ascontiguousarray(expected_array.data, dtype=numpy.double),
+             numpy.ascontiguousarray(expected_array.indices),
+             numpy.ascontiguousarray(expected_array.indptr) )
+
+def calc_sparse_lhd( freqs, observed_array, expected_array ):
+    """calc_lhd for a scipy.sparse expected array.
+
+    """
+    return sparsify_support_fns.calc_csr_lhd(
+        *csr_kernel_args(freqs, observed_array, expected_array))
+
+def calc_sparse_gradient( freqs, observed_array, expected_array ):
+    """calc_gradient for a scipy.sparse expected array.
+
+    """
+    return sparsify_support_fns.calc_csr_gradient(
+        *csr_kernel_args(freqs, observed_array, expected_array))
+
+def calc_sparse_lhd_and_gradient( freqs, observed_array, expected_array ):
+    """calc_lhd_and_gradient for a scipy.sparse expected array.
+
+    """
+    return sparsify_support_fns.calc_csr_lhd_and_gradient(
+        *csr_kernel_args(freqs, observed_array, expected_array))
+
+def dense_kernel_args( freqs, observed_array, expected_array ):
+    """Convert the arrays to the types that the sparsify_support_fns 
+       kernels take. 
+
+    This doesn't copy arrays that already have the right type and layout.
+    """
+    return ( numpy.ascontiguousarray(freqs, dtype=numpy.double),
+             numpy.ascontiguousarray(observed_array, dtype=numpy.int64),
+             numpy.ascontiguousarray(expected_array, dtype=numpy.double) )
+
 def calc_lhd( freqs, observed_array, expected_array, 
               sparse_penalty=0, sparse_index=None ):
-    rv = sparsify_support_fns.calc_lhd(freqs, observed_array, expected_array)
+    if scipy.sparse.issparse(expected_array):
+        rv = calc_sparse_lhd(freqs, observed_array, expected_array)
+    else:
+        rv = sparsify_support_fns.calc_lhd(
+            *dense_kernel_args(freqs, observed_array, expected_array))
 
     if sparse_penalty > 0:
         if sparse_index != None:
@@ -90,8 +139,11 @@ def calc_lhd( freqs, observed_array, expected_array,
 
 def calc_gradient( freqs, observed_array, expected_array,
                    sparse_penalty=0, sparse_index=None):
-    rv = sparsify_support_fns.calc_gradient(
-        freqs, observed_array, expected_array)
+    if scipy.sparse.issparse(expected_array):
+        rv = calc_sparse_gradient(freqs, observed_array, expected_array)
+    else:
+        rv = sparsify_support_fns.calc_gradient(
+            *dense_kernel_args(freqs, observed_array, expected_array))
     if sparse_penalty > 0:
         if sparse_index != None:
             penalty = math.log(sparse_penalty) - 2*math.log(freqs[sparse_index])
@@ -102,9 +154,20 @@ def calc_gradient( freqs, observed_array, expected_array,
     
     return rv
 
+def calc_lhd_and_gradient( freqs, observed_array, expected_array ):
+    """Return calc_lhd and calc_gradient, sharing the bin frequencies.
+
+    """
+    if scipy.sparse.issparse(expected_array):
+        return calc_sparse_lhd_and_gradient(
+            freqs, observed_array, expected_array)
+    return sparsify_support_fns.calc_lhd_and_gradient(
+        *dense_kernel_args(freqs, observed_array, expected_array))
+
 def is_row_identifiable(X, i_to_check):
     import scipy.optimize
     
+    if scipy.sparse.issparse(X): X = X.toarray()
     indices = numpy.array([i for i in xrange(X.shape[1]) if i != i_to_check]) 
     A = X[:,indices]
     b = X[:,i_to_check]
@@ -533,31 +596,138 @@ def estimate_sparse_transcript_frequencies(observed_array, full_expected_array):
     
     return best_x
 
-def estimate_transcript_frequencies(observed_array, full_expected_array):
+def calc_em_step( x, observed_array, expected_array, num_reads, 
+                  gradient=None ):
+    """Take an EM step for the multinomial mixture.
+
+    Each read is assigned to the transcripts in proportion to their 
+    contribution to its bin's frequency. This never decreases the 
+    likelihood, and stays on the simplex. If it's already known, gradient
+    should be calc_gradient at x.
+    """
+    if gradient is None:
+        gradient = calc_gradient(x, observed_array, expected_array)
+    # calc_gradient returns minus the lhd gradient
+    rv = -x*gradient/num_reads
+    rv[rv < MIN_TRANSCRIPT_FREQ] = MIN_TRANSCRIPT_FREQ
+    return rv/rv.sum()
+
+def estimate_transcript_frequencies_squarem( 
+        observed_array, expected_array, abs_tol=LHD_ABS_TOL ):
+    """Estimate the transcript frequencies with SQUAREM accelerated EM.
+
+    Each iteration takes two EM steps, extrapolates along them with the 
+    SqS3 step length ( Varadhan and Roland, 2008 ), and then takes an EM 
+    step from the extrapolated point. If that decreases the likelihood, we
+    halve the extrapolation until it doesn't, which at worst reduces to 3 
+    plain EM steps.
+    """
+    num_reads = float(observed_array.sum())
+    if num_reads == 0:
+        raise TooFewReadsError, ( "Too few reads (%i)" % num_reads )
+    
+    n = expected_array.shape[1]
+    if n == 1:
+        return numpy.ones( 1, dtype=float )
+    
+    def em_step(x, gradient=None):
+        return calc_em_step(
+            x, observed_array, expected_array, num_reads, gradient)
+    
+    # we keep the gradient at x from the lhd calculation, so that the first
+    # EM step doesn't need to calculate the bin frequencies again
+    x = numpy.ones(n, dtype=float)/n
+    lhd, gradient = calc_lhd_and_gradient(x, observed_array, expected_array)
+    start_time = time.time()
+    for i in xrange( MAX_NUM_ITERATIONS ):
+        x1 = em_step(x, gradient)
+        x2 = em_step(x1)
+        r = x1 - x
+        v = x2 - 2*x1 + x
+        v_size = numpy.sqrt((v**2).sum())
+        step = ( -numpy.sqrt((r**2).sum())/v_size if v_size > 0 else -1.0 )
+        while True:
+            step = min(step, -1.0)
+            new_x = project_onto_simplex(x - 2*step*r + step*step*v)
+            new_x = em_step(new_x)
+            new_lhd, new_gradient = calc_lhd_and_gradient(
+                new_x, observed_array, expected_array)
+            if new_lhd >= lhd or step == -1.0: break
+            step = (step - 1)/2.
+            # halving never quite reaches -1, so stop once we're close
+            if step > -1.01: step = -1.0
+        
+        if DEBUG_OPTIMIZATION:
+            config.log_statement( "%i\t%.2f\t%.6e\t%e" % ( 
+                    i, new_lhd, new_lhd - lhd, step ) )
+        
+        # the step == -1 step is 3 EM steps, so only rounding error can
+        # decrease the lhd, and we would just take the same steps again
+        if new_lhd < lhd: break
+
+        converged = ( new_lhd - lhd < abs_tol
+                      and numpy.absolute(new_x - x).max() < PARAM_ABS_TOL )
+        x, lhd, gradient = new_x, new_lhd, new_gradient
+        if converged: break
+    
+    if config.DEBUG_VERBOSE:
+        config.log_statement( "SQUAREM %i\t%.2f\t%s" % ( 
+                i, lhd, make_time_str(time.time()-start_time) ) )
+    return x
+
+# the available MLE solvers, see estimate_transcript_frequencies
+MLE_SOLVERS = ('line_search', 'squarem')
+
+def estimate_transcript_frequencies(
+        observed_array, full_expected_array, solver=None):
+    """Find the maximum likelihood transcript frequencies.
+
+    solver is one of MLE_SOLVERS, and defaults to config.MLE_SOLVER. 
+    'line_search' is the penalized projected gradient ascent, and 'squarem'
+    is accelerated EM, which is much faster for loci with many transcripts.
+    """
+    if solver == None: solver = config.MLE_SOLVER
+    if solver == 'squarem':
+        return estimate_transcript_frequencies_squarem(
+            observed_array, full_expected_array)
+    assert solver == 'line_search', "Unrecognized MLE solver '%s'" % solver
     rv = estimate_transcript_frequencies_sparse(
         observed_array, full_expected_array, 
         None, None )
     return rv
         
 
-def estimate_confidence_bound( f_mat, 
-                               num_reads_in_bams,
-                               fixed_index,
-                               mle_estimate,
-                               bound_type,
-                               alpha):
+def normalize_bound_type( bound_type ):
     if bound_type == 'lb': bound_type = 'LOWER'
     if bound_type == 'ub': bound_type = 'UPPER'
     assert bound_type in ('LOWER', 'UPPER'), (
         "Improper bound type '%s'" % bound_type )
-    expected_array, observed_array = f_mat.expected_and_observed(
-        bam_cnts=num_reads_in_bams)
+    return bound_type
+
+def calc_confidence_bound_lhds( 
+        observed_array, expected_array, mle_estimate, alpha ):
+    """Return the maximum log likelihood, and the minimum log likelihood of
+       a point inside the alpha level confidence region.
+
+    """
+    max_lhd = calc_lhd(
+        project_onto_simplex(mle_estimate), observed_array, expected_array)
+    unprojected_lhd = calc_lhd(mle_estimate, observed_array, expected_array)
+    assert abs(max_lhd - unprojected_lhd) < 1e-2, "Diff: %e %e %e" % (
+        max_lhd, unprojected_lhd, max_lhd - unprojected_lhd)
+    max_test_stat = chi2.ppf( 1 - alpha, 1 )/2.    
+    return max_lhd, max_lhd-max_test_stat
+
+def find_confidence_bound( observed_array, expected_array, 
+                           fixed_index, x0, bound_type, 
+                           max_lhd, min_lhd ):
+    """Walk from x0 to the bound_type bound of x[fixed_index].
+
+    x0 must be in the confidence region ( have a log likelihood of at least
+    min_lhd ). Returns the bound's p-value, the bound, and the point that 
+    the bound was found at.
+    """
     eps = 0.1
-    #expected_array = expected_array[:, 0:4]    
-    #mle_estimate = mle_estimate[:-1]
-    #print mle_estimate
-    if 1 == expected_array.shape[1]:
-        return 1.0, 1.0
     
     def min_line_search( x, gradient, max_feasible_step_size ):
         def brentq_fmin(alpha):
@@ -655,16 +825,8 @@ def estimate_confidence_bound( f_mat,
         return new_x
     
     n = expected_array.shape[1]    
-    max_lhd = calc_lhd(
-        project_onto_simplex(mle_estimate), observed_array, expected_array)
-    unprojected_lhd = calc_lhd(mle_estimate, observed_array, expected_array)
-    assert abs(max_lhd - unprojected_lhd) < 1e-2, "Diff: %e %e %e" % (
-        max_lhd, unprojected_lhd, max_lhd - unprojected_lhd)
-    max_test_stat = chi2.ppf( 1 - alpha, 1 )/2.    
-    min_lhd = max_lhd-max_test_stat
-
-    x = mle_estimate.copy()
-    prev_x = mle_estimate[fixed_index]
+    x = x0.copy()
+    prev_x = x0[fixed_index]
     n_successes = 0
     for i in xrange(MAX_NUM_ITERATIONS):
         # take a downhill step
@@ -696,8 +858,80 @@ def estimate_confidence_bound( f_mat,
     if value < PARAM_ABS_TOL: value = 0.
     if 1-value < PARAM_ABS_TOL: value = 1.
     lhd = calc_lhd( x, observed_array, expected_array )
-    rv = chi2.sf( 2*(max_lhd-lhd), 1), value
-    return rv    
+    return chi2.sf( 2*(max_lhd-lhd), 1), value, x
+
+def estimate_confidence_bound( f_mat, 
+                               num_reads_in_bams,
+                               fixed_index,
+                               mle_estimate,
+                               bound_type,
+                               alpha):
+    bound_type = normalize_bound_type(bound_type)
+    expected_array, observed_array = f_mat.expected_and_observed(
+        bam_cnts=num_reads_in_bams)
+    if 1 == expected_array.shape[1]:
+        return 1.0, 1.0
+    
+    max_lhd, min_lhd = calc_confidence_bound_lhds(
+        observed_array, expected_array, mle_estimate, alpha)
+    p_value, value, x = find_confidence_bound( 
+        observed_array, expected_array, fixed_index, mle_estimate, 
+        bound_type, max_lhd, min_lhd )
+    return p_value, value
+
+class ProfileLikelihood(object):
+    """Estimate the confidence bounds of the transcripts in a gene.
+
+    The design matrix, and the MLE's and confidence region's log 
+    likelihoods, are found once. Each walk is warm started from the last
+    point found for the same bound type when that point is in the 
+    confidence region, and at least as close to the bound as the MLE - so 
+    estimating neighbouring transcripts' bounds in order shares work.
+    """
+    def __init__(self, f_mat, num_reads_in_bams, mle_estimate, alpha):
+        self.expected_array, self.observed_array = f_mat.expected_and_observed(
+            bam_cnts=num_reads_in_bams)
+        self.mle_estimate = mle_estimate
+        self.n = self.expected_array.shape[1]
+        if self.n > 1:
+            self.max_lhd, self.min_lhd = calc_confidence_bound_lhds(
+                self.observed_array, self.expected_array, mle_estimate, alpha)
+        self._last_points = {}
+    
+    def _find_start(self, fixed_index, bound_type):
+        x0 = self._last_points.get(bound_type)
+        if x0 is None: 
+            return self.mle_estimate
+        mle_value = self.mle_estimate[fixed_index]
+        if bound_type == 'LOWER' and x0[fixed_index] > mle_value:
+            return self.mle_estimate
+        if bound_type == 'UPPER' and x0[fixed_index] < mle_value:
+            return self.mle_estimate
+        if calc_lhd(x0, self.observed_array, self.expected_array) \
+                < self.min_lhd:
+            return self.mle_estimate
+        return x0
+    
+    def estimate_bound(self, fixed_index, bound_type):
+        """Return the p-value and value of x[fixed_index]'s bound_type bound.
+
+        """
+        bound_type = normalize_bound_type(bound_type)
+        if self.n == 1:
+            return 1.0, 1.0
+        p_value, value, x = find_confidence_bound( 
+            self.observed_array, self.expected_array, fixed_index, 
+            self._find_start(fixed_index, bound_type), bound_type, 
+            self.max_lhd, self.min_lhd )
+        self._last_points[bound_type] = x
+        return p_value, value
+
+    def estimate_bounds(self, fixed_index, bound_types=('lb', 'ub')):
+        """Return a (p-value, value) tuple for each of bound_types.
+
+        """
+        return [ self.estimate_bound(fixed_index, bound_type) 
+                 for bound_type in bound_types ]
 
 def estimate_confidence_bound_with_cvx( f_mat, 
                                num_reads_in_bams,
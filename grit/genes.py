@@ -18,17 +18,25 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import signal
 import time
+import traceback
 import numpy
 import scipy
 import math
 
 from collections import defaultdict, namedtuple
-from itertools import chain, izip
+from itertools import chain, izip, groupby
 
 import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import Queue
 
+import heapq
+import shutil
+import tempfile
+import cPickle as pickle
+
 from scipy.stats import beta, binom
 
 import networkx as nx
@@ -37,6 +45,9 @@ from copy import copy
 
 ReadCounts = namedtuple('ReadCounts', ['Promoters', 'RNASeq', 'Polya'])
 
+# the number of gene segments per thread to aim for when splitting the genome
+SEGMENTS_PER_THREAD = 20
+
 from frag_len import build_fl_dists_from_fls_dict
 
 from transcript import Transcript, Gene
@@ -47,12 +58,17 @@ import config
 
 from files.reads import MergedReads, RNAseqReads, CAGEReads, \
     RAMPAGEReads, PolyAReads, \
-    fix_chrm_name_for_ucsc, get_contigs_and_lens, calc_frag_len_from_read_data, \
-    iter_paired_reads, extract_jns_and_reads_in_region, TooManyReadsError
+    fix_chrm_name_for_ucsc, clean_chr_name, \
+    get_contigs_and_lens, \
+    iter_paired_reads, ReadSummary, TooManyReadsError, \
+    build_coverage_from_intervals, estimate_read_density_from_index, \
+    BAM_INDEX_WINDOW_SIZE
 import files.junctions
 
 from files.bed import create_bed_line
 
+from lib.multiprocessing_utils import run_in_parallel
+
 class Bin(object):
     start = None
     stop = None
@@ -234,6 +250,8 @@ class GeneElements(object):
         self.regions = []
         self.element_segments = []
         self.elements = []
+        # the peak calling controls, so that they are only built once
+        self.control_cov_cache = {}
 
     def find_coverage(self, reads):
         cov = numpy.zeros(self.stop-self.start+1, dtype=float)
@@ -244,6 +262,16 @@ class GeneElements(object):
         #if gene.strand == '-': cov = cov[::-1]
         return cov
     
+    def summarize_reads(self, reads):
+        """Decode the reads in this gene's regions once. 
+
+        The returned ReadSummary can be passed to find_coverage in place 
+        of reads.
+        """
+        return ReadSummary(
+            reads, self.chrm, self.strand, self.start, self.stop,
+            [(x.start, x.stop) for x in self.regions])
+    
     def base_is_in_gene(self, pos):
         return all( r.start <= pos <= r.stop for r in self.regions )
     
@@ -556,40 +584,20 @@ def find_transcribed_regions_and_jns_in_segment(
     
     for reads_i,reads in enumerate((promoter_reads, rnaseq_reads, polya_reads)):
         if reads == None: continue
-
-        ( p1_rds, p2_rds, r_plus_jns, r_minus_jns, inner_cov, reads_n_uniq
-          ) = extract_jns_and_reads_in_region(
-              (contig, '.', r_start, r_stop), reads)
-        cov['+'] += inner_cov['+']
-        cov['-'] += inner_cov['-']
-        num_unique_reads[reads_i] += reads_n_uniq
-        
-        for jn, cnt in r_plus_jns.iteritems(): 
-            jn_reads['+'][jn] += cnt 
-        for jn, cnt in r_minus_jns.iteritems(): 
-            jn_reads['-'][jn] += cnt 
         
+        # decode all of the reads in this segment once
+        summary = ReadSummary(reads, contig, '.', r_start, r_stop)
+        for strand in '+-':
+            cov[strand] += summary.find_read_coverage(strand)
+            for jn, cnt in summary.find_jns(strand).iteritems(): 
+                jn_reads[strand][jn] += cnt 
+        num_unique_reads[reads_i] += summary.num_unique_reads
 
         # update the fragment length dist
         if reads == rnaseq_reads:
-            for qname, r1_data in p1_rds.iteritems():
-                # if there are multiple mappings, or the read isn't paired,
-                # don't use this for fragment length estimation
-                if len(r1_data) != 1 or r1_data[0].map_prb != 1.0: 
-                    continue
-                try: r2_data = p2_rds[qname]
-                except KeyError: continue
-                if len(r2_data) != 1 or r2_data[0].map_prb != 1.0: 
-                    continue
-                # estimate the fragment length, and update the read lengths
-                assert r1_data[0].map_prb == 1.0, str(r1_data)
-                assert r2_data[0].map_prb == 1.0, str(r2_data)
-                assert r1_data[0].read_grp == r2_data[0].read_grp
-                fl_key = ( r1_data[0].read_grp, 
-                           (r1_data[0].read_len, r2_data[0].read_len))
-                # we add 1 because we know that this read is unique
-                frag_len = calc_frag_len_from_read_data(r1_data[0], r2_data[0])
-                fragment_lengths[fl_key][frag_len] += 1.0
+            for fl_key, fl_cnts in summary.find_fragment_lengths().iteritems():
+                for frag_len, cnt in fl_cnts.iteritems():
+                    fragment_lengths[fl_key][frag_len] += cnt
     
     # add pseudo coverage for annotated jns. This is so that the clustering
     # algorithm knows which gene segments to join if a jn falls outside of 
@@ -653,41 +661,228 @@ def split_genome_into_segments(contig_lens, region_to_use,
                  min(contig_length, start+segment_length-1)))
     return segments
 
-class GlobalGeneSegmentData(object):
-    def __init__(self, contig_lens):
-        self.manager = multiprocessing.Manager()
-        self.num_unique_reads = ReadCounts(multiprocessing.Value('d', 0.0), 
-                                           multiprocessing.Value('d', 0.0), 
-                                           multiprocessing.Value('d', 0.0))
-        self.transcribed_regions = {}
-        self.jns = {}
-        for strand in "+-":
-            for contig in contig_lens.keys():
-                self.transcribed_regions[(contig, strand)] = self.manager.list()
-                self.jns[(contig, strand)] = self.manager.list()
-        self.frag_lens = self.manager.dict()
-        self.lock = multiprocessing.Lock()
-
-    def update_all_data(self, frag_lens, transcribed_regions, jns, rd_cnts):
-        with self.lock:
-            for key, cnt in frag_lens.iteritems():
-                if key not in self.frag_lens: self.frag_lens[key] = cnt
-                else: self.frag_lens[key] += cnt
-            for key, regions in transcribed_regions.iteritems():
-                self.transcribed_regions[key].extend(regions)
-            for key, vals in jns.iteritems():
-                self.jns[key].extend( vals )
-            for i, val in enumerate(rd_cnts):
-                self.num_unique_reads[i].value += val
-        return
+def find_uncovered_base_near(all_reads, contig, pos, max_dist):
+    """Return the base closest to pos that isn't covered by any read.
+    
+    Returns None if every base within max_dist of pos is covered.
+    """
+    start, stop = max(0, pos-max_dist), pos+max_dist
+    rd_starts, rd_stops = [], []
+    for reads in all_reads:
+        for rd in reads.fetch(contig, start, stop+1):
+            if rd.is_unmapped: continue
+            rd_starts.append(rd.pos)
+            rd_stops.append(rd.aend-1)
+    cov = build_coverage_from_intervals(rd_starts, rd_stops, start, stop)
+    uncovered = numpy.nonzero(cov == 0)[0] + start
+    if len(uncovered) == 0: return None
+    return int(uncovered[numpy.abs(uncovered - pos).argmin()])
+
+def find_uncovered_bases_near(all_reads, positions, max_dist):
+    """Run find_uncovered_base_near for every (contig, pos) in positions.
+
+    The searches are split between config.NTHREADS processes. Returns a list
+    with the uncovered base, or None, for each position.
+    """
+    if config.NTHREADS == 1 or len(positions) <= 1:
+        return [ find_uncovered_base_near(all_reads, contig, pos, max_dist)
+                 for contig, pos in positions ]
+    
+    # -1 marks the positions without an uncovered base nearby
+    uncovered_bases = RawArray('l', [-1,]*len(positions))
+    # re-open the reads once in each process to make this multi-process safe
+    reloaded_reads = []
+    def find_uncovered_base(i, contig, pos):
+        if len(reloaded_reads) == 0:
+            reloaded_reads.extend(reads.reload() for reads in all_reads)
+        base = find_uncovered_base_near(reloaded_reads, contig, pos, max_dist)
+        if base != None: uncovered_bases[i] = base
+    
+    run_in_parallel(
+        min(config.NTHREADS, len(positions)), find_uncovered_base, 
+        [ (i, contig, pos) for i, (contig, pos) in enumerate(positions) ])
+    return [ None if base == -1 else base for base in uncovered_bases ]
+
+def split_genome_into_segments_by_read_density(
+        contig_lens, region_to_use, all_reads, 
+        min_segment_length=5000, max_segment_length=1000000):
+    """Return non-overlapping segments with roughly equal numbers of reads.
+
+    The read density is estimated from the bam indices, and we try to cut
+    segments at uncovered bases so that transcribed regions aren't split.
+    The segments are sorted by decreasing read density, so that the most 
+    expensive segments are started first. 
+    
+    If any of the bams don't have a .bai or .csi index this falls back to 
+    split_genome_into_segments.
+    """
+    # the underlying reads objects of any merged reads
+    all_reads = [ rds for reads in all_reads 
+                  for rds in getattr(reads, '_reads', [reads,]) ]
+    densities = defaultdict(lambda: numpy.zeros(0))
+    for reads in all_reads:
+        reads_densities = estimate_read_density_from_index(reads)
+        if reads_densities == None: 
+            config.log_statement(
+                "'%s' isn't indexed, so the genome is split into equal "
+                "length segments" % reads.filename, log=True)
+            return split_genome_into_segments(
+                contig_lens, region_to_use, min_segment_length)
+        for contig, density in reads_densities.iteritems():
+            if len(density) > len(densities[contig]):
+                density = density.copy()
+                density[:len(densities[contig])] += densities[contig]
+            else:
+                density = densities[contig] + numpy.append(
+                    density, numpy.zeros(len(densities[contig])-len(density)))
+            densities[contig] = density
+    
+    if region_to_use != None:
+        r_chrm, (r_start, r_stop) = region_to_use
+    else:
+        r_chrm, r_start, r_stop = None, 0, 1000000000000
+    
+    total_density = sum(densities[contig].sum() for contig in contig_lens)
+    # use enough segments that the queue stays balanced, even though the 
+    # density estimates are approximate
+    target_density = max(
+        1.0, total_density/float(config.NTHREADS*SEGMENTS_PER_THREAD))
+    
+    # find the index windows to cut the segments at, and then search for the
+    # uncovered bases near all of the cuts at once
+    contig_cuts = []
+    for contig, contig_length in contig_lens.iteritems():
+        if region_to_use != None and r_chrm != contig: 
+            continue
+        start, stop = r_start, min(r_stop, contig_length-1)
+        # find the read density at the start of every index window
+        density = densities[contig]
+        window_bnds = numpy.arange(
+            len(density), dtype=int)*BAM_INDEX_WINDOW_SIZE
+        
+        cuts = []
+        seg_start, seg_density = start, 0.0
+        for window_start, window_density in izip(window_bnds, density):
+            window_stop = window_start + BAM_INDEX_WINDOW_SIZE - 1
+            if window_stop < seg_start: continue
+            # only count the part of the window that is in the segment
+            window_frac = min(1.0, (window_stop-seg_start+1)/float(
+                BAM_INDEX_WINDOW_SIZE))
+            seg_density += window_frac*window_density
+            if window_stop >= stop: break
+            if window_stop - seg_start + 1 < min_segment_length: continue
+            if ( seg_density < target_density 
+                 and window_stop - seg_start + 1 < max_segment_length ):
+                continue
+            cuts.append((seg_density, window_stop))
+            seg_start, seg_density = window_stop+1, 0.0
+        contig_cuts.append((contig, start, stop, cuts, seg_density))
+    
+    uncovered_bases = iter(find_uncovered_bases_near(
+        all_reads, 
+        [ (contig, window_stop) 
+          for contig, start, stop, cuts, seg_density in contig_cuts 
+          for cut_density, window_stop in cuts ], 
+        BAM_INDEX_WINDOW_SIZE/2))
+    
+    segments = []
+    for contig, start, stop, cuts, seg_density in contig_cuts:
+        seg_start = start
+        for cut_density, window_stop in cuts:
+            # try to cut at an uncovered base near the window boundary
+            cut = next(uncovered_bases)
+            if cut == None or cut-seg_start+1 < min_segment_length:
+                cut = window_stop
+            cut = min(cut, stop)
+            segments.append((cut_density, (contig, seg_start, cut)))
+            seg_start = cut+1
+        
+        # the remaining bases don't have any indexed reads, so split them
+        # into segments of max_segment_length
+        while seg_start <= stop:
+            seg_stop = min(stop, seg_start+max_segment_length-1)
+            segments.append((seg_density, (contig, seg_start, seg_stop)))
+            seg_start, seg_density = seg_stop+1, 0.0
+    
+    return [ segment for density, segment in sorted(
+        segments, key=lambda x: -x[0]) ]
 
-    def shutdown(self):
-        self.manager.shutdown()
+def write_gene_segment_data(
+        ofname, frag_lens, transcribed_regions, jns, rd_cnts):
+    """Write the gene segment data found by a single worker to ofname.
+
+    The transcribed regions and the junction counts are stored as sorted
+    integer arrays keyed by (contig, strand), so that the data from all of
+    the workers can be merged in a single pass.
+    """
+    data = {
+        'frag_lens': dict(frag_lens),
+        'rd_cnts': list(rd_cnts),
+        'transcribed_regions': dict(
+            (key, numpy.array(sorted(regions), dtype=int).reshape((-1, 2)))
+            for key, regions in transcribed_regions.iteritems()),
+        'jns': dict(
+            (key, numpy.array(sorted(
+                (start, stop, cnt) for (start, stop), cnt 
+                in key_jns.iteritems()), dtype=int).reshape((-1, 3)))
+            for key, key_jns in jns.iteritems())
+    }
+    # write to a temporary file, so that a partially written file is never 
+    # mistaken for a finished one
+    with open(ofname + ".tmp", "wb") as ofp:
+        pickle.dump(data, ofp, pickle.HIGHEST_PROTOCOL)
+    os.rename(ofname + ".tmp", ofname)
+    return
+
+def merge_gene_segment_data(fnames):
+    """Merge the data written by write_gene_segment_data.
+    
+    returns the sorted transcribed regions and junction counts ( as 
+    (start, stop, cnt) tuples ) keyed by (contig, strand), the fragment 
+    length counts and the read counts.
+    """
+    all_data = []
+    for fname in fnames:
+        with open(fname, "rb") as fp:
+            all_data.append(pickle.load(fp))
+    
+    frag_lens = defaultdict(int)
+    rd_cnts = [0.0, 0.0, 0.0]
+    keys = set()
+    for data in all_data:
+        for key, cnt in data['frag_lens'].iteritems():
+            frag_lens[key] += cnt
+        for i, val in enumerate(data['rd_cnts']):
+            rd_cnts[i] += val
+        keys.update(data['transcribed_regions'].iterkeys())
+        keys.update(data['jns'].iterkeys())
+    
+    # k-way merge the sorted per worker data
+    transcribed_regions = defaultdict(list)
+    jns = defaultdict(list)
+    for key in keys:
+        transcribed_regions[key] = [ 
+            tuple(x) for x in heapq.merge(*[
+                data['transcribed_regions'][key].tolist() for data in all_data
+                if key in data['transcribed_regions'] ]) ]
+        for jn, grp in groupby(
+                heapq.merge(*[ data['jns'][key].tolist() for data in all_data 
+                               if key in data['jns'] ]),
+                key=lambda x: (x[0], x[1])):
+            jns[key].append((jn[0], jn[1], sum(x[2] for x in grp)))
+
+    return transcribed_regions, jns, frag_lens, ReadCounts(*rd_cnts)
         
 def find_segments_and_jns_worker(
-        segments, global_gene_data,
+        (worker_index, current_segments, contigs), segments, ofname,
         rnaseq_reads, promoter_reads, polya_reads,
         ref_elements, ref_elements_to_include ):
+    """Find the transcribed regions and junctions in the segments queue.
+
+    Before each segment is processed, it's stored in current_segments as 
+    (index into contigs, start, stop), so that if this worker dies the 
+    parent can report the segment that it was processing.
+    """
     rnaseq_reads = rnaseq_reads.reload()
     if promoter_reads != None: 
         promoter_reads = promoter_reads.reload()
@@ -696,11 +891,9 @@ def find_segments_and_jns_worker(
 
     local_frag_lens = defaultdict(int)
     local_transcribed_regions = defaultdict(list)
-    local_jns = defaultdict(list)
+    local_jns = defaultdict(lambda: defaultdict(int))
     local_rd_cnts = [0.0, 0.0, 0.0]
     
-    # just use this to keep track of where we are in the queue
-    length_of_segments = segments.qsize()
     while True:
         try: 
             config.log_statement("Waiting for segment")
@@ -711,6 +904,8 @@ def find_segments_and_jns_worker(
             config.log_statement("")
             break
         config.log_statement("Finding genes and jns in %s" % str(segment) )
+        current_segments[3*worker_index:3*worker_index+3] = [
+            contigs.index(segment[0]), segment[1], segment[2]]
         try:
             ( r_transcribed_regions, r_jns, r_n_unique_reads, r_frag_lens,
                 ) = find_transcribed_regions_and_jns_in_segment(
@@ -729,32 +924,18 @@ def find_segments_and_jns_worker(
         for (rd_key, rls), fls in r_frag_lens.iteritems():
             for fl, cnt in fls.iteritems():
                 local_frag_lens[(rd_key, rls, fl)] += cnt
-        local_transcribed_regions[(segment[0], '+')].extend([
-            (start+segment[1], stop+segment[1])
-            for start, stop in r_transcribed_regions['+']])
-        local_transcribed_regions[(segment[0], '-')].extend([
-            (start+segment[1], stop+segment[1])
-            for start, stop in r_transcribed_regions['-']])
-
-        local_jns[(segment[0], '+')].extend(r_jns['+'])
-        local_jns[(segment[0], '-')].extend(r_jns['-'])
+        for strand in '+-':
+            local_transcribed_regions[(segment[0], strand)].extend([
+                (start+segment[1], stop+segment[1])
+                for start, stop in r_transcribed_regions[strand]])
+            for jn, cnt in r_jns[strand]:
+                local_jns[(segment[0], strand)][jn] += cnt
 
         for i, val in enumerate(r_n_unique_reads):
             local_rd_cnts[i] += val
 
-        if sum(local_rd_cnts) > 1e5:
-            global_gene_data.update_all_data(
-                local_frag_lens,
-                local_transcribed_regions,
-                local_jns,
-                local_rd_cnts)
-            
-            local_frag_lens = defaultdict(int)
-            local_transcribed_regions = defaultdict(list)
-            local_jns = defaultdict(list)
-            local_rd_cnts = [0.0, 0.0, 0.0]
-
-    global_gene_data.update_all_data(
+    write_gene_segment_data(
+        ofname,
         local_frag_lens,
         local_transcribed_regions,
         local_jns,
@@ -762,6 +943,43 @@ def find_segments_and_jns_worker(
     
     return
 
+def wait_on_gene_segment_workers(pids, current_segments, contigs, 
+                                 segments_queue, n_segments):
+    """Wait for the gene segment finding workers in pids to exit.
+
+    If a worker exits with an error ( or is killed ), then we kill the 
+    others, and raise an OSError that names the worker and the segment that
+    it was processing, rather than failing to merge its missing data.
+    """
+    running = dict( (pid, i) for i, pid in enumerate(pids) )
+    while len(running) > 0:
+        config.log_statement(
+            "Waiting on gene segment finding children (%i/%i segments remain, %i/%i children running)" 
+            %(segments_queue.qsize(), n_segments, len(running), len(pids)))
+        for pid, worker_index in running.items():
+            ret_pid, status = os.waitpid(pid, os.WNOHANG)
+            if ret_pid == 0: continue
+            del running[pid]
+            if status == 0: continue
+            
+            for other_pid in running:
+                os.kill(other_pid, signal.SIGKILL)
+                os.waitpid(other_pid, 0)
+            contig_index, start, stop = current_segments[
+                3*worker_index:3*worker_index+3]
+            segment = ( (contigs[contig_index], start, stop) 
+                        if contig_index >= 0 else None )
+            if os.WIFSIGNALED(status):
+                reason = "was killed by signal %i" % os.WTERMSIG(status)
+            else:
+                reason = "exited with status %i" % os.WEXITSTATUS(status)
+            raise OSError, (
+                "Gene segment finding worker %i (pid %i) %s while processing segment %s" % (
+                    worker_index, pid, reason, segment))
+        time.sleep(0.5)
+    
+    return
+
 def load_gene_bndry_bins( genes, contig, strand, contig_len ):  
     if config.VERBOSE:
         config.log_statement( 
@@ -808,6 +1026,27 @@ def load_gene_bndry_bins( genes, contig, strand, contig_len ):
     
     return gene_bndry_bins
 
+def load_gene_segments_from_bed( fp ):
+    """Load the gene segments that GeneElements.write_elements_bed wrote to fp.
+
+    Only the gene lines are used, and their blocks become the gene regions.
+    """
+    gene_segments = []
+    for line in fp:
+        data = line.split()
+        if len(data) < 12 or data[3] != 'gene': continue
+        gene = GeneElements( clean_chr_name(data[0]), data[5] )
+        start = int(data[1])
+        for size, rel_start in izip(data[10].split(","), data[11].split(",")):
+            if size == '': continue
+            region_start = start + int(rel_start)
+            gene.regions.append(SegmentBin(
+                region_start, region_start + int(size) - 1, 
+                ["ESTART",], ["ESTOP",], "GENE"))
+        gene_segments.append( gene )
+    
+    return gene_segments
+
 def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
                             ref_genes, ref_elements_to_include,
                             region_to_use=None ):
@@ -817,9 +1056,22 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
         [ reads for reads in [rnaseq_reads, promoter_reads, polya_reads]
           if reads != None ] )))
 
+    # split the genome before forking the workers, because the search for 
+    # the segment boundaries waits on its own child processes
+    config.log_statement("Splitting the genome into gene segments")
+    segments = split_genome_into_segments_by_read_density(
+        contig_lens, region_to_use, 
+        [ reads for reads in [rnaseq_reads, promoter_reads, polya_reads]
+          if reads != None ])
+    
     config.log_statement("Spawning gene segment finding children")    
     segments_queue = multiprocessing.Queue()
-    global_gene_data = GlobalGeneSegmentData(contig_lens)
+    # each child writes its data to a file in this directory
+    segment_data_dir = tempfile.mkdtemp(
+        prefix=".gene_segments", dir=config.tmp_dir)
+    segment_data_fnames = [
+        os.path.join(segment_data_dir, "%i.obj" % i) 
+        for i in xrange(config.NTHREADS) ]
     
     ref_element_types_to_include = set()
     if ref_elements_to_include.junctions: 
@@ -839,56 +1091,69 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
         ref_element_types_to_include.add('intron')
         ref_element_types_to_include.add('exon')
     
+    # the segment that each worker is processing - see 
+    # find_segments_and_jns_worker
+    contigs = sorted(contig_lens)
+    current_segments = RawArray('l', [-1,]*(3*config.NTHREADS))
+    
     pids = []
     for i in xrange(config.NTHREADS):
         pid = os.fork()
         if pid == 0:
-            find_segments_and_jns_worker(
-                segments_queue, 
-                global_gene_data,
-                rnaseq_reads, promoter_reads, polya_reads,
-                ref_genes, ref_element_types_to_include)
-            os._exit(0)
+            exit_status = 0
+            try:
+                find_segments_and_jns_worker(
+                    (i, current_segments, contigs),
+                    segments_queue, 
+                    segment_data_fnames[i],
+                    rnaseq_reads, promoter_reads, polya_reads,
+                    ref_genes, ref_element_types_to_include)
+            except Exception, inst:
+                config.log_statement( traceback.format_exc(), log=True )
+                exit_status = 1
+            finally:
+                os._exit(exit_status)
         pids.append(pid)
 
     config.log_statement("Populating gene segment queue")        
-    segments = split_genome_into_segments(contig_lens, region_to_use)
     for segment in segments: 
         segments_queue.put(segment)
     for i in xrange(config.NTHREADS): segments_queue.put('FINISHED')
     
-    while segments_queue.qsize() > 2*config.NTHREADS:
-        config.log_statement(
-            "Waiting on gene segment finding children (%i/%i segments remain)" 
-            %(segments_queue.qsize(), len(segments)))        
-        time.sleep(0.5)
+    try:
+        wait_on_gene_segment_workers(
+            pids, current_segments, contigs, segments_queue, len(segments))
+    except OSError:
+        shutil.rmtree(segment_data_dir)
+        raise
+    
+    config.log_statement("Merging gene segment data")
+    (all_transcribed_regions, all_jns, frag_lens, num_unique_reads
+     ) = merge_gene_segment_data(segment_data_fnames)
+    shutil.rmtree(segment_data_dir)
     
-    for i, pid in enumerate(pids):
-        config.log_statement(
-            "Waiting on gene segment finding children (%i/%i children remain)" 
-            %(len(pids)-i, len(pids)))
-        os.waitpid(pid, 0) 
-            
     config.log_statement("Merging gene segments")
-    merged_transcribed_regions = {}
-    for key, intervals in global_gene_data.transcribed_regions.iteritems():
-        merged_transcribed_regions[
-            key] = merge_adjacent_intervals(
-                intervals, config.MAX_EMPTY_REGION_SIZE)
-    transcribed_regions = merged_transcribed_regions
+    transcribed_regions = {}
+    for contig in contig_lens.keys():
+        for strand in '+-':
+            transcribed_regions[(contig, strand)] = merge_adjacent_intervals(
+                all_transcribed_regions[(contig, strand)], 
+                config.MAX_EMPTY_REGION_SIZE)
     
     config.log_statement("Filtering junctions")    
     filtered_jns = defaultdict(dict)
     for contig in contig_lens.keys():
         plus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '+')]: plus_jns[jn] += cnt
+        for start, stop, cnt in all_jns[(contig, '+')]: 
+            plus_jns[(start, stop)] += cnt
         minus_jns = defaultdict(int)
-        for jn, cnt in global_gene_data.jns[(contig, '-')]: minus_jns[jn] += cnt
+        for start, stop, cnt in all_jns[(contig, '-')]: 
+            minus_jns[(start, stop)] += cnt
         filtered_jns[(contig, '+')] = filter_jns(plus_jns, minus_jns)
         filtered_jns[(contig, '-')] = filter_jns(minus_jns, plus_jns)
 
     config.log_statement("Building FL dist")        
-    fl_dists = build_fl_dists_from_fls_dict(dict(global_gene_data.frag_lens))
+    fl_dists = build_fl_dists_from_fls_dict(dict(frag_lens))
         
     if ref_elements_to_include.junctions:
         for gene in ref_genes:
@@ -923,14 +1188,6 @@ def find_all_gene_segments( rnaseq_reads, promoter_reads, polya_reads,
                     continue
                 new_genes.append(new_gene)
 
-    try: 
-        num_unique_reads = ReadCounts(*[
-            float(x.value) for x in global_gene_data.num_unique_reads])
-    except AttributeError:
-        num_unique_reads = ReadCounts(*global_gene_data.num_unique_reads)
-
-    global_gene_data.shutdown()
-
     config.log_statement("")    
         
     return new_genes, fl_dists, num_unique_reads 
@@ -24,7 +24,7 @@ import math
 import random
 
 import numpy
-from scipy.special import gammaln, gamma, cbrt
+from scipy.special import gammaln, gamma, cbrt, gammainccinv
 import scipy.stats
 
 from itertools import chain
@@ -35,8 +35,6 @@ import grit.files.junctions
 import grit.files.reads
 from grit.lib.multiprocessing_utils import ProcessSafeOPStream
 
-from grit.call_peaks_support_fns import calc_moments
-
 from scipy.optimize import fmin_l_bfgs_b as minimize
 
 """ Tuneable config options - should be set by caller
@@ -57,6 +55,12 @@ BACKGROUND_FRACTION = 0.01
 MIN_NOISE_FRAC = 0.01
 SMOOTH_WIN_LEN = 10
 SPLIT_TYPE = 'optimal' # 'random' other option
+# the number of standard deviations from the mean to sum the binomial
+# moments over. The terms outside of this window are below the tolerance
+# that calc_moments used
+NULL_MOMENTS_N_SD = 10
+# the relative error bound of calc_null_moments with NULL_MOMENTS_N_SD
+NULL_MOMENTS_TOL = 1e-6
 
 MAX_NUM_ITERATIONS = 25
 N_REPS = 1
@@ -152,65 +156,205 @@ def build_control(rnaseq_reads, region, control_type, smooth_win_len=SMOOTH_WIN_
     #cov[cov < min_signal] = min_signal
     return (cov + 1e-12)/(cov.sum() + 1e-12*len(cov))
 
+def smooth_in_segments(cov, bnds, smooth_win_len, min_mean=None):
+    """Smooth cov with a moving average inside of each segment.
+    
+    The segments are [bnds[i], bnds[i+1]), and the smoothed value at a 
+    base is the same as numpy.convolve(window, segment_cov, mode='same') 
+    for a flat window of length smooth_win_len. Segments that are no 
+    longer than the window, or whose mean coverage is below min_mean, are 
+    set to their mean. All of the segments are smoothed at once with 
+    differences of the coverage cumsum.
+    """
+    rv = numpy.array(cov, dtype=float)
+    bnds = numpy.unique(numpy.clip(bnds, 0, len(rv)))
+    if len(bnds) < 2: return rv
+    seg_starts, seg_stops = bnds[:-1], bnds[1:]
+    seg_lens = seg_stops - seg_starts
+    
+    cov_cumsum = numpy.zeros(len(rv)+1, dtype=float)
+    numpy.cumsum(rv, out=cov_cumsum[1:])
+    seg_means = (cov_cumsum[seg_stops] - cov_cumsum[seg_starts])/seg_lens
+    use_mean = (seg_lens <= smooth_win_len)
+    if min_mean != None: 
+        use_mean |= (seg_means < min_mean)
+    
+    seg_ids = numpy.repeat(numpy.arange(len(seg_lens)), seg_lens)
+    positions = numpy.arange(seg_starts[0], seg_stops[-1])
+    lower = numpy.maximum(
+        positions - smooth_win_len//2, seg_starts[seg_ids])
+    upper = numpy.minimum(
+        positions + (smooth_win_len-1)//2 + 1, seg_stops[seg_ids])
+    smoothed = (cov_cumsum[upper] - cov_cumsum[lower])/smooth_win_len
+    rv[positions] = numpy.where(
+        use_mean[seg_ids], seg_means[seg_ids], smoothed)
+    return rv
+
 def build_control_in_gene_regions(
         gene, rnaseq_reads, control_type, smooth_win_len=SMOOTH_WIN_LEN):
+    """Build the control from the RNAseq coverage in the gene's regions.
+
+    The control doesn't depend on control_type, so it is cached on the 
+    gene and shared by the 5p and 3p peak calls.
+    """
     assert control_type in ('5p', '3p')
-    # get the read start coverage
-    cov = numpy.zeros(gene.stop-gene.start+1, dtype=float)
-    window = numpy.ones(smooth_win_len, dtype=float)/smooth_win_len
+    key = ('regions', smooth_win_len)
+    cached = gene.control_cov_cache.get(key)
+    if cached != None and cached[0] is rnaseq_reads: 
+        return cached[1]
+    
+    # get the read coverage, and smooth it in each region
+    cov = gene.find_coverage(rnaseq_reads)
+    bnds = [0, len(cov)]
     for x in gene.regions:
-        seg_cov = rnaseq_reads.build_read_coverage_array( 
-            gene.chrm, gene.strand, x.start, x.stop )
-        if len(seg_cov) <= smooth_win_len:
-            seg_cov = seg_cov.mean()
-        else:    
-            seg_cov = numpy.convolve(
-                window, seg_cov, mode='same')
-        cov[x.start-gene.start:x.stop-gene.start+1] = seg_cov
+        bnds.append(x.start-gene.start)
+        bnds.append(x.stop-gene.start+1)
+    cov = smooth_in_segments(cov, bnds, smooth_win_len)
+    cov = (cov + 1e-12)/(cov.sum() + 1e-12*len(cov))
+    
+    gene.control_cov_cache[key] = (rnaseq_reads, cov)
+    return cov
 
-    return (cov + 1e-12)/(cov.sum() + 1e-12*len(cov))
+def build_controls_in_gene(gene, paired_rnaseq_reads, bndries, 
+                           smooth_win_len=SMOOTH_WIN_LEN):
+    """Build the 5p and 3p controls for gene from the paired RNAseq reads.
 
-def build_control_in_gene(gene, paired_rnaseq_reads, bndries, 
-                          control_type, smooth_win_len=SMOOTH_WIN_LEN):
-    assert control_type in ('5p', '3p')
-    # get the read start coverage
-    cov = numpy.zeros(gene.stop-gene.start+1, dtype=float)
-    for rd_key, mappings in paired_rnaseq_reads:
-        for mapping in mappings:
-            poss = chain(chain(*mapping[4].cov_regions), 
-                         chain(*mapping[4].cov_regions))
-            if control_type == '3p':
-                pos = max(poss)
-            else:
-                pos = min(poss)
-            if pos < gene.start or pos > gene.stop: continue
-            cov[pos-gene.start] += mapping[-1]
+    Returns a dict keyed by control type. 
+    """
+    # get the read start and stop coverage. We stack the two, with the 3p 
+    # coverage after the 5p coverage, so that they can be built together
+    gene_len = gene.stop-gene.start+1
+    read_data = paired_rnaseq_reads.read_data
+    r1_indices = paired_rnaseq_reads.r1_indices
+    starts = read_data.read_starts(r1_indices)
+    stops = read_data.read_stops(r1_indices)
+    starts_in_gene = (starts >= gene.start)&(starts <= gene.stop)
+    stops_in_gene = (stops >= gene.start)&(stops <= gene.stop)
+    post_prbs = paired_rnaseq_reads.post_prbs
+    cov = numpy.bincount(
+        numpy.hstack((starts[starts_in_gene]-gene.start, 
+                      stops[stops_in_gene]-gene.start+gene_len)), 
+        weights=numpy.hstack((post_prbs[starts_in_gene], 
+                              post_prbs[stops_in_gene])), 
+        minlength=2*gene_len).astype(float)
     
     n_rnaseq_reads = len(paired_rnaseq_reads)
     # add the uniform background
     cov = (1-BACKGROUND_FRACTION)*cov+(
-        n_rnaseq_reads*BACKGROUND_FRACTION)/len(cov)
+        n_rnaseq_reads*BACKGROUND_FRACTION)/gene_len
     
     # smooth the signal in each segment
-    min_signal = n_rnaseq_reads*BACKGROUND_FRACTION/len(cov)
-    window = numpy.ones(smooth_win_len, dtype=float)/smooth_win_len
-    for start, stop in zip(bndries[:-1], bndries[1:]):
-        segment_signal = cov[start-gene.start:stop-gene.start+1]
-        region_len = stop - start + 1
-        region_cnt = segment_signal.sum()
-        if ( region_cnt/region_len < 1./smooth_win_len 
-             or region_len <= smooth_win_len ):
-            cov[start-gene.start:stop-gene.start+1] = region_cnt/region_len
-        else:    
-            cov[start-gene.start:stop-gene.start+1] = numpy.convolve(
-                window,segment_signal,mode='same')
-    #cov[cov < min_signal] = min_signal
-    return (cov + 1e-12)/(cov.sum() + 1e-12*len(cov))
+    bnds = numpy.array(bndries, dtype=int) - gene.start
+    bnds = numpy.hstack((bnds, bnds+gene_len))
+    cov = smooth_in_segments(
+        cov, bnds, smooth_win_len, min_mean=1./smooth_win_len)
+    
+    controls = {}
+    for control_type, control_cov in (('5p', cov[:gene_len]), 
+                                      ('3p', cov[gene_len:])):
+        controls[control_type] = (control_cov + 1e-12)/(
+            control_cov.sum() + 1e-12*gene_len)
+    return controls
 
+def build_control_in_gene(gene, paired_rnaseq_reads, bndries, 
+                          control_type, smooth_win_len=SMOOTH_WIN_LEN):
+    """Build the control_type control for gene.
+
+    The 5p and 3p controls are built together, and cached on the gene so
+    that the TSS and TES peak calls share them.
+    """
+    assert control_type in ('5p', '3p')
+    key = ('paired_reads', tuple(bndries), smooth_win_len)
+    cached = gene.control_cov_cache.get(key)
+    if cached == None or cached[0] is not paired_rnaseq_reads:
+        cached = ( paired_rnaseq_reads, build_controls_in_gene(
+            gene, paired_rnaseq_reads, bndries, smooth_win_len) )
+        gene.control_cov_cache[key] = cached
+    return cached[1][control_type]
+
+
+def calc_null_moments(ps, n, n_sd=NULL_MOMENTS_N_SD):
+    """Calculate the mean and variance of x*log(p) - log(x!), x ~ Bin(n, p), 
+       for every p in ps.
+
+    The moments are summed over the x's within n_sd standard deviations
+    (plus n_sd, so that the poisson tails are covered when n*p or n*(1-p)
+    is small) of n*p, clipped to [0, n]. The bases are sorted by the width
+    of this window so that each term is only calculated for the bases whose
+    window includes it, which makes the total work 
+    O(len(ps) + sum(sqrt(n*ps))). The moments are accumulated around the 
+    statistic's value at n*p, so that the variance doesn't lose precision 
+    when the mean is large. With the default n_sd, the moments agree with 
+    the sum over every x to within NULL_MOMENTS_TOL*max(1, |moment|).
+    """
+    ps = numpy.asarray(ps, dtype=float)
+    means = numpy.zeros(len(ps), dtype=float)
+    second_moments = numpy.zeros(len(ps), dtype=float)
+    if len(ps) == 0 or n == 0: return means, second_moments
+    
+    sds = numpy.sqrt(n*ps*(1-ps))
+    lower = numpy.clip(numpy.floor(n*ps - n_sd*sds - n_sd), 0, n).astype(int)
+    upper = numpy.clip(numpy.ceil(n*ps + n_sd*sds + n_sd), 0, n).astype(int)
+    # process the bases in order of decreasing window width, so that the 
+    # bases that need the j'th term are always a prefix
+    order = numpy.argsort(lower - upper, kind='mergesort')
+    n_terms = (upper - lower + 1)[order]
+    n_active = numpy.searchsorted(-n_terms, -numpy.arange(n_terms[0]), 
+                                  side='left')
+    
+    log_ps, log_1m_ps = numpy.log(ps)[order], numpy.log1p(-ps)[order]
+    lower = lower[order]
+    modes = numpy.clip(numpy.round(n*ps[order]), lower, upper[order])
+    shifts = modes*log_ps - gammaln(modes+1)
+    log_n_fac = gammaln(n+1)
+    for j, n_bases in enumerate(n_active):
+        xs = lower[:n_bases] + j
+        log_x_fac = gammaln(xs+1)
+        prbs = numpy.exp(
+            log_n_fac - log_x_fac - gammaln(n-xs+1)
+            + xs*log_ps[:n_bases] + (n-xs)*log_1m_ps[:n_bases])
+        values = xs*log_ps[:n_bases] - log_x_fac - shifts[:n_bases]
+        means[:n_bases] += prbs*values
+        second_moments[:n_bases] += prbs*values*values
+    
+    rv_means = numpy.empty(len(ps), dtype=float)
+    rv_means[order] = means + shifts
+    rv_vars = numpy.empty(len(ps), dtype=float)
+    rv_vars[order] = second_moments - means**2
+    return rv_means, rv_vars
+
+class NullMoments(object):
+    """The cumulative sums of the null moments of the region test 
+       statistic for a control coverage array.
+
+    The moments only depend on the number of noise reads, so the most 
+    recent ones are kept and reused until noise_n changes.
+    """
+    def __init__(self, control_cov):
+        self.control_cov = control_cov
+        self._noise_n = None
+        self._cumsums = None
+
+    def cumsums(self, noise_n):
+        if noise_n != self._noise_n:
+            means, variances = calc_null_moments(self.control_cov, noise_n)
+            self._cumsums = (
+                numpy.hstack((numpy.zeros(1), means.cumsum())),
+                numpy.hstack((numpy.zeros(1), variances.cumsum())) )
+            self._noise_n = noise_n
+        return self._cumsums
 
 class TestSignificance(object):
+    """Test regions of the signal for significance against the control.
+
+    The signal cumsums and zero intervals only depend on the signal, so 
+    they are built once, and set_noise_frac only updates the noise 
+    dependent null moments. The split bases of a region don't depend on
+    the noise, so they are cached, and the regions that were tested 
+    under the previous noise fraction are retested in a single batch 
+    when the noise fraction changes. 
+    """
     def __init__(self, signal_cov, control_cov, noise_frac, min_peak_size):
-        self.noise_n = int(noise_frac*sum(signal_cov)) + 1
         self.signal_n = sum(signal_cov)
         self.min_peak_size = min_peak_size
         
@@ -227,57 +371,90 @@ class TestSignificance(object):
         self.zero_intervals = [ 
             (start, stop) for start, stop in zip(starts, stops)
             if stop - start + 1 >= MIN_EMPTY_REGION_SIZE ]
-        
-        #### initialize data to test for region significance
-        # initialize the null data
-        null_means = [0.,]
-        null_vars = [0.,]
-        for i, p in enumerate(control_cov):
-            mean, var = calc_moments(p, self.noise_n)
-            null_means.append(mean)
-            null_vars.append(var)
-
-        self.null_means_cumsum = numpy.array(null_means).cumsum()
-        self.null_variances_cumsum = numpy.array(null_vars).cumsum()
+        self._split_bases = {}
         
         # initialize the signal test statistic
+        self.control_cov = control_cov
         lhds = ( signal_cov*numpy.log(control_cov)
                  - gammaln(1+signal_cov) )
         self.signal_lhd_cumsum = numpy.hstack((
             numpy.zeros(1), lhds.cumsum()))
         self.signal_cnts_cumsum = numpy.hstack((
             numpy.zeros(1), signal_cov.cumsum()))
+        
+        #### initialize data to test for region significance
+        self.null_moments = NullMoments(control_cov)
+        self.noise_n = None
+        self._is_significant = {}
+        self._tested_regions = set()
+        self.set_noise_frac(noise_frac)
     
-    def __call__(self, start, stop, alpha):
+    def set_noise_frac(self, noise_frac):
+        noise_n = int(noise_frac*self.signal_n) + 1
+        if noise_n == self.noise_n: return
+        self.noise_n = noise_n
+        self.null_means_cumsum, self.null_variances_cumsum = \
+            self.null_moments.cumsums(self.noise_n)
+        # retest the regions that the previous search tested together
+        prev_tested = self._tested_regions
+        self._is_significant = {}
+        self._tested_regions = set()
+        for alpha in set(alpha for start, stop, alpha in prev_tested):
+            regions = [ (start, stop) for start, stop, region_alpha 
+                        in prev_tested if region_alpha == alpha ]
+            self.test_regions(regions, alpha)
+        return
+    
+    def test_regions(self, regions, alpha):
+        """Test every (start, stop) region in regions, and cache the results.
+
+        """
+        starts = numpy.array([start for start, stop in regions], dtype=int)
+        stops = numpy.array([stop for start, stop in regions], dtype=int)
         # if there are more reads in this region than noise reads, 
         # then this region must include some signal
-        sig_cnt = ( 
-            self.signal_cnts_cumsum[stop] 
-            - self.signal_cnts_cumsum[start] )
-        if sig_cnt > self.noise_n: return True
+        sig_cnts = ( self.signal_cnts_cumsum[stops] 
+                     - self.signal_cnts_cumsum[starts] )
         
-        mean = -(self.null_means_cumsum[stop] 
-                 - self.null_means_cumsum[start] + 1)
-        variance = ( self.null_variances_cumsum[stop] 
-                     - self.null_variances_cumsum[start] + 1)
+        mean = -(self.null_means_cumsum[stops] 
+                 - self.null_means_cumsum[starts] + 1)
+        variance = ( self.null_variances_cumsum[stops] 
+                     - self.null_variances_cumsum[starts] + 1)
         
         scale = variance/mean
         shape = mean/scale
         
-        dist = scipy.stats.gamma(shape, scale=scale)
-        critical_value = -scipy.stats.gamma(
-            shape, scale=scale).isf(alpha)
+        # this is -gamma(shape, scale=scale).isf(alpha)
+        critical_values = -scale*gammainccinv(shape, alpha)
         
         # calculate the value of the observed likelihood
-        obs_lhd = ( self.signal_lhd_cumsum[stop] 
-                    - self.signal_lhd_cumsum[start] )
+        obs_lhds = ( self.signal_lhd_cumsum[stops] 
+                     - self.signal_lhd_cumsum[starts] )
         
-        return obs_lhd < critical_value
+        rv = (sig_cnts > self.noise_n) | (obs_lhds < critical_values)
+        for region, is_sig in zip(regions, rv.tolist()):
+            self._is_significant[(region[0], region[1], alpha)] = is_sig
+        return rv
+    
+    def __call__(self, start, stop, alpha):
+        key = (start, stop, alpha)
+        self._tested_regions.add(key)
+        if key not in self._is_significant:
+            self.test_regions([(start, stop),], alpha)
+        return self._is_significant[key]
     
     def find_split_bases(self, r_start, r_stop):
         """Returns a closed,open interval of bases to split. 
 
         """
+        if SPLIT_TYPE == 'random':
+            return self._find_split_bases(r_start, r_stop)
+        key = (r_start, r_stop)
+        if key not in self._split_bases:
+            self._split_bases[key] = self._find_split_bases(r_start, r_stop)
+        return self._split_bases[key]
+    
+    def _find_split_bases(self, r_start, r_stop):
         r_start += self.min_peak_size
         r_stop -= self.min_peak_size
         assert r_stop >= r_start
@@ -316,10 +493,13 @@ class TestSignificance(object):
         return rv, rv
 
 def find_noise_regions(signal_cov, control_cov, 
-                       noise_frac, alpha, min_peak_size):
+                       noise_frac, alpha, min_peak_size, is_significant=None):
     alpha = alpha/(2*len(signal_cov))
-    is_significant = TestSignificance(
-        signal_cov, control_cov, noise_frac, min_peak_size)
+    if is_significant is None:
+        is_significant = TestSignificance(
+            signal_cov, control_cov, noise_frac, min_peak_size)
+    else:
+        is_significant.set_noise_frac(noise_frac)
     noise_regions = []
     if signal_cov.sum() == 0:
         return [(0, len(signal_cov)),]
@@ -477,6 +657,7 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
                 min_peak_size, max_peak_size,
                 max_exp_sum_fraction, max_exp_mean_cvg_fraction):
     signal = numpy.ones(len(signal_cov))
+    is_significant = None
     for k in xrange(N_REPS):
         noise_frac = 1.0
         noise_regions = [(0, len(signal)),]
@@ -495,9 +676,16 @@ def call_peaks( signal_cov, original_control_cov, reads_type,
                 config.log_statement(
                     "Iter %i: Noise Frac %.2f%%\tReg Coef: %s" % (
                         i+1, noise_frac*100, reg_coef))
+            # the signal statistics only need to be rebuilt if the 
+            # control changed
+            if ( is_significant is None 
+                 or is_significant.control_cov is not control_cov ):
+                is_significant = TestSignificance(
+                    signal_cov, control_cov, noise_frac, min_peak_size)
             noise_regions = find_noise_regions(
                 signal_cov, control_cov, 
-                noise_frac, alpha=alpha, min_peak_size=min_peak_size )
+                noise_frac, alpha=alpha, min_peak_size=min_peak_size,
+                is_significant=is_significant )
             new_noise_frac = estimate_noise_frac(
                 noise_regions, signal_cov, control_cov, min_noise_frac)
             new_reg_coef, control_cov = \
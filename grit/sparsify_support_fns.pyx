@@ -22,95 +22,312 @@ USELESS_GLOBAL_VAR='I need to do this so that cython creates a c_init function'
 import numpy as np
 cimport numpy as np
 
-cdef extern from "math.h":
-    double log(double)
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport log
 
-cdef extern from "stdlib.h":
-    ctypedef unsigned int size_t
-    void* calloc( size_t n, size_t size )
-    void free(void *ptr)
+# the frequency that we give to bins that no transcript can produce reads in
+cdef double MIN_BIN_FREQ = 1e-16
+
+# design matrices with fewer bins than this aren't worth spinning up threads
+# for. The gradient is summed over chunks of BINS_PER_CHUNK bins, so that 
+# every thread can accumulate into its own row-major buffer
+cdef Py_ssize_t PARALLEL_MIN_NUM_BINS = 8192
+cdef Py_ssize_t BINS_PER_CHUNK = 2048
 
-cimport cython
 @cython.boundscheck(False)
-def calc_lhd( np.ndarray[np.double_t, ndim=1] freqs not None, 
-              np.ndarray[np.int_t, ndim=1] observed_array not None, 
-              np.ndarray[np.double_t, ndim=2] expected_array not None ):
-    cdef int num_transcripts = freqs.shape[0]
-    cdef int num_bins = expected_array.shape[0]
-    # build the expected bin frequencies
+@cython.wraparound(False)
+cdef inline double calc_bin_freq( const double[::1] freqs, 
+                                  const double[:, ::1] expected_array, 
+                                  Py_ssize_t i ) nogil:
+    cdef Py_ssize_t j
+    cdef double freq = MIN_BIN_FREQ
+    for j in range(expected_array.shape[1]):
+        freq += freqs[j]*expected_array[i,j]
+    return freq
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double calc_bin_freqs( const double[::1] freqs, 
+                            const np.int64_t[::1] observed_array, 
+                            const double[:, ::1] expected_array,
+                            double[::1] bin_freqs ):
+    """Fill bin_freqs with the expected bin frequencies, and return the lhd.
+
+    """
+    cdef Py_ssize_t num_bins = expected_array.shape[0]
+    cdef Py_ssize_t i
+    cdef double freq
     cdef double lhd = 0
-    cdef double freq = 0
-    cdef int i = 0
-    cdef int j = 0
-    for i in range(num_bins):
-        # calculate this bin's frequency
-        freq = 1e-16
-        for j in range(num_transcripts):
-            freq += freqs[j]*expected_array[i,j]
-        
-        lhd += observed_array[i]*log(freq)
-    
+    if num_bins < PARALLEL_MIN_NUM_BINS:
+        for i in range(num_bins):
+            freq = calc_bin_freq(freqs, expected_array, i)
+            bin_freqs[i] = freq
+            lhd += observed_array[i]*log(freq)
+    else:
+        for i in prange(num_bins, nogil=True, schedule='static'):
+            freq = calc_bin_freq(freqs, expected_array, i)
+            bin_freqs[i] = freq
+            lhd += observed_array[i]*log(freq)
     return lhd
 
 @cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-def calc_gradient( np.ndarray[np.double_t, ndim=1] freqs not None, 
-                    np.ndarray[np.int_t, ndim=1] observed_array not None, 
-                    np.ndarray[np.double_t, ndim=2] expected_array not None ):
-    cdef int num_transcripts = freqs.shape[0]
-    cdef int num_bins = expected_array.shape[0]
-
-    cdef int i = 0
-    cdef int j = 0
-    cdef double* weights = <double *>calloc( num_bins, sizeof( double ) )
+cdef void accumulate_weighted_rows( const np.int64_t[::1] observed_array, 
+                                    const double[:, ::1] expected_array,
+                                    const double[::1] bin_freqs,
+                                    Py_ssize_t start, Py_ssize_t stop,
+                                    double[:, ::1] rv, 
+                                    Py_ssize_t rv_row ) nogil:
+    """Add observed_i/freq_i*expected_array[i,:] to rv[rv_row,:] for 
+       start <= i < stop.
+
+    """
+    cdef Py_ssize_t i, j
+    cdef double weight
+    for i in range(start, stop):
+        if observed_array[i] == 0: continue
+        weight = observed_array[i]/bin_freqs[i]
+        for j in range(expected_array.shape[1]):
+            rv[rv_row,j] += weight*expected_array[i,j]
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef calc_gradient_from_bin_freqs( const np.int64_t[::1] observed_array, 
+                                   const double[:, ::1] expected_array,
+                                   const double[::1] bin_freqs ):
+    cdef Py_ssize_t num_bins = expected_array.shape[0]
+    cdef Py_ssize_t num_transcripts = expected_array.shape[1]
+    cdef Py_ssize_t num_chunks = (num_bins + BINS_PER_CHUNK - 1)//BINS_PER_CHUNK
+    cdef Py_ssize_t chunk, start, stop
+    
+    if num_bins < PARALLEL_MIN_NUM_BINS:
+        gradient = np.zeros((1, num_transcripts), dtype=np.double)
+        accumulate_weighted_rows( 
+            observed_array, expected_array, bin_freqs, 0, num_bins, 
+            gradient, 0)
+        return gradient[0]
+    
+    # walk the rows of each chunk in order, and then sum the chunks. This 
+    # keeps the memory access sequential, and the sum doesn't depend on 
+    # the number of threads
+    chunk_gradients = np.zeros((num_chunks, num_transcripts), dtype=np.double)
+    cdef double[:, ::1] chunk_gradients_view = chunk_gradients
+    for chunk in prange(num_chunks, nogil=True, schedule='static'):
+        start = chunk*BINS_PER_CHUNK
+        stop = start + BINS_PER_CHUNK
+        if stop > num_bins: stop = num_bins
+        accumulate_weighted_rows( 
+            observed_array, expected_array, bin_freqs, start, stop, 
+            chunk_gradients_view, chunk)
+    return chunk_gradients.sum(0)
+
+def calc_lhd( const double[::1] freqs not None, 
+              const np.int64_t[::1] observed_array not None, 
+              const double[:, ::1] expected_array not None ):
+    bin_freqs = np.empty(expected_array.shape[0], dtype=np.double)
+    return calc_bin_freqs(freqs, observed_array, expected_array, bin_freqs)
+
+def calc_gradient( const double[::1] freqs not None, 
+                   const np.int64_t[::1] observed_array not None, 
+                   const double[:, ::1] expected_array not None ):
+    """Return minus the gradient of the log likelihood.
+
+    """
+    bin_freqs = np.empty(expected_array.shape[0], dtype=np.double)
+    calc_bin_freqs(freqs, observed_array, expected_array, bin_freqs)
+    return -calc_gradient_from_bin_freqs(
+        observed_array, expected_array, bin_freqs)
+
+def calc_lhd_and_gradient( const double[::1] freqs not None, 
+                           const np.int64_t[::1] observed_array not None, 
+                           const double[:, ::1] expected_array not None ):
+    """Return the log likelihood and calc_gradient from one pass over the 
+       bin frequencies.
+
+    """
+    bin_freqs = np.empty(expected_array.shape[0], dtype=np.double)
+    lhd = calc_bin_freqs(freqs, observed_array, expected_array, bin_freqs)
+    gradient = calc_gradient_from_bin_freqs(
+        observed_array, expected_array, bin_freqs)
+    return lhd, -gradient
+
+###############################################################################
+#
+# Kernels for design matrices that are stored as scipy.sparse CSR arrays. 
+# They take the matrix's data, indices and indptr arrays.
+#
+###############################################################################
+
+ctypedef fused csr_index_t:
+    np.int32_t
+    np.int64_t
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double calc_csr_bin_freq( const double[::1] freqs, 
+                                      const double[::1] data, 
+                                      const csr_index_t[::1] indices, 
+                                      const csr_index_t[::1] indptr, 
+                                      Py_ssize_t i ) nogil:
+    cdef Py_ssize_t k
+    cdef double freq = MIN_BIN_FREQ
+    for k in range(indptr[i], indptr[i+1]):
+        freq += freqs[indices[k]]*data[k]
+    return freq
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double calc_csr_bin_freqs( const double[::1] freqs, 
+                                const np.int64_t[::1] observed_array, 
+                                const double[::1] data, 
+                                const csr_index_t[::1] indices, 
+                                const csr_index_t[::1] indptr,
+                                double[::1] bin_freqs ):
+    """Fill bin_freqs with the expected bin frequencies, and return the lhd.
+
+    """
+    cdef Py_ssize_t num_bins = indptr.shape[0] - 1
+    cdef Py_ssize_t i
     cdef double freq
-    for i in range(num_bins):
-        # calculate this bin's frequency
-        freq = 1e-16
-        for j in range(num_transcripts):
-            freq += freqs[j]*expected_array[i,j]
-        weights[i] = observed_array[i]/freq
+    cdef double lhd = 0
+    if num_bins < PARALLEL_MIN_NUM_BINS:
+        for i in range(num_bins):
+            freq = calc_csr_bin_freq(freqs, data, indices, indptr, i)
+            bin_freqs[i] = freq
+            lhd += observed_array[i]*log(freq)
+    else:
+        for i in prange(num_bins, nogil=True, schedule='static'):
+            freq = calc_csr_bin_freq(freqs, data, indices, indptr, i)
+            bin_freqs[i] = freq
+            lhd += observed_array[i]*log(freq)
+    return lhd
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void accumulate_weighted_csr_rows( const np.int64_t[::1] observed_array, 
+                                        const double[::1] data, 
+                                        const csr_index_t[::1] indices, 
+                                        const csr_index_t[::1] indptr,
+                                        const double[::1] bin_freqs,
+                                        Py_ssize_t start, Py_ssize_t stop,
+                                        double[:, ::1] rv, 
+                                        Py_ssize_t rv_row ) nogil:
+    cdef Py_ssize_t i, k
+    cdef double weight
+    for i in range(start, stop):
+        if observed_array[i] == 0: continue
+        weight = observed_array[i]/bin_freqs[i]
+        for k in range(indptr[i], indptr[i+1]):
+            rv[rv_row,indices[k]] += weight*data[k]
+    return
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef calc_csr_gradient_from_bin_freqs( const np.int64_t[::1] observed_array, 
+                                       const double[::1] data, 
+                                       const csr_index_t[::1] indices, 
+                                       const csr_index_t[::1] indptr,
+                                       Py_ssize_t num_transcripts,
+                                       const double[::1] bin_freqs ):
+    cdef Py_ssize_t num_bins = indptr.shape[0] - 1
+    cdef Py_ssize_t num_chunks = (num_bins + BINS_PER_CHUNK - 1)//BINS_PER_CHUNK
+    cdef Py_ssize_t chunk, start, stop
     
-    gradient = np.zeros( num_transcripts, dtype=np.double )
-    cdef double curr_grad_value
-    for i in range(num_transcripts):
-        curr_grad_value = 0
-        for j in range(num_bins):
-            curr_grad_value += weights[j]*expected_array[j,i]
-        gradient[i] = curr_grad_value
+    # see calc_gradient_from_bin_freqs
+    if num_bins < PARALLEL_MIN_NUM_BINS: num_chunks = 1
+    chunk_gradients = np.zeros((num_chunks, num_transcripts), dtype=np.double)
+    cdef double[:, ::1] chunk_gradients_view = chunk_gradients
+    if num_chunks == 1:
+        accumulate_weighted_csr_rows( 
+            observed_array, data, indices, indptr, bin_freqs, 0, num_bins, 
+            chunk_gradients_view, 0)
+        return chunk_gradients[0]
     
-    return -gradient
+    for chunk in prange(num_chunks, nogil=True, schedule='static'):
+        start = chunk*BINS_PER_CHUNK
+        stop = start + BINS_PER_CHUNK
+        if stop > num_bins: stop = num_bins
+        accumulate_weighted_csr_rows( 
+            observed_array, data, indices, indptr, bin_freqs, start, stop, 
+            chunk_gradients_view, chunk)
+    return chunk_gradients.sum(0)
+
+cdef calc_csr_lhd_and_maybe_gradient( const double[::1] freqs, 
+                                      const np.int64_t[::1] observed_array, 
+                                      const double[::1] data, 
+                                      const csr_index_t[::1] indices, 
+                                      const csr_index_t[::1] indptr,
+                                      bint find_gradient ):
+    bin_freqs = np.empty(indptr.shape[0] - 1, dtype=np.double)
+    cdef double[::1] bin_freqs_view = bin_freqs
+    lhd = calc_csr_bin_freqs(
+        freqs, observed_array, data, indices, indptr, bin_freqs_view)
+    if not find_gradient:
+        return lhd, None
+    gradient = calc_csr_gradient_from_bin_freqs(
+        observed_array, data, indices, indptr, freqs.shape[0], bin_freqs_view)
+    return lhd, -gradient
+
+def dispatch_csr_kernel( freqs, observed_array, data, indices, indptr, 
+                         bint find_gradient ):
+    # Cython can't build def functions with const fused memoryview 
+    # arguments, so we pick the index type here
+    if indices.dtype == np.int32 and indptr.dtype == np.int32:
+        return calc_csr_lhd_and_maybe_gradient[np.int32_t](
+            freqs, observed_array, data, indices, indptr, find_gradient)
+    return calc_csr_lhd_and_maybe_gradient[np.int64_t](
+        freqs, observed_array, data, 
+        np.ascontiguousarray(indices, dtype=np.int64), 
+        np.ascontiguousarray(indptr, dtype=np.int64), find_gradient)
+
+def calc_csr_lhd( freqs, observed_array, data, indices, indptr ):
+    return dispatch_csr_kernel(
+        freqs, observed_array, data, indices, indptr, False)[0]
+
+def calc_csr_gradient( freqs, observed_array, data, indices, indptr ):
+    """Return minus the gradient of the log likelihood.
+
+    """
+    return dispatch_csr_kernel(
+        freqs, observed_array, data, indices, indptr, True)[1]
 
+def calc_csr_lhd_and_gradient( freqs, observed_array, data, indices, indptr ):
+    return dispatch_csr_kernel(
+        freqs, observed_array, data, indices, indptr, True)
 
 @cython.boundscheck(False)
+@cython.wraparound(False)
 @cython.cdivision(True)
-def calc_hessian( np.ndarray[np.double_t, ndim=1] freqs not None, 
-                  np.ndarray[np.int_t, ndim=1] observed_array not None, 
-                  np.ndarray[np.double_t, ndim=2] expected_array not None ):
-    cdef int num_transcripts = freqs.shape[0]
-    cdef int num_bins = expected_array.shape[0]
-
-    cdef int i = 0
-    cdef int j = 0
-    cdef int k = 0
+def calc_hessian( const double[::1] freqs not None, 
+                  const np.int64_t[::1] observed_array not None, 
+                  const double[:, ::1] expected_array not None ):
+    cdef Py_ssize_t num_transcripts = expected_array.shape[1]
+    cdef Py_ssize_t num_bins = expected_array.shape[0]
+    cdef Py_ssize_t i, j, k
+    cdef double weight, row_value
     
-    cdef double* weights = <double *>calloc( num_bins, sizeof( double ) )
-    cdef double freq
+    bin_freqs = np.empty(num_bins, dtype=np.double)
+    cdef double[::1] bin_freqs_view = bin_freqs
+    calc_bin_freqs(freqs, observed_array, expected_array, bin_freqs_view)
+
+    # accumulate the upper triangle row by row, and then reflect it
+    hessian = np.zeros( (num_transcripts, num_transcripts), dtype=np.double )
+    cdef double[:, ::1] hessian_view = hessian
     for i in range(num_bins):
-        # calculate this bin's frequency
-        freq = 0
+        if observed_array[i] == 0: continue
+        weight = observed_array[i]/(bin_freqs_view[i]*bin_freqs_view[i])
         for j in range(num_transcripts):
-            freq += freqs[j]*expected_array[i,j]
-        weights[i] = observed_array[i]/(freq*freq)
+            row_value = weight*expected_array[i,j]
+            if row_value == 0: continue
+            for k in range(j, num_transcripts):
+                hessian_view[j,k] += row_value*expected_array[i,k]
     
-    hessian = np.zeros( (num_transcripts, num_transcripts), dtype=np.double )
-    cdef double curr_hessian_value
-    for i in range(num_transcripts):
-        for j in range(num_transcripts):
-            curr_hessian_value = 0
-            for k in range(num_bins):
-                curr_hessian_value += \
-                    weights[k]*expected_array[k,i]*expected_array[k,j]
-            hessian[i,j] = curr_hessian_value
+    for j in range(num_transcripts):
+        for k in range(j):
+            hessian_view[j,k] = hessian_view[k,j]
     
     return hessian
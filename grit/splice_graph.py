@@ -0,0 +1,199 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+
+# node types
+SEGMENT, TSS, TES, EXON = 0, 1, 2, 3
+NODE_TYPE_NAMES = ['segment', 'TSS', 'TES', 'exon']
+
+# edge types
+ADJACENT, SPLICE, TSS_EDGE, TES_EDGE = 0, 1, 2, 3
+EDGE_TYPE_NAMES = ['adjacent', 'splice', 'tss', 'tes']
+
+# segment boundary labels are stored as bitmasks. The labels are in sorted
+# order, so iterating over the set bits yields sorted labels
+LABELS = [ 'D_JN', 'EMPTY_START', 'EMPTY_STOP', 'GENE_BNDRY',
+           'R_JN', 'TES', 'TSS' ]
+LABEL_BITS = dict( (label, 1 << i) for i, label in enumerate(LABELS) )
+
+def labels_to_bitmask(labels):
+    rv = 0
+    for label in labels:
+        rv |= LABEL_BITS[label]
+    return rv
+
+def bitmask_to_labels(bitmask):
+    return [ label for i, label in enumerate(LABELS) if bitmask & (1 << i) ]
+
+class NotADAGError(ValueError):
+    pass
+
+class SpliceGraph(object):
+    """A splice graph stored in numpy arrays.
+
+    Nodes are numbered 0..n_nodes-1, and store a type, their genomic bounds
+    and their left and right boundary label bitmasks. Edges store their
+    source and destination nodes, a type and a read count, and are sorted
+    by source node ( stably, so the successors of a node are in the order
+    that the edges were given ) so that the successors of node i are
+    edge_dsts[succ_indptr[i]:succ_indptr[i+1]]. pred_edges orders the edge
+    indices by destination node in the same way.
+
+    Expression estimates are stored in (n, 3) arrays of
+    (fpkm_lb, fpkm, fpkm_ub), that are nan until they are set. Objects for
+    the nodes that need more data than this ( e.g. the peak coverage of a
+    TSS ) can be stored in node_bins.
+    """
+    def __init__(self, node_types, starts, stops,
+                 edge_srcs, edge_dsts, edge_types, edge_cnts=None,
+                 left_labels=None, right_labels=None):
+        self.node_types = numpy.array(node_types, dtype=numpy.int8)
+        self.n_nodes = len(self.node_types)
+        self.starts = numpy.array(starts, dtype=numpy.int64)
+        self.stops = numpy.array(stops, dtype=numpy.int64)
+        assert len(self.starts) == len(self.stops) == self.n_nodes
+        self.left_labels = numpy.zeros(self.n_nodes, dtype=numpy.uint8)
+        if left_labels is not None: self.left_labels[:] = left_labels
+        self.right_labels = numpy.zeros(self.n_nodes, dtype=numpy.uint8)
+        if right_labels is not None: self.right_labels[:] = right_labels
+
+        edge_srcs = numpy.array(edge_srcs, dtype=numpy.int64)
+        self.n_edges = len(edge_srcs)
+        order = numpy.argsort(edge_srcs, kind='mergesort')
+        self.edge_srcs = edge_srcs[order]
+        self.edge_dsts = numpy.array(edge_dsts, dtype=numpy.int64)[order]
+        self.edge_types = numpy.array(edge_types, dtype=numpy.int8)[order]
+        if edge_cnts is None:
+            self.edge_cnts = numpy.zeros(self.n_edges, dtype=float)
+        else:
+            self.edge_cnts = numpy.array(edge_cnts, dtype=float)[order]
+        assert ( len(self.edge_dsts) == len(self.edge_types)
+                 == len(self.edge_cnts) == self.n_edges )
+        assert self.n_edges == 0 or (
+            self.edge_srcs.max() < self.n_nodes
+            and self.edge_dsts.max() < self.n_nodes )
+
+        self.succ_indptr = numpy.zeros(self.n_nodes+1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(self.edge_srcs, minlength=self.n_nodes),
+                     out=self.succ_indptr[1:])
+        self.pred_edges = numpy.argsort(self.edge_dsts, kind='mergesort')
+        self.pred_indptr = numpy.zeros(self.n_nodes+1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(self.edge_dsts, minlength=self.n_nodes),
+                     out=self.pred_indptr[1:])
+
+        self.node_fpkms = numpy.empty((self.n_nodes, 3), dtype=float)
+        self.node_fpkms.fill(numpy.nan)
+        self.edge_fpkms = numpy.empty((self.n_edges, 3), dtype=float)
+        self.edge_fpkms.fill(numpy.nan)
+        self.node_bins = {}
+        return
+
+    def __len__(self):
+        return self.n_nodes
+
+    def successors(self, node):
+        return self.edge_dsts[self.succ_indptr[node]:self.succ_indptr[node+1]]
+
+    def successor_edges(self, node):
+        return numpy.arange(self.succ_indptr[node], self.succ_indptr[node+1])
+
+    def out_edges(self, nodes):
+        """Return the indices of the edges out of any of nodes.
+
+        """
+        nodes = numpy.asarray(nodes, dtype=numpy.int64)
+        starts = self.succ_indptr[nodes]
+        n_out = self.succ_indptr[nodes+1] - starts
+        return ( numpy.repeat(starts - n_out.cumsum() + n_out, n_out)
+                 + numpy.arange(n_out.sum()) )
+
+    def predecessors(self, node):
+        return self.edge_srcs[self.predecessor_edges(node)]
+
+    def predecessor_edges(self, node):
+        return self.pred_edges[
+            self.pred_indptr[node]:self.pred_indptr[node+1]]
+
+    def without_edges(self, edges):
+        """Return a copy of this graph with edges removed.
+
+        The nodes, and their expression and bins, are unchanged.
+        """
+        keep = numpy.ones(self.n_edges, dtype=bool)
+        keep[edges] = False
+        rv = SpliceGraph(
+            self.node_types, self.starts, self.stops,
+            self.edge_srcs[keep], self.edge_dsts[keep], 
+            self.edge_types[keep], self.edge_cnts[keep],
+            self.left_labels, self.right_labels)
+        rv.node_fpkms[:] = self.node_fpkms
+        rv.edge_fpkms[:] = self.edge_fpkms[keep]
+        rv.node_bins.update(self.node_bins)
+        return rv
+
+    def nodes_of_type(self, node_type):
+        return numpy.flatnonzero(self.node_types == node_type)
+
+    def edges_of_type(self, edge_type):
+        return numpy.flatnonzero(self.edge_types == edge_type)
+
+    def node_lengths(self):
+        return self.stops - self.starts + 1
+
+    def topological_levels(self):
+        """Return a list of node arrays, such that every predecessor of a
+           node is in an earlier level.
+
+        Raises NotADAGError if the graph has a cycle.
+        """
+        in_degree = self.pred_indptr[1:] - self.pred_indptr[:-1]
+        levels = []
+        level = numpy.flatnonzero(in_degree == 0)
+        n_visited = 0
+        while len(level) > 0:
+            levels.append(level)
+            n_visited += len(level)
+            # remove the edges out of this level
+            dsts = self.edge_dsts[self.out_edges(level)]
+            numpy.subtract.at(in_degree, dsts, 1)
+            dsts = numpy.unique(dsts)
+            level = dsts[in_degree[dsts] == 0]
+        if n_visited < self.n_nodes:
+            raise NotADAGError, "The splice graph contains a cycle"
+        return levels
+
+    def is_dag(self):
+        try:
+            self.topological_levels()
+        except NotADAGError:
+            return False
+        return True
+
+    def set_node_expression(self, nodes, fpkms):
+        fpkms = numpy.asarray(fpkms, dtype=float)
+        assert not numpy.isnan(fpkms).any()
+        self.node_fpkms[nodes] = fpkms
+        return
+
+    def set_edge_expression(self, edges, fpkms):
+        fpkms = numpy.asarray(fpkms, dtype=float)
+        assert not numpy.isnan(fpkms).any()
+        self.edge_fpkms[edges] = fpkms
+        return
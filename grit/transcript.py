@@ -20,6 +20,8 @@ along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
 import os, sys
 
 import tempfile
+
+import numpy
 import cPickle as pickle
 
 from itertools import chain, izip
@@ -92,6 +94,9 @@ class Gene( object ):
         return    
 
     def find_nonoverlapping_boundaries( self ):
+        if isinstance( self.transcripts, TranscriptSet ):
+            return self.transcripts.exon_boundaries().tolist()
+        
         boundaries = set()
         for transcript in self.transcripts:
             for exon in transcript.exons:
@@ -104,8 +109,8 @@ class Gene( object ):
         if ofname == None:
             opdir = tempfile.mkdtemp()
             ofname = os.path.join(opdir, self.id + ".gene")
-        with open(ofname, "w") as ofp:
-            pickle.dump(self, ofp)
+        with open(ofname, "wb") as ofp:
+            pickle.dump(self, ofp, protocol=pickle.HIGHEST_PROTOCOL)
         return ofname
     
     def find_transcribed_regions( self ):
@@ -412,3 +417,148 @@ class Transcript( object ):
                          self.exons[0][1]) )
         
         assert False
+
+# attributes that Transcript computes from its exons and cds region, and so 
+# that a TranscriptSet doesn't need to store
+DERIVED_TRANSCRIPT_ATTRIBUTES = set((
+    'exon_bnds', 'start', 'stop', 'exons', 'introns', 'is_protein_coding',
+    'start_codon', 'stop_codon', 'cds_exons', 'fp_utr_exons', 'tp_utr_exons',
+    'us_exons', 'ds_exons', '_seq'))
+TRANSCRIPT_INIT_KWARGS = (
+    'score', 'fpkm', 'fpk', 'promoter', 'polya_region', 'coding_sequence',
+    'conf_lo', 'conf_hi', 'frac', 'gene_name', 'name')
+
+class TranscriptSet( object ):
+    """The transcripts of a gene, stored compactly.
+
+    The exon boundaries of all of the transcripts are stored in one int32 
+    array, so that transcript i's exon boundaries are 
+    exon_bnds[offsets[i]:offsets[i+1]]. The other attributes are only 
+    stored when they are set, and chrm, strand and gene_id are only stored 
+    for the transcripts that differ from the set's values. 
+
+    Indexing and iterating build Transcript objects on demand, so changes 
+    to them are not kept unless the transcript is assigned back.
+    """
+    def __init__(self, chrm, strand, gene_id, exon_bnds, offsets, ids, 
+                 attributes=None):
+        self.chrm = chrm
+        self.strand = strand
+        self.gene_id = gene_id
+        self.exon_bnds = numpy.array(exon_bnds, dtype=numpy.int32)
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.ids = list(ids)
+        assert len(self.offsets) == len(self.ids) + 1
+        assert self.offsets[-1] == len(self.exon_bnds)
+        # map from a transcript index to a dict of its other attributes
+        self.attributes = {} if attributes is None else attributes
+        return
+
+    @staticmethod
+    def _extract_attributes(transcript, chrm, strand, gene_id):
+        attrs = {}
+        for key, val in transcript.__dict__.iteritems():
+            if key in DERIVED_TRANSCRIPT_ATTRIBUTES or key == 'id': continue
+            if val is None: continue
+            if key == 'chrm' and val == chrm: continue
+            if key == 'strand' and val == strand: continue
+            if key == 'gene_id' and val == gene_id: continue
+            attrs[key] = val
+        return attrs
+    
+    @classmethod
+    def from_transcripts(cls, transcripts, chrm=None, strand=None, gene_id=None):
+        transcripts = list(transcripts)
+        if len(transcripts) > 0:
+            if chrm is None: chrm = transcripts[0].chrm
+            if strand is None: strand = transcripts[0].strand
+            if gene_id is None: gene_id = transcripts[0].gene_id
+        
+        offsets = numpy.zeros(len(transcripts)+1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(
+            [len(t.exon_bnds) for t in transcripts], dtype=numpy.int64)
+        exon_bnds = numpy.fromiter(
+            chain(*[t.exon_bnds for t in transcripts]), 
+            dtype=numpy.int32, count=offsets[-1])
+        attributes = {}
+        for i, t in enumerate(transcripts):
+            attrs = cls._extract_attributes(t, chrm, strand, gene_id)
+            if len(attrs) > 0: attributes[i] = attrs
+        return cls(chrm, strand, gene_id, exon_bnds, offsets, 
+                   [t.id for t in transcripts], attributes)
+
+    def __len__(self):
+        return len(self.ids)
+    
+    def transcript_exon_bnds(self, i):
+        return self.exon_bnds[self.offsets[i]:self.offsets[i+1]]
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in xrange(*i.indices(len(self))) ]
+        if i < 0: i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError, "TranscriptSet index out of range"
+        attrs = dict(self.attributes.get(i, {}))
+        bnds = self.transcript_exon_bnds(i).tolist()
+        kwargs = dict( (key, attrs.pop(key)) 
+                       for key in TRANSCRIPT_INIT_KWARGS if key in attrs )
+        transcript = Transcript(
+            self.ids[i], attrs.pop('chrm', self.chrm), 
+            attrs.pop('strand', self.strand), 
+            zip(bnds[:-1:2], bnds[1::2]), attrs.pop('cds_region', None), 
+            attrs.pop('gene_id', self.gene_id), **kwargs )
+        # coding_sequence is only set with a cds region, so set it ( and 
+        # any other attributes that aren't constructor args ) explicitly 
+        if 'coding_sequence' in kwargs:
+            transcript.coding_sequence = kwargs['coding_sequence']
+        for key, val in attrs.iteritems():
+            setattr(transcript, key, val)
+        return transcript
+
+    def __setitem__(self, i, transcript):
+        if i < 0: i += len(self)
+        assert ( list(self.transcript_exon_bnds(i)) 
+                 == list(transcript.exon_bnds) ), \
+            "A TranscriptSet's transcript exons can not be changed"
+        self.ids[i] = transcript.id
+        attrs = self._extract_attributes(
+            transcript, self.chrm, self.strand, self.gene_id)
+        if len(attrs) > 0: self.attributes[i] = attrs
+        else: self.attributes.pop(i, None)
+        return
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+    
+    def exon_boundaries(self):
+        """Return the sorted unique exon starts and (stops+1).
+
+        This is the same as Gene.find_nonoverlapping_boundaries
+        """
+        bnds = self.exon_bnds.astype(numpy.int64)
+        bnds[1::2] += 1
+        return numpy.unique(bnds)
+
+    def iter_nonoverlapping_indices(self, exon_boundaries):
+        """Iterate over the indices of the exon_boundaries segments that 
+           each transcript covers.
+
+        exon_boundaries must contain every exon start and stop+1, 
+        e.g. from exon_boundaries()
+        """
+        exon_boundaries = numpy.asarray(exon_boundaries)
+        start_is = exon_boundaries.searchsorted(self.exon_bnds[0::2])
+        stop_is = exon_boundaries.searchsorted(
+            self.exon_bnds[1::2].astype(numpy.int64)+1)
+        assert ( stop_is < len(exon_boundaries) ).all()
+        assert ( exon_boundaries[start_is] == self.exon_bnds[0::2] ).all()
+        start_is, stop_is = start_is.tolist(), stop_is.tolist()
+        exon_offsets = (self.offsets//2).tolist()
+        for i in xrange(len(self)):
+            yield list(chain(*[ 
+                xrange(start_i, stop_i) for start_i, stop_i in izip(
+                    start_is[exon_offsets[i]:exon_offsets[i+1]],
+                    stop_is[exon_offsets[i]:exon_offsets[i+1]]) ]))
+        return
@@ -21,18 +21,67 @@ from distutils.core import setup, Extension
 
 from setuptools import setup, Extension
 
+import os, shutil, tempfile
+
+def find_openmp_args():
+    """Return the OpenMP flags if the compiler accepts them, and [] otherwise.
+
+    Without OpenMP ( e.g. Apple's clang ) the prange loops run serially.
+    """
+    from distutils.ccompiler import new_compiler
+    from distutils.sysconfig import customize_compiler
+    from distutils.errors import CompileError, LinkError
+    from distutils import log
+    args = ['-fopenmp',]
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, "test_openmp.c")
+        with open(fname, "w") as fp:
+            fp.write( "#include <omp.h>\n"
+                      "int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n")
+        try:
+            objects = compiler.compile(
+                [fname,], output_dir=tmp_dir, extra_postargs=args)
+            compiler.link_executable(
+                objects, os.path.join(tmp_dir, "test_openmp"), 
+                extra_postargs=args)
+        except (CompileError, LinkError):
+            log.warn("The compiler doesn't support OpenMP, so the " \
+                     + "likelihood kernels will be built single threaded")
+            return []
+    finally:
+        shutil.rmtree(tmp_dir)
+    return args
+
+# the likelihood kernels split large design matrices across threads
+OPENMP_ARGS = find_openmp_args()
+
+# the kernels use const memoryviews, which need Cython >= 0.28. The 
+# generated .c files are used when Cython isn't installed
+MIN_CYTHON_VERSION = '0.28'
+
 try:
-    from Cython.Setup import cythonize
+    from Cython.Build import cythonize
+    import Cython
+    from distutils.version import LooseVersion
+    if LooseVersion(Cython.__version__) < LooseVersion(MIN_CYTHON_VERSION):
+        raise ImportError, "Cython >= %s is required" % MIN_CYTHON_VERSION
     extensions = cythonize([
         Extension("grit.sparsify_support_fns", 
-                  ["grit/sparsify_support_fns.pyx", ]),
+                  ["grit/sparsify_support_fns.pyx", ],
+                  extra_compile_args=OPENMP_ARGS,
+                  extra_link_args=OPENMP_ARGS),
         Extension("grit.call_peaks_support_fns", 
                   ["grit/call_peaks_support_fns.pyx", ])
     ])
 except ImportError:
     extensions = [
         Extension("grit.sparsify_support_fns", 
-                  ["grit/sparsify_support_fns.c", ]),
+                  ["grit/sparsify_support_fns.c", ],
+                  extra_compile_args=OPENMP_ARGS,
+                  extra_link_args=OPENMP_ARGS),
         Extension("grit.call_peaks_support_fns", 
                   ["grit/call_peaks_support_fns.c", ])
     ]
@@ -0,0 +1,98 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import signal
+import multiprocessing
+
+import grit.files.gtf
+from grit import config
+from grit import estimate_transcript_expression as ete
+
+NUM_TRANSCRIPTS = 3
+TIMEOUT = 60
+
+class Data(object):
+    """Just enough of SharedData for quantify_genes.
+
+    """
+    def __init__(self, gene_ids):
+        self.gene_ids = gene_ids
+        self.gene_ntranscripts_mapping = dict(
+            (gene_id, NUM_TRANSCRIPTS) for gene_id in gene_ids)
+        self.design_matrices = set(gene_ids)
+
+    def get_num_reads_in_bams(self):
+        return [0,]
+
+def run_quantify_genes(monkeypatch, num_genes, killed_gene_id=None):
+    """Run quantify_genes with stand-ins that count the tasks they're given.
+
+    The worker that gets killed_gene_id's design matrix task exits without 
+    cleaning up, like a worker killed for using too much memory.
+    """
+    cnts = dict( (task_type, multiprocessing.Value('i', 0)) 
+                 for task_type in ete.QuantificationTasks.TASK_TYPES )
+    def count(task_type):
+        with cnts[task_type].get_lock():
+            cnts[task_type].value += 1
+    
+    def build_gene_design_matrix(data, gene_id, *args):
+        if gene_id == killed_gene_id: os._exit(1)
+        count('design_matrix')
+    def estimate_gene_mle(data, gene_id):
+        count('mle')
+        return NUM_TRANSCRIPTS
+    def estimate_gene_confidence_bounds(data, gene_id, cntr, bnd_types):
+        count('cbs')
+    
+    monkeypatch.setattr(ete, 'build_gene_design_matrix', 
+                        build_gene_design_matrix)
+    monkeypatch.setattr(ete, 'estimate_gene_mle', estimate_gene_mle)
+    monkeypatch.setattr(ete, 'estimate_gene_confidence_bounds', 
+                        estimate_gene_confidence_bounds)
+    monkeypatch.setattr(config, 'log_statement', lambda *args, **kwargs: None)
+    monkeypatch.setattr(config, 'NTHREADS', 4)
+    monkeypatch.setattr(config, 'EXPECTED_CNTS_CACHE_DIR', None)
+    
+    def timeout(signum, frame):
+        raise AssertionError, "quantify_genes didn't finish"
+    signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(TIMEOUT)
+    try:
+        gene_ids = ["gene%i" % i for i in xrange(num_genes)]
+        ete.quantify_genes(Data(gene_ids), {}, (None, None, None), ('lb', 'ub'))
+    finally:
+        signal.alarm(0)
+    return dict( (task_type, cnt.value) for task_type, cnt in cnts.items() )
+
+def test_quantify_genes(monkeypatch):
+    # every run depends on the 'FINISHED' sentinels reaching all of the 
+    # workers, so repeat it to catch them being lost
+    n_cb_tasks = min( 4, (NUM_TRANSCRIPTS + ete.NUM_TRANSCRIPTS_TO_CLAIM - 1)
+                      //ete.NUM_TRANSCRIPTS_TO_CLAIM )
+    for i in xrange(40):
+        cnts = run_quantify_genes(monkeypatch, 10)
+        assert cnts == {'design_matrix': 10, 'mle': 10, 'cbs': 10*n_cb_tasks}
+
+def test_quantify_genes_with_a_dead_worker(monkeypatch):
+    cnts = run_quantify_genes(monkeypatch, 10, killed_gene_id='gene3')
+    assert cnts['design_matrix'] == 9
+    # the dead worker's gene is still in data.design_matrices
+    assert cnts['mle'] == 10
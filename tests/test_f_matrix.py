@@ -0,0 +1,125 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import random
+
+import numpy
+
+import grit.files.gtf
+from grit.frag_len import FlDist
+from grit.files.reads import RNAseqReads, ReadSummary
+from grit.f_matrix import ( 
+    sum_fl_density_over_starts, sum_fl_density_over_starts_slow,
+    bin_rnaseq_reads, iter_paired_read_blocks )
+
+from tests.utils import write_paired_bam
+
+def random_fl_dist(rng):
+    fl_min = rng.randint(1, 50)
+    fl_max = fl_min + rng.randint(0, 60)
+    density = numpy.array(
+        [rng.random() for i in xrange(fl_max-fl_min+1)], dtype=float)
+    return FlDist(fl_min, fl_max, density/density.sum())
+
+def assert_agrees(fl_dist, min_start, max_start, min_stop, max_stop):
+    fast = sum_fl_density_over_starts(
+        fl_dist, min_start, max_start, min_stop, max_stop)
+    slow = sum_fl_density_over_starts_slow(
+        fl_dist, min_start, max_start, min_stop, max_stop)
+    # the sums are taken in a different order, so allow for rounding
+    assert abs(fast - slow) <= 1e-9*max(1.0, abs(slow)), (
+        fl_dist.fl_min, fl_dist.fl_max, 
+        min_start, max_start, min_stop, max_stop, fast, slow)
+
+def test_random_bounds():
+    rng = random.Random(0)
+    for i in xrange(3000):
+        fl_dist = random_fl_dist(rng)
+        min_start = rng.randint(0, 100)
+        max_start = min_start + rng.randint(-2, 80)
+        min_stop = rng.randint(0, 250)
+        max_stop = min_stop + rng.randint(-2, 80)
+        assert_agrees(fl_dist, min_start, max_start, min_stop, max_stop)
+
+def test_edge_cases():
+    rng = random.Random(1)
+    for i in xrange(200):
+        fl_dist = random_fl_dist(rng)
+        fl_min, fl_max = fl_dist.fl_min, fl_dist.fl_max
+        # empty start and stop ranges
+        assert_agrees(fl_dist, 10, 9, 50, 80)
+        assert_agrees(fl_dist, 10, 20, 80, 79)
+        # a single start position
+        start = rng.randint(0, 50)
+        assert_agrees(fl_dist, start, start, start+fl_min, start+fl_max)
+        assert_agrees(fl_dist, start, start, start, start+rng.randint(0, 200))
+        # lower_brk == upper_brk ( the ranges have the same length )
+        length = rng.randint(0, 40)
+        min_stop = start + rng.randint(0, 150)
+        assert_agrees(
+            fl_dist, start, start+length, min_stop, min_stop+length)
+        # ranges clipped by fl_min and by fl_max
+        assert_agrees(
+            fl_dist, 0, 30, fl_min - rng.randint(1, 20), fl_min + 10)
+        assert_agrees(
+            fl_dist, 0, 30, fl_max - 10, fl_max + rng.randint(1, 60))
+        # every fragment length is possible, and none are
+        assert_agrees(fl_dist, 0, 10, 0, fl_max + 20)
+        assert_agrees(fl_dist, 0, 10, fl_max + 11, fl_max + 40)
+        # stops before the starts
+        assert_agrees(fl_dist, 50, 60, 0, 40)
+
+def test_bin_rnaseq_reads_from_a_summary(tmpdir):
+    rng = random.Random(0)
+    pairs = []
+    for i in xrange(200):
+        pos = rng.randint(0, 800)
+        pairs.append( ("read%i" % i, 'chr1', 
+                       (pos, rng.choice(('50M', '20M100N30M'))), 
+                       (pos + rng.randint(0, 200), '50M')) )
+    fname = write_paired_bam(
+        str(tmpdir.join("reads.bam")), [('chr1', 2000),], pairs)
+    reads = RNAseqReads(fname).init(
+        reads_are_paired=True, pairs_are_opp_strand=True, 
+        reads_are_stranded=False, reverse_read_strand=False)
+    
+    exon_bndrys = numpy.array([0, 100, 250, 400, 700, 1100, 1500])
+    binned_reads = bin_rnaseq_reads(reads, 'chr1', '+', exon_bndrys)
+    summary = ReadSummary(reads, 'chr1', '.', 0, 1500)
+    assert bin_rnaseq_reads(summary, 'chr1', '+', exon_bndrys) == binned_reads
+    assert sum(binned_reads.values()) == len(pairs)
+
+def test_bin_rnaseq_reads_counts_every_pair_once(tmpdir):
+    # a read pair with two mappings, and a uniquely mapped read pair
+    pairs = [ ("multi", 'chr1', (100, '50M'), (300, '50M')),
+              ("multi", 'chr1', (800, '50M'), (1000, '50M')),
+              ("unique", 'chr1', (500, '50M'), (600, '50M')) ]
+    fname = write_paired_bam(
+        str(tmpdir.join("reads.bam")), [('chr1', 2000),], pairs)
+    reads = RNAseqReads(fname).init(
+        reads_are_paired=True, pairs_are_opp_strand=True, 
+        reads_are_stranded=False, reverse_read_strand=False)
+    exon_bndrys = numpy.array([0, 400, 1500])
+    for reads in (reads, ReadSummary(reads, 'chr1', '.', 0, 1500)):
+        num_pairs = len(list(
+            iter_paired_read_blocks(reads, 'chr1', '+', 0, 1501)))
+        binned_reads = bin_rnaseq_reads(reads, 'chr1', '+', exon_bndrys)
+        assert sum(binned_reads.values()) == num_pairs
+        assert all( isinstance(cnt, int) for cnt in binned_reads.values() )
@@ -0,0 +1,74 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+import scipy.sparse
+
+import grit.files.gtf
+from grit.frequency_estimation import (
+    estimate_transcript_frequencies, calc_lhd, calc_gradient, LHD_ABS_TOL)
+
+def random_design_matrix(rng, num_bins, num_transcripts, num_reads,
+                         alpha=0.5):
+    """A random sparse design matrix, and reads simulated from it.
+
+    Every transcript has at least one bin, and each column sums to 1. The
+    frequencies are Dirichlet(alpha), so a small alpha makes some of them
+    close to 0.
+    """
+    expected = rng.rand(num_bins, num_transcripts)
+    expected *= ( rng.rand(num_bins, num_transcripts) < 0.3 )
+    expected[rng.randint(num_bins, size=num_transcripts), 
+             numpy.arange(num_transcripts)] += 1
+    expected /= expected.sum(0)
+    freqs = rng.dirichlet(alpha*numpy.ones(num_transcripts))
+    observed = rng.multinomial(num_reads, expected.dot(freqs))
+    return observed, scipy.sparse.csr_matrix(expected)
+
+def test_solvers_agree():
+    # line_search can stop short when some of the MLE frequencies are 0, so
+    # we simulate from frequencies that are all well away from it
+    rng = numpy.random.RandomState(0)
+    for num_bins, num_transcripts, num_reads in (
+            (20, 3, 2000), (50, 8, 5000), (100, 12, 10000)):
+        observed, expected = random_design_matrix(
+            rng, num_bins, num_transcripts, num_reads, alpha=5.)
+        lhds = {}
+        for solver in ('line_search', 'squarem'):
+            x = estimate_transcript_frequencies(observed, expected, solver)
+            assert abs(x.sum() - 1) < 1e-6 and (x >= 0).all()
+            lhds[solver] = calc_lhd(x, observed, expected)
+        assert abs(lhds['squarem'] - lhds['line_search']) < LHD_ABS_TOL, lhds
+
+def test_squarem_converges():
+    # at the MLE, the lhd gradient is num_reads for every transcript with 
+    # a non-zero frequency, and no larger for the others
+    rng = numpy.random.RandomState(1)
+    observed, expected = random_design_matrix(rng, 1000, 60, 100000)
+    x = estimate_transcript_frequencies(observed, expected, 'squarem')
+    gradient = -calc_gradient(x, observed, expected)/observed.sum()
+    assert gradient.max() < 1 + 1e-5
+    assert numpy.absolute(gradient[x > 1e-6] - 1).max() < 1e-5
+
+def test_single_transcript():
+    observed = numpy.array([3, 0, 5])
+    expected = scipy.sparse.csr_matrix(numpy.array([[0.5], [0.2], [0.3]]))
+    for solver in ('line_search', 'squarem'):
+        x = estimate_transcript_frequencies(observed, expected, solver)
+        assert (x == [1.]).all()
@@ -0,0 +1,127 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import signal
+import time
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import pytest
+
+import grit.files.gtf
+import grit.genes
+from grit import config
+from grit.genes import (
+    wait_on_gene_segment_workers, split_genome_into_segments_by_read_density )
+from grit.files.reads import RNAseqReads, BAM_INDEX_WINDOW_SIZE
+
+from tests.utils import write_paired_bam
+
+CONTIGS = ['chr1', 'chr2']
+
+def fork_workers(monkeypatch, exits):
+    """Fork a worker for each (segment, exit status or signal) in exits.
+
+    Each worker stores its segment like find_segments_and_jns_worker, and 
+    then exits with the status, or kills itself with the signal.
+    """
+    monkeypatch.setattr(config, 'log_statement', lambda *args, **kwargs: None)
+    current_segments = RawArray('l', [-1,]*(3*len(exits)))
+    pids = []
+    for i, (segment, (exit_status, sig)) in enumerate(exits):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if segment != None:
+                    current_segments[3*i:3*i+3] = [
+                        CONTIGS.index(segment[0]), segment[1], segment[2]]
+                time.sleep(0.2)
+                if sig != None: os.kill(os.getpid(), sig)
+            finally:
+                os._exit(exit_status)
+        pids.append(pid)
+    return pids, current_segments
+
+def test_workers_finish(monkeypatch):
+    pids, current_segments = fork_workers(
+        monkeypatch, [(('chr1', 0, 100), (0, None)), (None, (0, None))])
+    wait_on_gene_segment_workers(
+        pids, current_segments, CONTIGS, multiprocessing.Queue(), 2)
+
+@pytest.mark.parametrize("exit_status, sig, reason", [
+        (1, None, "exited with status 1"), 
+        (0, signal.SIGKILL, "was killed by signal %i" % signal.SIGKILL)])
+def test_worker_dies(monkeypatch, exit_status, sig, reason):
+    pids, current_segments = fork_workers(monkeypatch, [
+            (('chr1', 0, 100), (0, None)), 
+            (('chr2', 100, 200), (exit_status, sig)), 
+            (None, (0, None)) ])
+    with pytest.raises(OSError) as excinfo:
+        wait_on_gene_segment_workers(
+            pids, current_segments, CONTIGS, multiprocessing.Queue(), 3)
+    assert "worker 1 (pid %i) %s" % (pids[1], reason) in str(excinfo.value)
+    assert "segment ('chr2', 100, 200)" in str(excinfo.value)
+    # the other workers have been waited on
+    for pid in pids:
+        with pytest.raises(OSError):
+            os.waitpid(pid, os.WNOHANG)
+
+def write_reads_across_windows(tmpdir, n_windows):
+    """Write reads that cover each of the first n_windows window boundaries.
+
+    The reads near the boundary between windows that starts at w cover 
+    [w-100, w+28], so the closest uncovered base to the boundary is w+29.
+    """
+    pairs = []
+    for window_i in xrange(1, n_windows+1):
+        bnd = window_i*BAM_INDEX_WINDOW_SIZE
+        for read_i in xrange(20):
+            pos = bnd - 100 + read_i
+            pairs.append(("r%i_%i" % (window_i, read_i), 'chr1', 
+                          (pos, '50M'), (pos+60, '50M')))
+    fname = write_paired_bam(
+        str(tmpdir.join("reads.bam")), 
+        [('chr1', (n_windows+2)*BAM_INDEX_WINDOW_SIZE)], pairs)
+    return RNAseqReads(fname).init(
+        reads_are_paired=True, pairs_are_opp_strand=True, 
+        reads_are_stranded=False, reverse_read_strand=False)
+
+@pytest.mark.parametrize("nthreads", [1, 2])
+def test_split_genome_into_segments_by_read_density(
+        monkeypatch, tmpdir, nthreads):
+    monkeypatch.setattr(config, 'NTHREADS', nthreads)
+    # make every window with reads end a segment
+    monkeypatch.setattr(grit.genes, 'SEGMENTS_PER_THREAD', 100)
+    n_windows = 6
+    reads = write_reads_across_windows(tmpdir, n_windows)
+    contig_len = (n_windows+2)*BAM_INDEX_WINDOW_SIZE
+    segments = split_genome_into_segments_by_read_density(
+        {'1': contig_len}, None, [reads,])
+    
+    # the segments tile the contig, and they are cut at the uncovered bases
+    # next to the window boundaries
+    segments.sort()
+    assert segments[0][1] == 0 and segments[-1][2] == contig_len-1
+    for (contig, start, stop), (next_contig, next_start, next_stop) in zip(
+            segments[:-1], segments[1:]):
+        assert next_start == stop + 1
+    assert [ stop for contig, start, stop in segments[:-1] ] == [
+        window_i*BAM_INDEX_WINDOW_SIZE + 29 
+        for window_i in xrange(1, n_windows+1) ]
@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+from scipy.special import gammaln
+
+import grit.files.gtf
+from grit.peaks import calc_null_moments, NullMoments, NULL_MOMENTS_TOL
+from grit.call_peaks_support_fns import calc_moments
+
+def full_moments(p, n):
+    """The moments summed over every x in [0, n].
+
+    """
+    xs = numpy.arange(n+1)
+    prbs = numpy.exp(gammaln(n+1) - gammaln(xs+1) - gammaln(n-xs+1)
+                     + xs*numpy.log(p) + (n-xs)*numpy.log1p(-p))
+    values = xs*numpy.log(p) - gammaln(xs+1)
+    mean = (prbs*values).sum()
+    return mean, (prbs*(values-mean)**2).sum()
+
+def assert_moments_agree(ps, n, ref_fn):
+    means, variances = calc_null_moments(ps, n)
+    for p, mean, variance in zip(ps, means, variances):
+        ref_mean, ref_variance = ref_fn(p, n)
+        assert abs(mean - ref_mean) <= NULL_MOMENTS_TOL*max(1, abs(ref_mean)),\
+            (p, n, mean, ref_mean)
+        assert ( abs(variance - ref_variance) 
+                 <= NULL_MOMENTS_TOL*max(1, abs(ref_variance)) ), \
+            (p, n, variance, ref_variance)
+
+def test_agrees_with_calc_moments():
+    # calc_moments stops summing once the terms are below an absolute 
+    # tolerance, so its own error grows with n. Up to n=1000 it's well 
+    # within NULL_MOMENTS_TOL. Small n*p clips the window at 0, and small 
+    # n or p near 1 clips it at n
+    numpy.random.seed(0)
+    for n in (1, 2, 5, 30, 200, 1000):
+        ps = numpy.hstack((10**numpy.random.uniform(-8, -0.005, 100), 
+                           [1e-12, 0.5, 0.99]))
+        assert_moments_agree(ps, n, calc_moments)
+    for n in (1, 2, 5, 30):
+        assert_moments_agree(
+            1 - 10**numpy.random.uniform(-9, -1, 20), n, calc_moments)
+
+def test_agrees_with_full_sum():
+    # calc_moments loses the variance to cancellation when the mean is large,
+    # so check large n and p near 1 against the sum over every x
+    numpy.random.seed(1)
+    for n in (5000, 50000):
+        ps = numpy.hstack((10**numpy.random.uniform(-8, 0, 50), 
+                           1 - 10**numpy.random.uniform(-9, -1, 20)))
+        assert_moments_agree(ps[ps < 1], n, full_moments)
+
+def test_edge_cases():
+    means, variances = calc_null_moments([], 10)
+    assert len(means) == len(variances) == 0
+    means, variances = calc_null_moments([0.1, 0.5], 0)
+    assert (means == 0).all() and (variances == 0).all()
+    
+    # the moments of a shuffled array are shuffled
+    ps = 10**numpy.random.uniform(-6, -0.1, 50)
+    order = numpy.random.permutation(len(ps))
+    means, variances = calc_null_moments(ps, 300)
+    shuffled_means, shuffled_variances = calc_null_moments(ps[order], 300)
+    assert numpy.allclose(shuffled_means, means[order])
+    assert numpy.allclose(shuffled_variances, variances[order])
+
+def test_null_moments_cumsums():
+    ps = 10**numpy.random.uniform(-6, -0.1, 20)
+    null_moments = NullMoments(ps)
+    mean_cumsum, var_cumsum = null_moments.cumsums(100)
+    means, variances = calc_null_moments(ps, 100)
+    assert numpy.allclose(mean_cumsum[1:], means.cumsum())
+    assert numpy.allclose(var_cumsum[1:], variances.cumsum())
+    assert null_moments.cumsums(100)[0] is mean_cumsum
+    assert numpy.allclose(
+        null_moments.cumsums(50)[0][1:], calc_null_moments(ps, 50)[0].cumsum())
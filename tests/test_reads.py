@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+import pysam
+import pytest
+
+import grit.files.gtf
+import grit.files.reads
+from grit.files.reads import (
+    ReadDataStore, pair_reads, iter_paired_reads, 
+    estimate_read_density_from_index, BAM_INDEX_WINDOW_SIZE )
+
+from tests.utils import write_paired_bam
+
+def build_read_data(reads):
+    """Build a ReadDataStore from (qname, is_read1, strand, read_grp, pos).
+
+    """
+    read_data = ReadDataStore()
+    for qname, is_read1, strand, read_grp, pos in reads:
+        read_data.add(qname, is_read1, strand, read_grp, 1.0, 10, 
+                      ((pos, pos+9),))
+    return read_data
+
+def find_pairs(read_data):
+    paired_reads = pair_reads(read_data)
+    return sorted( 
+        (read_data.qnames[read_data.qname_id[i]], 
+         int(read_data.read_starts(i)), int(read_data.read_starts(j))) 
+        for i, j in zip(paired_reads.r1_indices, paired_reads.r2_indices) )
+
+def test_pair_reads():
+    read_data = build_read_data([
+        ('a', True, '+', 'rg1', 0), ('b', True, '+', 'rg2', 100), 
+        ('a', False, '+', 'rg1', 50), ('c', False, '+', 'rg1', 200),
+        ('d', True, '+', 'rg1', 300), ('d', False, '-', 'rg1', 350),
+        ('e', True, '+', 'rg1', 400), ('e', True, '+', 'rg1', 500),
+        ('e', False, '+', 'rg1', 450), ('e', False, '+', 'rg1', 550),
+        ('b', False, '+', 'rg2', 150) ])
+    # unpaired reads and mates on opposite strands aren't paired, and a 
+    # multi-mapped read is paired in every combination
+    assert find_pairs(read_data) == [
+        ('a', 0, 50), ('b', 100, 150), 
+        ('e', 400, 450), ('e', 400, 550), ('e', 500, 450), ('e', 500, 550) ]
+    
+    post_prbs = dict( 
+        (qname, [mapping[-1] for mapping in mappings]) 
+        for qname, mappings in iter_paired_reads(read_data) )
+    assert post_prbs == {'a': [1.0,], 'b': [1.0,], 'e': [0.25,]*4}
+
+def test_pair_reads_compares_qnames(monkeypatch):
+    # reads are paired by qname, so even if every qname had the same hash
+    # the reads would be paired correctly
+    monkeypatch.setattr(grit.files.reads, 'hash', lambda qname: 0, 
+                        raising=False)
+    read_data = build_read_data([
+        ('a', True, '+', 'rg1', 0), ('b', True, '+', 'rg2', 100), 
+        ('a', False, '+', 'rg1', 50), ('b', False, '+', 'rg2', 150) ])
+    assert find_pairs(read_data) == [('a', 0, 50), ('b', 100, 150)]
+    assert [qname for qname, mappings in iter_paired_reads(read_data)] \
+        == ['a', 'b']
+
+# the number of read pairs starting in each BAM_INDEX_WINDOW_SIZE window. 
+# This is few enough reads that they all fit in one bgzf block, so the 
+# offsets in the index aren't distorted by the compression ratio estimate
+WINDOW_READ_COUNTS = [40, 10, 0, 20, 40, 10]
+
+def write_indexed_bam(tmpdir, index_args=()):
+    pairs = []
+    for window_i, n_reads in enumerate(WINDOW_READ_COUNTS):
+        for read_i in xrange(n_reads):
+            pos = window_i*BAM_INDEX_WINDOW_SIZE + 100 + read_i
+            pairs.append(("r%i_%i" % (window_i, read_i), 'chr1', 
+                          (pos, '50M'), (pos+100, '50M')))
+    fname = write_paired_bam(
+        str(tmpdir.join("reads.bam")), 
+        [('chr1', (len(WINDOW_READ_COUNTS)+1)*BAM_INDEX_WINDOW_SIZE)], 
+        pairs, index_args)
+    return pysam.AlignmentFile(fname)
+
+def check_density(density):
+    assert len(density) == len(WINDOW_READ_COUNTS)
+    # the last window isn't checked, because the index only stores the 
+    # compressed offset of the end of its reads, and the read records differ
+    # in size by their qname length
+    counts = numpy.array(WINDOW_READ_COUNTS[:-1], dtype=float)
+    assert numpy.allclose(density[:-1]/density[:-1].sum(), 
+                          counts/counts.sum(), rtol=0.02, atol=0)
+
+def test_estimate_read_density_from_bai(tmpdir):
+    densities = estimate_read_density_from_index(write_indexed_bam(tmpdir))
+    assert list(densities) == ['1']
+    check_density(densities['1'])
+
+def test_estimate_read_density_from_csi(tmpdir):
+    bai_density = estimate_read_density_from_index(
+        write_indexed_bam(tmpdir.mkdir("bai")))['1']
+    csi_reads = write_indexed_bam(tmpdir.mkdir("csi"), ('-c',))
+    assert not tmpdir.join("csi", "reads.bam.bai").check()
+    csi_density = estimate_read_density_from_index(csi_reads)['1']
+    assert numpy.allclose(csi_density, bai_density)
+
+def test_estimate_read_density_from_csi_with_small_bins(tmpdir):
+    # 4096 bp bins are resampled to BAM_INDEX_WINDOW_SIZE windows
+    reads = write_indexed_bam(tmpdir, ('-c', '-m', '12'))
+    check_density(estimate_read_density_from_index(reads)['1'])
+
+def test_estimate_read_density_without_an_index(tmpdir):
+    reads = write_indexed_bam(tmpdir)
+    tmpdir.join("reads.bam.bai").remove()
+    assert estimate_read_density_from_index(reads) is None
+
+def test_estimate_read_density_from_a_bad_index(tmpdir):
+    reads = write_indexed_bam(tmpdir)
+    tmpdir.join("reads.bam.bai").write("not an index")
+    with pytest.raises(ValueError):
+        estimate_read_density_from_index(reads)
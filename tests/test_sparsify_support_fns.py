@@ -0,0 +1,78 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+import scipy.sparse
+
+import grit.files.gtf
+from grit import frequency_estimation
+from grit import sparsify_support_fns
+
+def random_design_matrix(n_bins, n_transcripts, seed):
+    numpy.random.seed(seed)
+    expected = numpy.random.rand(n_bins, n_transcripts)
+    expected[numpy.random.rand(n_bins, n_transcripts) > 0.4] = 0
+    expected /= expected.sum(0) + 1e-300
+    observed = numpy.random.poisson(5, n_bins)
+    x = numpy.random.rand(n_transcripts)
+    return expected, observed, x/x.sum()
+
+def reference_lhd_and_gradient(x, observed, expected):
+    bin_freqs = expected.dot(x) + 1e-16
+    return ( float(numpy.dot(observed, numpy.log(bin_freqs))),
+             -expected.T.dot(observed/bin_freqs) )
+
+def test_kernels_match_reference():
+    # 20000 bins is above PARALLEL_MIN_NUM_BINS, so it uses the threaded path
+    for seed, (n_bins, n_transcripts) in enumerate(
+            [(1, 1), (5, 3), (100, 7), (20000, 12)]):
+        expected, observed, x = random_design_matrix(
+            n_bins, n_transcripts, seed)
+        lhd, gradient = reference_lhd_and_gradient(x, observed, expected)
+        for matrix in ( expected, scipy.sparse.csr_matrix(expected), 
+                        scipy.sparse.csc_matrix(expected) ):
+            rv = frequency_estimation.calc_lhd_and_gradient(
+                x, observed, matrix)
+            assert numpy.allclose(rv[0], lhd)
+            assert numpy.allclose(rv[1], gradient)
+            assert numpy.allclose(
+                frequency_estimation.calc_lhd(x, observed, matrix), lhd)
+            assert numpy.allclose(
+                frequency_estimation.calc_gradient(x, observed, matrix), 
+                gradient)
+
+def test_csr_kernels_accept_int64_indices_and_read_only_arrays():
+    expected, observed, x = random_design_matrix(50, 4, 0)
+    lhd, gradient = reference_lhd_and_gradient(x, observed, expected)
+    matrix = scipy.sparse.csr_matrix(expected)
+    arrays = [ matrix.data, matrix.indices.astype(numpy.int64), 
+               matrix.indptr.astype(numpy.int64), observed.astype(numpy.int64)]
+    for array in arrays: array.setflags(write=False)
+    data, indices, indptr, observed = arrays
+    rv = sparsify_support_fns.calc_csr_lhd_and_gradient(
+        x, observed, data, indices, indptr)
+    assert numpy.allclose(rv[0], lhd)
+    assert numpy.allclose(rv[1], gradient)
+
+def test_hessian():
+    expected, observed, x = random_design_matrix(30, 5, 0)
+    hessian = sparsify_support_fns.calc_hessian(
+        x, observed.astype(numpy.int64), expected)
+    weights = observed/(expected.dot(x) + 1e-16)**2
+    assert numpy.allclose(hessian, (expected*weights[:,None]).T.dot(expected))
@@ -0,0 +1,122 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import numpy
+import pytest
+
+import grit.files.gtf
+from grit.splice_graph import (
+    SpliceGraph, NotADAGError, labels_to_bitmask, bitmask_to_labels,
+    SEGMENT, TSS, TES, ADJACENT, SPLICE, TSS_EDGE, TES_EDGE )
+
+def build_graph():
+    """Build the graph of a gene with a skipped exon.
+
+    TSS(0) -> segment(1) -> segment(2) -> segment(3) -> TES(4), and an 
+    intron that splices segment 1 to segment 3. The edges aren't given in 
+    source order.
+    """
+    return SpliceGraph(
+        [TSS, SEGMENT, SEGMENT, SEGMENT, TES],
+        [0, 0, 100, 200, 290], [9, 99, 199, 299, 299],
+        [3, 1, 0, 2, 1], [4, 3, 1, 3, 2],
+        [TES_EDGE, SPLICE, TSS_EDGE, ADJACENT, ADJACENT], 
+        [0, 5, 0, 1, 2],
+        left_labels=[0, labels_to_bitmask(['TSS']), 
+                     labels_to_bitmask(['R_JN']), 0, 0])
+
+def test_labels_to_bitmask():
+    bitmask = labels_to_bitmask(['TSS', 'D_JN', 'EMPTY_STOP'])
+    assert bitmask_to_labels(bitmask) == ['D_JN', 'EMPTY_STOP', 'TSS']
+    assert bitmask_to_labels(labels_to_bitmask([])) == []
+
+def test_edges_are_sorted_by_source():
+    graph = build_graph()
+    assert len(graph) == 5 and graph.n_edges == 5
+    assert list(graph.edge_srcs) == [0, 1, 1, 2, 3]
+    # the edges out of a node stay in the order that they were given
+    assert list(graph.edge_dsts) == [1, 3, 2, 3, 4]
+    assert list(graph.edge_types) == [
+        TSS_EDGE, SPLICE, ADJACENT, ADJACENT, TES_EDGE]
+    assert list(graph.edge_cnts) == [0, 5, 2, 1, 0]
+    assert list(graph.node_lengths()) == [10, 100, 100, 100, 10]
+    assert bitmask_to_labels(graph.left_labels[2]) == ['R_JN']
+    assert numpy.isnan(graph.node_fpkms).all()
+    assert numpy.isnan(graph.edge_fpkms).all()
+
+def test_successors_and_predecessors():
+    graph = build_graph()
+    assert [list(graph.successors(node)) for node in xrange(5)] == [
+        [1], [3, 2], [3], [4], []]
+    assert [sorted(graph.predecessors(node)) for node in xrange(5)] == [
+        [], [0], [1], [1, 2], [3]]
+    for node in xrange(5):
+        assert list(graph.edge_dsts[graph.successor_edges(node)]) \
+            == list(graph.successors(node))
+        assert all(graph.edge_dsts[graph.predecessor_edges(node)] == node)
+    assert list(graph.out_edges([1, 3])) == [1, 2, 4]
+    assert list(graph.out_edges([4])) == []
+
+def test_nodes_and_edges_of_type():
+    graph = build_graph()
+    assert list(graph.nodes_of_type(SEGMENT)) == [1, 2, 3]
+    assert list(graph.nodes_of_type(TES)) == [4]
+    assert list(graph.edges_of_type(SPLICE)) == [1]
+
+def test_topological_levels():
+    graph = build_graph()
+    assert [list(level) for level in graph.topological_levels()] == [
+        [0], [1], [2], [3], [4]]
+    assert graph.is_dag()
+    
+    cyclic_graph = SpliceGraph(
+        [SEGMENT, SEGMENT, SEGMENT], [0, 10, 20], [9, 19, 29],
+        [0, 1, 2], [1, 2, 1], [ADJACENT, ADJACENT, SPLICE])
+    assert not cyclic_graph.is_dag()
+    with pytest.raises(NotADAGError):
+        cyclic_graph.topological_levels()
+
+def test_expression():
+    graph = build_graph()
+    graph.set_node_expression([1, 2], [(1, 2, 3), (4, 5, 6)])
+    graph.set_edge_expression(1, (0.5, 1, 1.5))
+    assert graph.node_fpkms[1:3].tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert numpy.isnan(graph.node_fpkms[[0, 3, 4]]).all()
+    assert graph.edge_fpkms[1].tolist() == [0.5, 1, 1.5]
+    with pytest.raises(AssertionError):
+        graph.set_node_expression(0, (numpy.nan, 1, 2))
+
+def test_without_edges():
+    graph = build_graph()
+    graph.set_node_expression(1, (1, 2, 3))
+    graph.set_edge_expression([1, 2], [(1, 2, 3), (4, 5, 6)])
+    graph.node_bins[0] = 'tss bin'
+    
+    # remove the splice
+    new_graph = graph.without_edges([1])
+    assert len(new_graph) == len(graph) and new_graph.n_edges == 4
+    assert [list(new_graph.successors(node)) for node in xrange(5)] == [
+        [1], [2], [3], [4], []]
+    assert new_graph.node_fpkms[1].tolist() == [1, 2, 3]
+    assert new_graph.edge_fpkms[1].tolist() == [4, 5, 6]
+    assert new_graph.node_bins == {0: 'tss bin'}
+    # the original graph is unchanged
+    assert graph.n_edges == 5
+    assert list(graph.successors(1)) == [3, 2]
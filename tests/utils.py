@@ -0,0 +1,67 @@
+"""
+Copyright (c) 2011-2015 Nathan Boley
+
+This file is part of GRIT.
+
+GRIT is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+GRIT is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with GRIT.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import subprocess
+
+import pysam
+
+def write_paired_bam(fname, contig_lens, pairs, index_args=()):
+    """Write a sorted and indexed bam of read pairs.
+
+    contig_lens is a list of (contig, length) tuples, and pairs is a list of
+    (qname, contig, (read 1 pos, cigar), (read 2 pos, cigar)) tuples. Read 1
+    is on the forward strand and read 2 on the reverse strand. index_args
+    are passed to samtools index, e.g. ('-c',) writes a .csi index.
+    """
+    contigs = [contig for contig, length in contig_lens]
+    reads = []
+    for qname, contig, (pos1, cigar1), (pos2, cigar2) in pairs:
+        for is_read1, pos, cigar, mate_pos in (
+                (True, pos1, cigar1, pos2), (False, pos2, cigar2, pos1)):
+            read = pysam.AlignedSegment()
+            read.query_name = qname
+            read.reference_id = contigs.index(contig)
+            read.reference_start = pos
+            read.cigarstring = cigar
+            read.mapping_quality = 255
+            # paired, proper pair, and read 1 forward / read 2 reverse
+            read.flag = 1 | 2 | ( 64|32 if is_read1 else 128|16 )
+            read.next_reference_id = read.reference_id
+            read.next_reference_start = mate_pos
+            read_len = read.infer_query_length()
+            read.query_sequence = 'A'*read_len
+            read.query_qualities = pysam.qualitystring_to_array('I'*read_len)
+            reads.append(read)
+
+    # sort here rather than with samtools sort, because samtools doesn't
+    # reset its option parsing between the commands that pysam runs in
+    # this process
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    header = { 'HD': {'VN': '1.0', 'SO': 'coordinate'},
+               'SQ': [ {'SN': contig, 'LN': length}
+                       for contig, length in contig_lens ] }
+    with pysam.AlignmentFile(fname, 'wb', header=header) as ofp:
+        for read in reads:
+            ofp.write(read)
+    # for the same reason, index in a new process
+    subprocess.check_call(
+        [sys.executable, "-c", "import sys, pysam; pysam.index(*sys.argv[1:])"]
+        + list(index_args) + [fname,])
+    return fname